@@ -1,7 +1,14 @@
 import random
 
+from GameManagers import ai_pool
+from .board import Board
+
 
 class BattleShipAI:
+    # The attributes that get_ai_move uses to remember its earlier shots, sent to and from the AI worker pool
+    SEARCH_STATE = ("last_shot", "homing", "direction_established", "last_hit", "homing_start", "direction",
+                    "backtracking")
+    POOL_PRIORITY = 1  # A move only takes a moment to work out, so the pool serves it ahead of most chess searches
 
     def __init__(self, board, current_room):
         """
@@ -191,6 +198,55 @@ class BattleShipAI:
 
         return self.get_random_shot(enemy_board)
 
+    def get_search_state(self):
+        """
+        Returns what the AI remembers about its earlier shots
+        :return: A dictionary of the SEARCH_STATE attributes, and the ids of the ships it has seen sunk
+        """
+        state = {name: getattr(self, name) for name in BattleShipAI.SEARCH_STATE}
+        state["sunk_ships"] = [ship.id for ship in self.sunk_ships]
+        return state
+
+    def set_search_state(self, state, enemy_board):
+        """
+        Restores what the AI remembers about its earlier shots
+        :param state: A dictionary from get_search_state
+        :param enemy_board: The enemy's board, whose ships the sunk ship ids refer to
+        :return:
+        """
+        for name in BattleShipAI.SEARCH_STATE:
+            setattr(self, name, state[name])
+        self.sunk_ships = [ship for ship in enemy_board.ships if ship.id in state["sunk_ships"]]
+
+    @staticmethod
+    def search_pooled_move(state, board_size, enemy_board):
+        """
+        Gets the AI's next move from its state. Called in a worker process of the AI worker pool.
+        :param state: The state of the AI, from get_search_state
+        :param board_size: The size of the boards
+        :param enemy_board: The enemy's board
+        :return: A tuple of (the move, the new state of the AI)
+        """
+        # The AI's own board is only used for its size, so it is not sent to the worker
+        ai = BattleShipAI.__new__(BattleShipAI)
+        ai.board = Board(board_size, None)
+        ai.set_search_state(state, enemy_board)
+        move = ai.get_ai_move(enemy_board)
+        return move, ai.get_search_state()
+
+    def get_pooled_move(self, enemy_board):
+        """
+        Gets the AI's next move from the server's AI worker pool, see get_ai_move
+        :param enemy_board: The enemy's board
+        :return: The AI's next move
+        """
+        future = ai_pool.AIWorkerPool.get_default().submit(
+            self.current_room.room_id, BattleShipAI.search_pooled_move, self.get_search_state(), self.board.size,
+            enemy_board, priority=BattleShipAI.POOL_PRIORITY)
+        move, state = future.result()
+        self.set_search_state(state, enemy_board)
+        return move
+
     def debug(self):
         """
         Print debug information
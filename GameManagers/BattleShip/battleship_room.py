@@ -1,6 +1,7 @@
 import random
 import threading
 import time
+from concurrent.futures import CancelledError
 
 from GameManagers.base_room import BaseRoom
 from loguru import logger as logging
@@ -34,6 +35,8 @@ class BattleShip(BaseRoom):
         else:
             logging.warning("BattleShip AI could not be imported. AI disabled.")
             self.ai_enable = False
+        # Whether the AI moves are made by the server's AI worker pool
+        self.ai_pool = starting_config["ai_pool"] if "ai_pool" in starting_config else True
 
         self.boards = [Board(self.board_size, ships), Board(self.board_size, ships)]
 
@@ -126,12 +129,22 @@ class BattleShip(BaseRoom):
     def ai_thread(self):
         ai_exceptions = 0
         while not self.game_over:
+            # Sleep until post_move makes it the AI's turn or the game ends
+            self.wait_for_turn(lambda: self.game_over or (self.both_ready and
+                                                          isinstance(self.current_player, BattleShipAI)))
+            # Then pause as if thinking, so the human can see their own move before the AI's
+            time.sleep(random.uniform(0.5, 1.5))
             try:
-                if isinstance(self.current_player, BattleShipAI):
+                if not self.game_over and isinstance(self.current_player, BattleShipAI):
                     # logging.info(self.users[1])
-                    move = self.current_player.get_ai_move(self.boards[0])
+                    if self.ai_pool:
+                        move = self.current_player.get_pooled_move(self.boards[0])
+                    else:
+                        move = self.current_player.get_ai_move(self.boards[0])
                     logging.info(move)
                     self.post_move(self.users[1], move)
+            except CancelledError:
+                break  # The room was closed while the AI worker pool was making its move
             except Exception as e:
                 ai_exceptions += 1
                 logging.exception(e)
@@ -143,55 +156,62 @@ class BattleShip(BaseRoom):
                         player.room_updated = True
                     self.state = "[red]AI Error[/red]"
                     break
-            time.sleep(random.uniform(0.5, 1.5))
 
-    def post_move(self, user, move):
+    def close(self):
+        with self.turn_changed:
+            self.game_over = True
+        super().close()
 
-        if len(self.users) == 1 and self.ai_enable:
-            self.users.append(BattleShipAI(self.boards[1], self))
-            self.current_player = self.users[0]
-            threading.Thread(target=self.ai_thread, daemon=True).start()
-
-        for player in self.users + self.spectators:
-            player.room_updated = True
-
-        if not self.both_ready:
-            logging.debug(move)
-            if "placed_ships" not in move:
-                return {"error": "No placement data"}
-            for ship in move["placed_ships"]:
-                ship_obj = self.boards[self.users.index(user)].get_ship(ship["id"])
-                if not self.boards[self.users.index(user)].place_ship(ship_obj, ship["x"], ship["y"],
-                                                                      ship["direction"]):
-                    return {"error": "Invalid ship placement."}
-                logging.info(f"User {user.username} placed a ship of size {ship['size']} at ({ship['x']}, {ship['y']})"
-                             f" facing {ship['direction']}")
-            if [board.ready() for board in self.boards] == [True, True]:
-                self.state = "In Progress"
-                self.both_ready = True
+    def post_move(self, user, move):
+        # Every change of turn happens with turn_changed held, so the AI thread only sees the turn once the move is
+        # complete
+        with self.turn_changed:
+            if len(self.users) == 1 and self.ai_enable:
+                self.users.append(BattleShipAI(self.boards[1], self))
                 self.current_player = self.users[0]
-                logging.info(f"{self.room_id} both players ready, starting game")
-        else:
-            if user.user_id != self.current_player.user_id:
-                logging.info(f"{user.username} tried to make a move out of turn.")
-                return {"error": "It is not your turn."}
-
-            if len(self.users) == 2:
-                self.current_player = self.users[1] if self.current_player == self.users[0] else self.users[0]
+                threading.Thread(target=self.ai_thread, daemon=True).start()
+
+            for player in self.users + self.spectators:
+                player.room_updated = True
+
+            if not self.both_ready:
+                logging.debug(move)
+                if "placed_ships" not in move:
+                    return {"error": "No placement data"}
+                for ship in move["placed_ships"]:
+                    ship_obj = self.boards[self.users.index(user)].get_ship(ship["id"])
+                    if not self.boards[self.users.index(user)].place_ship(ship_obj, ship["x"], ship["y"],
+                                                                          ship["direction"]):
+                        return {"error": "Invalid ship placement."}
+                    logging.info(f"User {user.username} placed a ship of size {ship['size']} at "
+                                 f"({ship['x']}, {ship['y']}) facing {ship['direction']}")
+                if [board.ready() for board in self.boards] == [True, True]:
+                    self.state = "In Progress"
+                    self.both_ready = True
+                    self.current_player = self.users[0]
+                    logging.info(f"{self.room_id} both players ready, starting game")
             else:
-                self.current_player = self.users[0]
-
-            # Check if the move has already been made
-            if self.get_board(self.current_player).board[move["x"]][move["y"]] != 0:
-                self.current_player = self.users[1] if self.current_player == self.users[0] else self.users[0]
-                return {"error": "You have already made this move."}
-
-            if self.get_board(self.current_player).is_hit(move["x"], move["y"]):
-                logging.info(f"{user.username} hit ({move['x']}, {move['y']})")
-                if self.get_board(self.current_player).all_sunk():
-                    self.state = "Game Over"
-                    self.game_over = True
-                    self.winner = user
-                    logging.info(f"{user.username} won {self.room_id}")
-
-        return {"success": True}
+                if user.user_id != self.current_player.user_id:
+                    logging.info(f"{user.username} tried to make a move out of turn.")
+                    return {"error": "It is not your turn."}
+
+                if len(self.users) == 2:
+                    self.current_player = self.users[1] if self.current_player == self.users[0] else self.users[0]
+                else:
+                    self.current_player = self.users[0]
+
+                # Check if the move has already been made
+                if self.get_board(self.current_player).board[move["x"]][move["y"]] != 0:
+                    self.current_player = self.users[1] if self.current_player == self.users[0] else self.users[0]
+                    return {"error": "You have already made this move."}
+
+                if self.get_board(self.current_player).is_hit(move["x"], move["y"]):
+                    logging.info(f"{user.username} hit ({move['x']}, {move['y']})")
+                    if self.get_board(self.current_player).all_sunk():
+                        self.state = "Game Over"
+                        self.game_over = True
+                        self.winner = user
+                        logging.info(f"{user.username} won {self.room_id}")
+
+            self.turn_changed.notify_all()
+            return {"success": True}
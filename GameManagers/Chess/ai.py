@@ -3,18 +3,120 @@ Modified from the original code by Dirk Hoekstra (https://github.com/Dirk94/Ches
 """
 
 # from GameAI.ChessAI import board
+import collections
+import os
+import threading
 import time
 
+from GameManagers import ai_pool
+from . import evaluation_cache
 from .ai_logic import AI
+from .bitbase import Bitbase
+from .opening_book import OpeningBook
+from .parallel_search import ParallelRootSearch
 
 import chess
 
+# The attributes of the AI that a search in the worker pool sends back, for the debug output and search statistics
+POOLED_RESULTS = ("total_moves_checked", "best_move_score", "total_optimal_moves", "calculate_time",
+                  "total_legal_moves", "search_depth", "depth_times", "branching_factor", "highest_score_calculated",
+                  "lowest_score_calculated", "rejected_moves", "used_opening_book", "used_bitbase", "cutoffs",
+                  "first_move_cutoffs")
+# How many AIs a pool worker keeps, so rooms that come back to the same worker reuse their tables, and how many
+# transposition table entries they can hold between them. An entry takes about 290 bytes, so about 290MB per worker.
+MAX_WORKER_AIS = 8
+MAX_WORKER_TABLE_ENTRIES = 1000000
+
+# The AIs of a pool worker by room and color. Only used in the worker processes.
+_worker_ais = collections.OrderedDict()  # type: collections.OrderedDict[tuple, AI]
+
+
+def search_pooled_move(key, color, board: chess.Board, invalid_moves, settings):
+    """
+    Searches a move like ChessAI.search_move. Called in a worker process of the AI worker pool.
+    :param key: The room and color the AI plays for, the worker keeps the AI of each for its next move
+    :param color: The color of the AI
+    :param board: The chessboard
+    :param invalid_moves: The moves that are not allowed
+    :param settings: The options of the AI and the search, see ChessAI.get_pool_settings
+    :return: A tuple of (move in uci, the POOLED_RESULTS of the AI, transposition table probes, hits)
+    """
+    ai = _worker_ais.pop(key, None)
+    if ai is None:
+        ai = AI(color, transposition_table_size=settings["table_size"], seed=settings["seed"],
+                opening_book=OpeningBook.get_default() if settings["opening_book"] else None,
+                bitbase=Bitbase.get_default() if settings["bitbase"] else None)
+    _worker_ais[key] = ai
+    # Drop the least recently used AIs, but never the one about to search
+    table_entries = sum(worker_ai.transposition_table.max_entries for worker_ai in _worker_ais.values())
+    while len(_worker_ais) > 1 and (len(_worker_ais) > MAX_WORKER_AIS or table_entries > MAX_WORKER_TABLE_ENTRIES):
+        table_entries -= _worker_ais.popitem(last=False)[1].transposition_table.max_entries
+
+    table = ai.transposition_table
+    table_probes, table_hits = table.probes, table.hits
+    # The search stops at its next deadline check if the room closes
+    ai.stop_event = ai_pool.get_stop_flag()
+    try:
+        move = ai.get_ai_move(board, invalid_moves, depth=settings["depth"], time_limit=settings["time_limit"],
+                              node_limit=settings["node_limit"], margin=settings["margin"])
+        if move is None:
+            move = ai.get_ai_move(board, [], depth=settings["depth"], time_limit=settings["time_limit"],
+                                  node_limit=settings["node_limit"], margin=settings["margin"])
+    finally:
+        ai.stop_event = None
+    results = {name: getattr(ai, name) for name in POOLED_RESULTS}
+    return move.uci(), results, table.probes - table_probes, table.hits - table_hits
+
 
 class ChessAI:
+    # The strength of the AI is set by how deep and how many moves it can search, so weaker AIs are also cheaper to
+    # run. The margin lets weaker AIs choose moves that score a little worse than the best one. The cheaper searches
+    # have a higher priority in the AI worker pool, so they are not held up behind the long ones, and the smaller
+    # searches keep smaller transposition tables.
+    DIFFICULTIES = {
+        "beginner": {"depth": 0, "node_limit": 200, "time_limit": 1, "margin": 150,
+                     "priority": 2, "table_size": 10000},
+        "easy": {"depth": 1, "node_limit": 2000, "time_limit": 2, "margin": 60,
+                 "priority": 1, "table_size": 25000},
+        "medium": {"depth": 2, "node_limit": 30000, "time_limit": 10, "margin": 20,
+                   "priority": 0, "table_size": 100000},
+        "hard": {"depth": 3, "node_limit": 300000, "time_limit": 10, "margin": 0,
+                 "priority": 0, "table_size": 250000},
+        "expert": {"depth": 5, "node_limit": None, "time_limit": 30, "margin": 0,
+                   "priority": -1, "table_size": 500000},
+    }
+    DEFAULT_DIFFICULTY = "medium"
+    MIN_TIME_LIMIT = 0.1  # The shortest time in seconds a move can be given
+    SEARCH_HISTORY_LENGTH = 100  # How many of the AI's last searches are kept for the search statistics
 
-    def __init__(self, room_board, current_room, color: chess.Color):
+    def __init__(self, room_board, current_room, color: chess.Color, difficulty=DEFAULT_DIFFICULTY, time_limit=None,
+                 workers=1, seed=None, opening_book=True, bitbase=True, ponder=False, use_pool=False):
         self.room_board = room_board
-        self.ai = AI(color)
+        level = ChessAI.DIFFICULTIES[difficulty]
+        self.ai = AI(color, transposition_table_size=level["table_size"], seed=seed,
+                     opening_book=OpeningBook.get_default() if opening_book else None,
+                     bitbase=Bitbase.get_default() if bitbase else None)
+        self.seed = seed
+        self.opening_book = opening_book
+        self.bitbase = bitbase
+        self.difficulty = difficulty
+        self.table_size = level["table_size"]
+        self.depth = level["depth"]
+        self.node_limit = level["node_limit"]
+        self.margin = level["margin"]
+        # The maximum time in seconds the AI can spend on a move, at most the difficulty's limit which is used if not
+        # given
+        self.time_limit = min(time_limit, level["time_limit"]) if time_limit is not None else level["time_limit"]
+        # When more than one worker is used the root moves are split across that many processes
+        self.parallel_search = ParallelRootSearch.get(workers) if workers > 1 else None
+        # Otherwise the move can be searched by the server's AI worker pool, with the searches of the other rooms
+        self.use_pool = use_pool and self.parallel_search is None
+        self.priority = level["priority"]  # How soon the pool searches the moves of this AI, set by its difficulty
+        # Pondering searches during the opponent's turn. The worker processes of a parallel search or the pool don't
+        # share the transposition table of this AI, so pondering is only done for in process searches.
+        self.ponder = ponder and self.parallel_search is None and not self.use_pool
+        self.ponder_thread = None  # type: threading.Thread | None
+        self.ponder_stop = threading.Event()
 
         self.username = "ChessAI"
         self.user_id = -1
@@ -23,6 +125,13 @@ class ChessAI:
         self.current_room = current_room
         self.last_ai_moves = []
 
+        # The statistics of the AI's last searches, see get_search_statistics
+        self.search_history = collections.deque(maxlen=ChessAI.SEARCH_HISTORY_LENGTH)
+        self.search_started = None  # The time.monotonic() time the current search started, None if not searching
+        self.moves_searched = 0
+        self.total_search_time = 0
+        self.total_nodes = 0
+
     def encode(self):
         return {
             "username": self.username,
@@ -35,25 +144,207 @@ class ChessAI:
         Returns a string of debug information about the AI's move.
         :return:
         """
+        table = self.ai.transposition_table
+        cache = evaluation_cache.get_evaluation_cache().stats()
         text = [
             f"AI Move Debug",
-            f"Time: {self.ai.calculate_time}",
-            f"MPS:  {self.ai.total_moves_checked / self.ai.calculate_time}",
+            f"Time: {self.ai.calculate_time}{' (Opening Book)' if self.ai.used_opening_book else ''}",
+            f"MPS:  {self.ai.total_moves_checked / self.ai.calculate_time if self.ai.calculate_time else 0}",
             f"Legal Moves:   {self.ai.total_legal_moves} (Rejected: {self.ai.rejected_moves})",
-            f"Search Depth:  {self.ai.search_depth}",
+            f"Difficulty:    {self.difficulty} (Depth: {self.depth}, Node Limit: {self.node_limit}, "
+            f"Margin: {self.margin})",
+            f"Search Depth:  {self.ai.search_depth}{' (Bitbase)' if self.ai.used_bitbase else ''} "
+            f"(Time Limit: {self.time_limit}s, "
+            f"Workers: {self.parallel_search.workers if self.parallel_search else 1})",
             f"Checked Moves: {self.ai.total_moves_checked}",
             f"Optimal Moves: {self.ai.total_optimal_moves}",
             f"Move Score:    {self.ai.best_move_score} (Max: {self.ai.highest_score_calculated} | Min: {self.ai.lowest_score_calculated})",
+            f"TT Entries:    {len(table)} (Hits: {table.hits}/{table.probes})",
+            f"Cutoffs:       {self.ai.cutoffs} (First Move: {self.ai.cutoff_rate:.1%})",
+            f"Eval Cache:    {cache['entries']} (Hits: {cache['hits']}/{cache['hits'] + cache['misses']}, "
+            f"{cache['hit_rate']:.1%})",
         ]
         return "\n".join(text)
 
+    def record_search(self, table_probes, table_hits):
+        """
+        Adds the statistics of the search that just finished to the search history
+        :param table_probes: The transposition table probes before the search started
+        :param table_hits: The transposition table hits before the search started
+        :return:
+        """
+        table = self.ai.transposition_table
+        probes = table.probes - table_probes
+        nodes = self.ai.total_moves_checked
+        depth = self.ai.search_depth
+        search = {
+            "time": self.ai.calculate_time,
+            "nodes": nodes,
+            "nodes_per_second": nodes / self.ai.calculate_time if self.ai.calculate_time else 0,
+            "depth": depth,
+            "time_to_depth": self.ai.depth_times,
+            # The average number of moves searched per position if the tree had been uniform. A depth 0 search still
+            # looks one move ahead, so the tree is depth + 1 moves deep.
+            "effective_branching_factor": nodes ** (1 / (depth + 1)) if nodes else 0,
+            "expected_branching_factor": self.ai.branching_factor or 0,
+            "cutoffs": self.ai.cutoffs,
+            "first_move_cutoff_rate": self.ai.cutoff_rate,
+            "tt_hit_rate": (table.hits - table_hits) / probes if probes else 0,
+            "legal_moves": self.ai.total_legal_moves,
+            "rejected_moves": self.ai.rejected_moves,
+            "score": self.ai.best_move_score,
+            "highest_score": self.ai.highest_score_calculated,
+            "lowest_score": self.ai.lowest_score_calculated,
+            "opening_book": self.ai.used_opening_book,
+            "bitbase": self.ai.used_bitbase,
+            "finished": time.time(),
+        }
+        self.search_history.append(search)
+        self.moves_searched += 1
+        self.total_search_time += search["time"]
+        self.total_nodes += nodes
+
+    @staticmethod
+    def average(searches, statistic):
+        """
+        Returns the average of one statistic over some searches
+        :param searches: A list of searches from the search history
+        :param statistic: The name of the statistic
+        :return:
+        """
+        return sum(search[statistic] for search in searches) / len(searches) if searches else 0
+
+    def get_search_statistics(self):
+        """
+        Returns the statistics of the search in progress, the last searches and every search the AI has made
+        :return: A dictionary that can be sent as JSON
+        """
+        search_started = self.search_started
+        history = list(self.search_history)
+        searched = [search for search in history if not search["opening_book"]]
+        return {
+            "username": self.username,
+            "color": "white" if self.ai.color == chess.WHITE else "black",
+            "difficulty": self.difficulty,
+            "workers": self.parallel_search.workers if self.parallel_search else 1,
+            "live": {
+                "searching": search_started is not None,
+                "elapsed": time.monotonic() - search_started if search_started is not None else 0,
+                # The worker processes of a parallel search only report their nodes once they finish
+                "nodes": self.ai.total_moves_checked if search_started is not None else 0,
+            },
+            "history": history,
+            "recent": {
+                "moves": len(history),
+                "average_time": self.average(history, "time"),
+                # Opening book moves are not searched, so they would pull the search averages down
+                "average_depth": self.average(searched, "depth"),
+                "average_branching_factor": self.average(searched, "effective_branching_factor"),
+                "average_tt_hit_rate": self.average(searched, "tt_hit_rate"),
+            },
+            "total": {
+                "moves": self.moves_searched,
+                "time": self.total_search_time,
+                "nodes": self.total_nodes,
+                "nodes_per_second": self.total_nodes / self.total_search_time if self.total_search_time else 0,
+            },
+        }
+
+    @staticmethod
+    def server_under_load():
+        """
+        Returns True when the server has more work than CPU cores, so optional work like pondering should wait
+        :return:
+        """
+        try:
+            return os.getloadavg()[0] > os.cpu_count()
+        except (AttributeError, OSError):  # Load averages are not available on every platform
+            return False
+
+    def start_pondering(self, board: chess.Board):
+        """
+        Starts searching the position in the background while the opponent thinks about their move
+        :param board: The board, with the opponent to move
+        :return:
+        """
+        if not self.ponder or board.is_game_over():
+            return
+        self.stop_pondering()
+        self.ponder_stop.clear()
+        self.ponder_thread = threading.Thread(target=self.ai.ponder, daemon=True,
+                                              args=(AI.search_board(board), self.ponder_stop, self.depth,
+                                                    self.server_under_load))
+        self.ponder_thread.start()
+
+    def stop_pondering(self):
+        """
+        Cancels the background search and waits for it to finish, so the AI can be used again
+        :return:
+        """
+        if self.ponder_thread is not None:
+            self.ponder_stop.set()
+            self.ponder_thread.join()
+            self.ponder_thread = None
+
     def get_ai_move(self, board: chess.Board) -> str:
-        move = self.ai.get_ai_move(board, self.last_ai_moves)
+        self.stop_pondering()
+        table = self.ai.transposition_table
+        table_probes, table_hits = table.probes, table.hits
+        self.search_started = time.monotonic()
+        try:
+            move = self.search_move(board)
+        finally:
+            self.search_started = None
+        self.record_search(table_probes, table_hits)
+        return move
+
+    def get_pool_settings(self):
+        """
+        Returns the options of the AI and the search, for search_pooled_move
+        :return:
+        """
+        return {
+            "depth": self.depth,
+            "time_limit": self.time_limit,
+            "node_limit": self.node_limit,
+            "margin": self.margin,
+            "table_size": self.table_size,
+            "seed": self.seed,
+            "opening_book": self.opening_book,
+            "bitbase": self.bitbase,
+        }
+
+    def search_pooled_move(self, board: chess.Board) -> str:
+        """
+        Searches the move in the AI worker pool, and copies the statistics of the search back to this AI
+        :param board: The chessboard
+        :return: The move in uci
+        """
+        room_id = self.current_room.room_id
+        # The pool is started by the first search that needs it, in the AI thread rather than a request handler
+        future = ai_pool.AIWorkerPool.get_default().submit(
+            room_id, search_pooled_move, (room_id, self.ai.color), self.ai.color, AI.search_board(board),
+            list(self.last_ai_moves), self.get_pool_settings(), priority=self.priority)
+        move, results, table_probes, table_hits = future.result()
+        for name, value in results.items():
+            setattr(self.ai, name, value)
+        # The worker's table is counted in this AI's table statistics
+        self.ai.transposition_table.probes += table_probes
+        self.ai.transposition_table.hits += table_hits
+        return move
+
+    def search_move(self, board: chess.Board) -> str:
+        if self.use_pool:
+            return self.search_pooled_move(board)
+        move = self.ai.get_ai_move(board, self.last_ai_moves, depth=self.depth, time_limit=self.time_limit,
+                                   node_limit=self.node_limit, margin=self.margin, parallel_search=self.parallel_search)
         # To prevent the AI from just moving the same piece back and forth we will check if the move is the same
         # as the last 2 moves. If it is we will get a new move.
         if move is None:
             # If the AI wasn't able to find a move with the move restriction we will try again without the restriction.
-            move = self.ai.get_ai_move(board, [])
+            move = self.ai.get_ai_move(board, [], depth=self.depth, time_limit=self.time_limit,
+                                       node_limit=self.node_limit, margin=self.margin,
+                                       parallel_search=self.parallel_search)
         # self.last_ai_moves.append(move)
         if len(self.last_ai_moves) > 4:  # Only restrict a repeat of the last 4 moves.
             self.last_ai_moves.pop(0)
@@ -1,9 +1,13 @@
+import math
 import random
 import time
 
 import chess
+import chess.polyglot
 import numpy
 
+from . import evaluation_cache
+
 
 class Heuristics:
     # The tables denote the points scored for the position of the chess pieces on the board.
@@ -72,68 +76,189 @@ class Heuristics:
         chess.KING: 1500
     }
 
+    # Variants where the aim is to lose every piece
+    LOSING_VARIANTS = ("suicide", "giveaway", "antichess")
+
     @staticmethod
-    def evaluate(board, ai_color):
+    def evaluate(board, ai_color, has_moves=None, repetitions=None):
         """
         Evaluates the board
         :param board:
         :param ai_color: The color of the AI
+        :param has_moves: Whether the side to move has a legal move, if the caller already knows
+        :param repetitions: How many times the position has occurred, if the caller keeps track
         :return:
         """
 
-        if board.is_checkmate():
-            if board.turn == ai_color:
-                return -AI.INFINITE
-            else:
-                return AI.INFINITE
+        mate_score, draw_score, check_score = Heuristics.get_terminal_state(board, ai_color, has_moves, repetitions)
+        if mate_score is not None:
+            return mate_score
 
         # Preform check evaluation
 
         material = Heuristics.get_material_score(board, ai_color)
+        if board.uci_variant in Heuristics.LOSING_VARIANTS:
+            material = -material  # The side that loses all its pieces wins
 
-        if board.is_game_over():
+        if draw_score is not None:
             # If the move is not going to result in an AI win, try to avoid it
-            if board.is_stalemate():
-                return 999999 if material < 0 else -999999  # If the AI is losing, try to achieve a stalemate
-            elif board.is_insufficient_material():
-                return 999998 if material < 0 else -999998  # If the AI is losing, try to achieve a draw
-            elif board.is_seventyfive_moves():
-                return 999997 if material < 0 else -999997  # If the AI is losing, try to achieve a draw
-            elif board.is_fivefold_repetition():
-                return 999996 if material < 0 else -999996  # If the AI is losing, try to achieve a draw
-
-        pawns = Heuristics.get_piece_position_score(board, chess.PAWN, Heuristics.PAWN_TABLE)
-        knights = Heuristics.get_piece_position_score(board, chess.KNIGHT, Heuristics.KNIGHT_TABLE)
-        bishops = Heuristics.get_piece_position_score(board, chess.BISHOP, Heuristics.BISHOP_TABLE)
-        rooks = Heuristics.get_piece_position_score(board, chess.ROOK, Heuristics.ROOK_TABLE)
-        queens = Heuristics.get_piece_position_score(board, chess.QUEEN, Heuristics.QUEEN_TABLE)
-
-        if board.is_check():
+            return draw_score if material < 0 else -draw_score  # If the AI is losing, try to achieve a draw
+
+        score = check_score + material + Heuristics.get_position_score(board)
+        if board.uci_variant != "chess":
+            variant_score = Heuristics.get_variant_score(board)
+            score += variant_score if ai_color == chess.WHITE else -variant_score
+        return score
+
+    @staticmethod
+    def get_terminal_state(board, ai_color, has_moves=None, repetitions=None):
+        """
+        Works out the parts of the evaluation that depend on the game being over or a king being in check
+        :param board:
+        :param ai_color: The color of the AI
+        :param has_moves: Whether the side to move has a legal move, if the caller already knows
+        :param repetitions: How many times the position has occurred, if the caller keeps track
+        :return: A tuple of (mate_score, draw_score, check_score). mate_score is the final score if the board is
+         checkmate, otherwise None. draw_score is the magnitude of the score if the game is drawn, otherwise None.
+         check_score is added to the evaluation when a king is in check.
+        """
+        if board.uci_variant != "chess" and board.is_variant_end():
+            # The variant's own way of ending, like a king reaching the hill or exploding
+            if board.is_variant_win():
+                return (AI.INFINITE if board.turn == ai_color else -AI.INFINITE), None, 0
+            if board.is_variant_loss():
+                return (-AI.INFINITE if board.turn == ai_color else AI.INFINITE), None, 0
+            return None, 999999, 0
+        # Otherwise the variants end in the same ways as standard chess, with their own rules for what is legal, a
+        # check and sufficient material
+        return Heuristics.classify_standard(board, ai_color, has_moves, repetitions)
+
+    @staticmethod
+    def classify_standard(board, ai_color, has_moves=None, repetitions=None):
+        """
+        get_terminal_state in a single pass, for positions that have not ended in a variant specific way.
+        Standard chess can only end in the ways checked here, so instead of asking the board whether the game is over
+        in each way, which generates the legal moves and replays the move stack several times over, at most one legal
+        move is generated and the move stack is only replayed if the position could be a fivefold repetition and the
+        caller does not keep track of repetitions.
+        :param board:
+        :param ai_color: The color of the AI
+        :param has_moves: Whether the side to move has a legal move, if the caller already knows
+        :param repetitions: How many times the position has occurred, if the caller keeps track
+        :return: See get_terminal_state
+        """
+        in_check = board.is_check()
+        if has_moves is None:
+            has_moves = any(board.generate_legal_moves())
+        if not has_moves:
+            if not in_check:
+                return None, 999999, 0  # Stalemate
+            return (-AI.INFINITE if board.turn == ai_color else AI.INFINITE), None, 0
+        if board.is_insufficient_material():
+            return None, 999998, 0
+        if board.halfmove_clock >= 150:
+            return None, 999997, 0  # Seventy-five moves
+        if board.halfmove_clock >= AI.CACHEABLE_HALFMOVES:
+            if (repetitions >= 5) if repetitions is not None else board.is_fivefold_repetition():
+                return None, 999996, 0
+
+        if in_check:
             if board.turn == ai_color:  # AI is in check
-                return -9999 + material + pawns + knights + bishops + rooks + queens
+                return None, None, -9999
+            else:
+                return None, None, 99
+        return None, None, 0
+
+    @staticmethod
+    def get_piece_masks(board):
+        """
+        Returns the bitboard of every piece type and color, in the row order used by the batch weights
+        :param board:
+        :return: A tuple of 12 bitboards
+        """
+        white_mask = board.occupied_co[chess.WHITE]
+        black_mask = board.occupied_co[chess.BLACK]
+        return (board.pawns & white_mask, board.pawns & black_mask,
+                board.knights & white_mask, board.knights & black_mask,
+                board.bishops & white_mask, board.bishops & black_mask,
+                board.rooks & white_mask, board.rooks & black_mask,
+                board.queens & white_mask, board.queens & black_mask,
+                board.kings & white_mask, board.kings & black_mask)
+
+    @staticmethod
+    def get_occupancy(piece_masks):
+        """
+        Stacks the piece bitboards of several positions into a single occupancy array
+        :param piece_masks: A list of tuples returned by get_piece_masks
+        :return: A (N, 12, 64) numpy array of zeros and ones
+        """
+        masks = numpy.array(piece_masks, dtype="<u8")
+        return numpy.unpackbits(masks.view(numpy.uint8).reshape(len(piece_masks), 12, 8),
+                                axis=2, bitorder="little")
+
+    @staticmethod
+    def score_batch(occupancy, terminal_states, ai_color):
+        """
+        Scores a batch of standard chess positions at once with dot products against the piece tables
+        :param occupancy: A (N, 12, 64) array returned by get_occupancy
+        :param terminal_states: A list of N tuples returned by get_terminal_state
+        :param ai_color: The color of the AI
+        :return: A list of N scores, the same as evaluate would return for each position. The variant terms are not
+         included, so variant positions have to be evaluated one at a time.
+        """
+        material = numpy.einsum("nps,p->n", occupancy, Heuristics.MATERIAL_WEIGHTS)
+        if ai_color == chess.BLACK:
+            material = -material
+        position = numpy.einsum("nps,ps->n", occupancy, Heuristics.POSITION_WEIGHTS)
+
+        scores = []
+        for index, (mate_score, draw_score, check_score) in enumerate(terminal_states):
+            if mate_score is not None:
+                scores.append(mate_score)
+            elif draw_score is not None:
+                scores.append(draw_score if material[index] < 0 else -draw_score)
             else:
-                return 99 + material + pawns + knights + bishops + rooks + queens
+                scores.append(check_score + int(material[index]) + int(position[index]))
+        return scores
 
-        return material + pawns + knights + bishops + rooks + queens
+    @staticmethod
+    def get_square_scores(table):
+        """
+        Flattens a piece table into per square scores so they can be looked up directly with the squares from a
+        bitboard.
+        :param table: The 2d numpy array used for the scoring. Example: Heuristics.PAWN_TABLE
+        :return: A tuple of (white_scores, black_scores), each a list of 64 scores indexed by square
+        """
+        white = [0] * 64
+        black = [0] * 64
+        for square in chess.SQUARES:
+            file, rank = chess.square_file(square), chess.square_rank(square)
+            white[square] = int(table[file][rank])
+            black[square] = int(table[7 - file][rank])
+        return white, black
 
-    # Returns the score for the position of the given type of piece.
-    # A piece type can for example be: pieces.Pawn.PIECE_TYPE.
-    # The table is the 2d numpy array used for the scoring. Example: Heuristics.PAWN_TABLE
     @staticmethod
-    def get_piece_position_score(chess_board: chess.Board, piece_type, table):
-        white = 0
-        black = 0
-        for x in range(8):
-            for y in range(8):
-                piece = chess_board.piece_at(chess.square(x, y))
-                if piece:
-                    if piece.piece_type == piece_type:
-                        if piece.color == chess.WHITE:
-                            white += table[x][y]
-                        else:
-                            black += table[7 - x][y]
-
-        return white - black
+    def get_position_score(chess_board: chess.Board):
+        """
+        Returns the combined score for the position of every piece type that has a table.
+        The score is always from the perspective of white.
+        :param chess_board:
+        :return:
+        """
+        white_mask = chess_board.occupied_co[chess.WHITE]
+        black_mask = chess_board.occupied_co[chess.BLACK]
+        score = 0
+        for piece_mask, (white_scores, black_scores) in (
+                (chess_board.pawns, Heuristics.SQUARE_SCORES[chess.PAWN]),
+                (chess_board.knights, Heuristics.SQUARE_SCORES[chess.KNIGHT]),
+                (chess_board.bishops, Heuristics.SQUARE_SCORES[chess.BISHOP]),
+                (chess_board.rooks, Heuristics.SQUARE_SCORES[chess.ROOK]),
+                (chess_board.queens, Heuristics.SQUARE_SCORES[chess.QUEEN])):
+            for square in chess.scan_forward(piece_mask & white_mask):
+                score += white_scores[square]
+            for square in chess.scan_forward(piece_mask & black_mask):
+                score -= black_scores[square]
+        return score
 
     @staticmethod
     def get_material_score(chess_board: chess.Board, ai_color):
@@ -143,26 +268,199 @@ class Heuristics:
         :param ai_color: The color of the AI, used to determine which pieces are positive and negative.
         :return:
         """
-        white = 0
-        black = 0
-        for x in range(8):
-            for y in range(8):
-                piece = chess_board.piece_at(chess.square(x, y))
-                if piece:
-                    if piece.color == chess.WHITE:
-                        white += Heuristics.piece_values[piece.piece_type]
-                    else:
-                        black += Heuristics.piece_values[piece.piece_type]
+        white_mask = chess_board.occupied_co[chess.WHITE]
+        black_mask = chess_board.occupied_co[chess.BLACK]
+        score = 0
+        for piece_mask, value in ((chess_board.pawns, Heuristics.piece_values[chess.PAWN]),
+                                  (chess_board.knights, Heuristics.piece_values[chess.KNIGHT]),
+                                  (chess_board.bishops, Heuristics.piece_values[chess.BISHOP]),
+                                  (chess_board.rooks, Heuristics.piece_values[chess.ROOK]),
+                                  (chess_board.queens, Heuristics.piece_values[chess.QUEEN]),
+                                  (chess_board.kings, Heuristics.piece_values[chess.KING])):
+            score += value * (chess.popcount(piece_mask & white_mask) - chess.popcount(piece_mask & black_mask))
         if ai_color == chess.WHITE:
-            return white - black
+            return score
         else:
-            return black - white
+            return -score
+
+    @staticmethod
+    def get_mop_up_score(chess_board: chess.Board, strong_color):
+        """
+        Returns the score for making progress in a won endgame, so the search does not just keep the position won.
+        The stronger king is brought closer to the lone king, and either the pawn is pushed or the lone king is driven
+        to the edge of the board where it can be checkmated.
+        :param chess_board:
+        :param strong_color: The color of the side that is winning
+        :return: A score that is higher the closer the stronger side is to winning
+        """
+        strong_king = chess_board.king(strong_color)
+        weak_king = chess_board.king(not strong_color)
+        score = 10 * (14 - chess.square_manhattan_distance(strong_king, weak_king))
+        pawns = chess_board.pawns & chess_board.occupied_co[strong_color]
+        if pawns:
+            rank = chess.square_rank(chess.lsb(pawns))
+            return score + 50 * (rank if strong_color == chess.WHITE else 7 - rank)
+        return score + 20 * Heuristics.get_centre_distance(weak_king)
+
+    @staticmethod
+    def get_centre_distance(square):
+        """
+        Returns how many files and ranks a square is from the four centre squares
+        :param square:
+        :return: 0 for the centre squares, up to 6 for the corners
+        """
+        file, rank = chess.square_file(square), chess.square_rank(square)
+        return max(3 - file, file - 4) + max(3 - rank, rank - 4)
+
+    @staticmethod
+    def get_variant_score(chess_board: chess.Board):
+        """
+        Returns the score for the parts of a variant's rules that the material and piece tables do not see.
+        The score is always from the perspective of white.
+        :param chess_board:
+        :return:
+        """
+        match chess_board.uci_variant:
+            case "kingofthehill":
+                # A king that reaches the centre wins
+                return 40 * (Heuristics.get_centre_distance(chess_board.king(chess.BLACK)) -
+                             Heuristics.get_centre_distance(chess_board.king(chess.WHITE)))
+            case "3check":
+                # Giving the third check wins
+                return 250 * (chess_board.remaining_checks[chess.BLACK] - chess_board.remaining_checks[chess.WHITE])
+            case "racingkings":
+                # A king that reaches the last rank wins
+                return 100 * (chess.square_rank(chess_board.king(chess.WHITE)) -
+                              chess.square_rank(chess_board.king(chess.BLACK)))
+            case "crazyhouse":
+                # Captured pieces can be dropped back onto the board, so they still count as material
+                return sum(value * (chess_board.pockets[chess.WHITE].count(piece_type) -
+                                    chess_board.pockets[chess.BLACK].count(piece_type))
+                           for piece_type, value in Heuristics.piece_values.items() if piece_type != chess.KING)
+        return 0
+
+
+# The square lookups are built once from the tables above
+Heuristics.SQUARE_SCORES = {
+    chess.PAWN: Heuristics.get_square_scores(Heuristics.PAWN_TABLE),
+    chess.KNIGHT: Heuristics.get_square_scores(Heuristics.KNIGHT_TABLE),
+    chess.BISHOP: Heuristics.get_square_scores(Heuristics.BISHOP_TABLE),
+    chess.ROOK: Heuristics.get_square_scores(Heuristics.ROOK_TABLE),
+    chess.QUEEN: Heuristics.get_square_scores(Heuristics.QUEEN_TABLE),
+}
+
+# The same tables arranged as weights for the batch evaluation, in the row order of get_piece_masks.
+# Black rows are negative because the scores are from the perspective of white.
+Heuristics.POSITION_WEIGHTS = numpy.array([
+    scores for piece_type in chess.PIECE_TYPES
+    for scores in (
+        (Heuristics.SQUARE_SCORES[piece_type][0], [-score for score in Heuristics.SQUARE_SCORES[piece_type][1]])
+        if piece_type in Heuristics.SQUARE_SCORES else ([0] * 64, [0] * 64))
+], dtype=numpy.int64)
+Heuristics.MATERIAL_WEIGHTS = numpy.array([
+    value for piece_type in chess.PIECE_TYPES
+    for value in (Heuristics.piece_values[piece_type], -Heuristics.piece_values[piece_type])
+], dtype=numpy.int64)
+
+
+class SearchTimeout(Exception):
+    """
+    Raised inside the search when the deadline for the current move has passed
+    """
+    pass
+
+
+class TranspositionTable:
+    """
+    A bounded table of previously searched positions, keyed by the zobrist hash of the position.
+    Each entry stores the depth that the position was searched to, what kind of bound the score is,
+    the score and the best move that was found.
+    """
+
+    EXACT = 0
+    LOWER_BOUND = 1  # The real score is at least the stored score (the search failed high)
+    UPPER_BOUND = 2  # The real score is at most the stored score (the search failed low)
+
+    def __init__(self, max_entries=500000):
+        self.max_entries = max_entries
+        self.entries = {}  # type: dict[int, tuple[int, int, int, chess.Move | None]]
+        self.probes = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def probe(self, key):
+        """
+        Looks up a position in the table
+        :param key: The zobrist hash of the position
+        :return: A tuple of (depth, bound, score, best_move) or None if the position is not in the table
+        """
+        self.probes += 1
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+        return entry
+
+    def store(self, key, depth, bound, score, best_move):
+        """
+        Stores the result of a search in the table
+        :param key: The zobrist hash of the position
+        :param depth: The depth the position was searched to
+        :param bound: One of EXACT, LOWER_BOUND or UPPER_BOUND
+        :param score: The score of the position
+        :param best_move: The best move found in the position, or None
+        :return:
+        """
+        existing = self.entries.get(key)
+        if existing is not None:
+            if existing[0] > depth:  # Keep the result of the deeper search
+                return
+        elif len(self.entries) >= self.max_entries:
+            # The table is full, so evict the oldest entry
+            del self.entries[next(iter(self.entries))]
+        self.entries[key] = (depth, bound, score, best_move)
+
+    def clear(self):
+        self.entries.clear()
+        self.probes = 0
+        self.hits = 0
 
 
 class AI:
     INFINITE = 10000000
+    KILLER_MOVES = 2  # The number of killer moves remembered for each ply
+    BUSY_CHECK_INTERVAL = 256  # How many nodes a pondering search goes between checks of the server load
+    BUSY_WAIT = 0.5  # How long in seconds a pondering search waits before checking the server load again
+    # Fivefold repetition needs this many reversible moves, so with fewer the evaluation of a position does not depend
+    # on the moves that led to it and can be cached
+    CACHEABLE_HALFMOVES = 16
+    ASPIRATION_WINDOW = 50  # How far from the last iteration's score the root search first looks, half a pawn
+    NULL_MOVE_REDUCTION = 2  # How much shallower the search after a null move is
+    LATE_MOVE_INDEX = 3  # Moves ordered after this many are searched shallower first
+    LATE_MOVE_DEPTH = 3  # Late moves are only reduced with at least this much depth remaining
+    BITBASE_WIN = 500000  # The score of a won bitbase position, below checkmate but above any normal evaluation
+    MIN_DRAW_SCORE = 999996  # Draws by the rules are scored at least this far from 0, see Heuristics.get_terminal_state
+    MAX_DISPLAY_SCORE = 10000  # Scores shown to players are capped to this, so a checkmate is 100 pawns
+    # The share of the time limit the search depth is chosen to fill, the rest covers a wrong estimate
+    TARGET_TIME_FRACTION = 0.5
+    # How many moves per second each variant is searched at until it has been measured. Drops, explosions and the
+    # extra rules make some variants much slower to generate moves for than standard chess.
+    NODE_RATES = {"chess": 15000, "crazyhouse": 8000, "atomic": 5000, "suicide": 10000, "giveaway": 10000,
+                  "antichess": 10000, "horde": 16000, "racingkings": 10000, "kingofthehill": 15000, "3check": 12000}
+    BRANCHING_EXPONENT = 0.65  # The effective branching factor is about the number of legal moves to this power
+    COST_WEIGHT = 0.2  # How much each search moves the measured costs of its variant towards its own
+    # The measured [moves per second, branching exponent] of each variant, shared by every AI in the process
+    variant_costs = {}  # type: dict[str, list[float]]
+    # The polyglot zobrist values of each piece indexed by [color][piece_type - 1][square], and of the side to move
+    ZOBRIST_PIECES = [[chess.polyglot.POLYGLOT_RANDOM_ARRAY[64 * ((piece_type - 1) * 2 + color):][:64]
+                       for piece_type in chess.PIECE_TYPES] for color in (chess.BLACK, chess.WHITE)]
+    ZOBRIST_WHITE_TO_MOVE = chess.polyglot.POLYGLOT_RANDOM_ARRAY[780]
+    ZOBRIST_HASHER = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
 
-    def __init__(self, color):
+    def __init__(self, color, transposition_table_size=500000, batch_leaves=False, seed=None, opening_book=None,
+                 principal_variation_search=True, aspiration_windows=True, null_move_pruning=True,
+                 late_move_reductions=True, bitbase=None):
         # These values are used to display debug information about the last move calculated.
         self.total_moves_checked = 0
         self.best_move_score = 0
@@ -170,62 +468,592 @@ class AI:
         self.calculate_time = 0
         self.total_legal_moves = 0
         self.search_depth = 0
+        self.search_start = 0  # The time.perf_counter() time the current search started at
+        self.depth_times = []  # type: list[float] # How many seconds into the search each depth finished
+        # The expected ratio of the moves checked by one depth to the last, see get_search_depth
+        self.branching_factor = None
         self.color = color
         self.highest_score_calculated = -AI.INFINITE
         self.lowest_score_calculated = AI.INFINITE
         self.rejected_moves = 0
+        self.deadline = None  # The time.monotonic() time the current search has to finish by
+        self.node_limit = None  # The number of moves the current search can check before it has to finish
+        self.margin = 0  # How much worse than the best move a move can score and still be chosen
+        # While pondering, the event that cancels the search and a function that returns True when the server is busy
+        self.stop_event = None  # type: threading.Event | None
+        self.is_busy = None
+        self.stop_checks = 0
+        self.ponder_move = None  # The opponent's reply that the last ponder expected
+        # Move ordering state, reset for every search
+        self.root_ply = 0
+        self.killer_moves = {}  # type: dict[int, list[chess.Move]]
+        self.history = {}  # type: dict[tuple[int, int], int]
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        # The position key of the root of the search and of every move made since, and how many times each key occurs
+        # in the game and the search. Keys are only updated move by move in standard chess, and are None otherwise.
+        self.keys = []  # type: list[int | None]
+        self.repetitions = {}  # type: dict[int, int]
+        # The transposition table is kept between moves so that later searches can reuse earlier results.
+        self.transposition_table = TranspositionTable(transposition_table_size)
+        # When enabled the last ply of the search is scored as a single numpy batch instead of one node at a time.
+        self.batch_leaves = batch_leaves
+        # The random choices of the AI are repeatable when a seed is given
+        self.seed = seed
+        self.random = random.Random(seed) if seed is not None else random
+        # An OpeningBook that is checked before searching, and whether the last move came from it
+        self.opening_book = opening_book
+        self.used_opening_book = False
+        # A Bitbase of endgames that are looked up instead of searched, and whether the last search started in one
+        self.bitbase = bitbase
+        self.used_bitbase = False
+        # The search techniques that can be turned off to measure what each one saves, see benchmark.py
+        self.principal_variation_search = principal_variation_search
+        self.aspiration_windows = aspiration_windows
+        self.null_move_pruning = null_move_pruning
+        self.late_move_reductions = late_move_reductions
+
+    @property
+    def search_options(self):
+        """
+        The search techniques that are enabled, as keyword arguments for AI
+        """
+        return {"principal_variation_search": self.principal_variation_search,
+                "aspiration_windows": self.aspiration_windows,
+                "null_move_pruning": self.null_move_pruning,
+                "late_move_reductions": self.late_move_reductions}
+
+    @staticmethod
+    def position_key(chessboard: chess.Board):
+        """
+        Returns the key used to identify a position in the transposition table
+        :param chessboard: The chessboard
+        :return: The zobrist hash of the position, extended with any variant specific state
+        """
+        # This is the same hash as chess.polyglot.zobrist_hash, but walks the piece bitboards instead of looking up
+        # the piece on every occupied square
+        key = 0
+        for color in chess.COLORS:
+            color_mask = chessboard.occupied_co[color]
+            for piece_mask, table in zip((chessboard.pawns, chessboard.knights, chessboard.bishops,
+                                          chessboard.rooks, chessboard.queens, chessboard.kings),
+                                         AI.ZOBRIST_PIECES[color]):
+                for square in chess.scan_forward(piece_mask & color_mask):
+                    key ^= table[square]
+        if chessboard.castling_rights:
+            key ^= AI.ZOBRIST_HASHER.hash_castling(chessboard)
+        if chessboard.ep_square is not None:
+            key ^= AI.ZOBRIST_HASHER.hash_ep_square(chessboard)
+        if chessboard.turn == chess.WHITE:
+            key ^= AI.ZOBRIST_WHITE_TO_MOVE
+        # The polyglot hash only covers the standard chess state, so mix in the state that some variants add.
+        if chessboard.uci_variant == "crazyhouse":
+            key = hash((key,) + tuple(chessboard.pockets[color].count(piece_type)
+                                      for color in chess.COLORS for piece_type in chess.PIECE_TYPES))
+        elif chessboard.uci_variant == "3check":
+            key = hash((key,) + tuple(chessboard.remaining_checks))
+        return key & 0xFFFFFFFFFFFFFFFF
+
+    @staticmethod
+    def incremental_keys(chessboard: chess.Board):
+        """
+        Returns whether position keys can be updated move by move on this board, rather than hashed from scratch
+        """
+        return chessboard.uci_variant == "chess" and not chessboard.chess960
+
+    def make_move(self, chessboard: chess.Board, move):
+        """
+        Pushes a move during the search, keeping the position keys and repetition counts up to date.
+        In standard chess the new key is worked out from the old one and the pieces the move changes.
+        :param chessboard: The chessboard
+        :param move: The move, or a null move
+        :return:
+        """
+        key = self.keys[-1]
+        if key is None:
+            chessboard.push(move)
+            self.keys.append(None)
+            return
+
+        table = AI.ZOBRIST_PIECES
+        hasher = AI.ZOBRIST_HASHER
+        key ^= AI.ZOBRIST_WHITE_TO_MOVE
+        if chessboard.castling_rights:
+            key ^= hasher.hash_castling(chessboard)
+        if chessboard.ep_square is not None:
+            key ^= hasher.hash_ep_square(chessboard)
+        if move:
+            color = chessboard.turn
+            from_square, to_square = move.from_square, move.to_square
+            piece_type = chessboard.piece_type_at(from_square)
+            key ^= table[color][piece_type - 1][from_square] ^ \
+                table[color][(move.promotion or piece_type) - 1][to_square]
+            captured = chessboard.piece_type_at(to_square)
+            if captured:
+                key ^= table[not color][captured - 1][to_square]
+            elif piece_type == chess.PAWN and to_square == chessboard.ep_square:
+                key ^= table[not color][chess.PAWN - 1][to_square - 8 if color == chess.WHITE else to_square + 8]
+            elif piece_type == chess.KING and abs(to_square - from_square) == 2:
+                # Castling, the rook jumps from its corner to the other side of the king
+                rook_from, rook_to = (from_square + 3, from_square + 1) if to_square > from_square \
+                    else (from_square - 4, from_square - 1)
+                key ^= table[color][chess.ROOK - 1][rook_from] ^ table[color][chess.ROOK - 1][rook_to]
+
+        chessboard.push(move)
+        if chessboard.castling_rights:
+            key ^= hasher.hash_castling(chessboard)
+        if chessboard.ep_square is not None:
+            key ^= hasher.hash_ep_square(chessboard)
+        self.keys.append(key)
+        self.repetitions[key] = self.repetitions.get(key, 0) + 1
+
+    def unmake_move(self, chessboard: chess.Board):
+        """
+        Pops the last move made with make_move
+        :param chessboard: The chessboard
+        :return:
+        """
+        key = self.keys.pop()
+        if key is not None:
+            count = self.repetitions[key] - 1
+            if count:
+                self.repetitions[key] = count
+            else:
+                del self.repetitions[key]
+        chessboard.pop()
+
+    def current_key(self, chessboard: chess.Board):
+        """
+        Returns the position key of the board during a search
+        :param chessboard: The chessboard
+        :return:
+        """
+        key = self.keys[-1] if self.keys else None
+        return key if key is not None else AI.position_key(chessboard)
+
+    def current_repetitions(self):
+        """
+        Returns how many times the current position of the search has occurred, or None if that is not tracked
+        """
+        key = self.keys[-1] if self.keys else None
+        return self.repetitions[key] if key is not None else None
+
+    @staticmethod
+    def search_board(chessboard: chess.Board):
+        """
+        Returns a copy of the board for a search to make and unmake its moves on.
+        Only the moves since the last capture or pawn move are kept, as those are the only ones repetition detection
+        looks at, so the copy does not grow with the length of the game.
+        :param chessboard: The chessboard
+        :return:
+        """
+        return chessboard.copy(stack=chessboard.halfmove_clock)
+
+    @staticmethod
+    def get_display_score(score, color):
+        """
+        Converts a search score into one that can be shown to players or compared between positions
+        :param score: The score, from the point of view of the AI that searched
+        :param color: The color of the AI that searched
+        :return: The score from white's point of view, capped to MAX_DISPLAY_SCORE, with draws scored 0 instead of
+         the large scores the search uses to steer towards or away from them
+        """
+        if AI.MIN_DRAW_SCORE <= abs(score) < AI.INFINITE:
+            return 0
+        score = max(-AI.MAX_DISPLAY_SCORE, min(AI.MAX_DISPLAY_SCORE, score))
+        return score if color == chess.WHITE else -score
+
+    def get_principal_variation(self, chessboard: chess.Board, move, length=8):
+        """
+        Returns the line the last search expects, by following the best moves stored in the transposition table
+        :param chessboard: The chessboard the search was from
+        :param move: The move the search chose
+        :param length: The most moves to return
+        :return: A list of moves, which stops early when the table has no move for a position
+        """
+        board = chessboard.copy(stack=False)
+        line = []
+        while move is not None and len(line) < length and board.is_legal(move):
+            line.append(move)
+            board.push(move)
+            entry = self.transposition_table.probe(AI.position_key(board))
+            move = entry[3] if entry is not None else None
+        return line
 
     def get_ai_move(self, chessboard: chess.Board, invalid_moves, depth=2,
-                    time_limit=120, skill=0.9):
+                    time_limit=120, node_limit=None, margin=0, parallel_search=None):
         """
         Returns the best move for the AI.
+        The search is iteratively deepened, so when the time limit is reached the best move of the deepest
+        finished iteration is returned.
         :param chessboard:  The chessboard
         :param invalid_moves: The moves that are not allowed, used to prevent the AI from repeating the same move.
         :param depth: The maximum depth to search.
-        :param time_limit: The maximum time to search.
-        :param skill: The skill of the AI. 1 is the full skill, 0 is zero skill.
-        :return:
+        :param time_limit: The maximum time to search, in seconds.
+        :param node_limit: The maximum number of moves to check, or None for no limit.
+        :param margin: Any move that scores within this much of the best move can be chosen. Weaker AIs use a
+         larger margin, which costs nothing extra to search.
+        :param parallel_search: A ParallelRootSearch to split the root moves across worker processes with,
+         or None to search in this thread.
+        :return: The move, or None if there are no moves that are allowed
         """
-        best_move = []
-        best_score = -AI.INFINITE
         start_time = time.time()
+        # The search makes and unmakes its moves on its own board, so the caller's board never changes
+        chessboard = AI.search_board(chessboard)
+        self.start_search(chessboard, time.monotonic() + time_limit, node_limit, margin)
+
+        # Known openings don't need to be searched
+        book_move = None
+        if self.opening_book is not None:
+            book_move = self.opening_book.get_move(chessboard, self.random, exclude_moves=invalid_moves)
+        self.used_opening_book = book_move is not None
+        if book_move is not None:
+            self.deadline = None
+            self.node_limit = None
+            self.total_legal_moves = chessboard.legal_moves.count()
+            self.rejected_moves = 0
+            self.total_optimal_moves = 1
+            self.best_move_score = 0
+            self.calculate_time = time.time() - start_time
+            return book_move
+
+        self.total_legal_moves = chessboard.legal_moves.count()
+        depth = self.get_search_depth(chessboard, depth, time_limit, node_limit)
+        entry = self.transposition_table.probe(AI.position_key(chessboard))
+        root_moves = [move for move in self.order_moves(chessboard, entry[3] if entry is not None else None, 0)
+                      if move not in invalid_moves]
+        if self.used_bitbase:
+            root_moves = self.filter_bitbase_moves(chessboard, root_moves)
+        self.rejected_moves = self.total_legal_moves - len(root_moves)
+
+        try:
+            if parallel_search is not None:
+                scores = parallel_search.search(self, chessboard, root_moves, depth)
+            else:
+                iterations, partial = self.iterative_search(chessboard, root_moves, depth)
+                self.search_depth = max(len(iterations) - 1, 0)
+                self.update_variant_cost(chessboard.uci_variant, len(iterations) == depth + 1)
+                # If not even the first iteration finished, use the moves that were scored before the deadline
+                scores = iterations[-1] if iterations else partial
+        finally:
+            self.deadline = None
+            self.node_limit = None
+
+        best_score = max(scores.values(), default=-AI.INFINITE)
+        # Iterating over root_moves rather than the scores keeps the choice independent of the order they finished in
+        best_move = [move for move in root_moves if scores.get(move, -AI.INFINITE - 1) >= best_score - margin]
+        if not best_move and root_moves:
+            # The deadline passed before any move was scored, so any of the allowed moves will have to do
+            best_move = root_moves
+        self.total_optimal_moves = len(best_move)
+        self.best_move_score = best_score
+        self.calculate_time = time.time() - start_time
+        if not best_move:
+            return None
+        return self.random.choice(best_move)
+
+    def get_search_depth(self, chessboard: chess.Board, depth, time_limit=None, node_limit=None):
+        """
+        Returns the depth to search a position to.
+        With a time or node limit the depth is capped to the deepest search expected to finish within it, from the
+        branching factor of the position and how fast its variant is searched. A crazyhouse position with piece drops
+        has several times the moves of a standard one, so it is searched shallower instead of running to the limit.
+        :param chessboard: The chessboard
+        :param depth: The normal search depth
+        :param time_limit: The time in seconds the search can take, or None for no limit
+        :param node_limit: The number of moves the search can check, or None for no limit
+        :return:
+        """
+        legal_moves = chessboard.legal_moves.count()
+        # If the total number of legal moves is less than 10, then increase the depth by 2.
+        # Bitbase endgames already know their result, so they don't need the extra depth.
+        if legal_moves < 10 and not self.in_bitbase(chessboard):
+            depth += 2
+
+        nodes_per_second, exponent = AI.get_variant_cost(chessboard.uci_variant)
+        self.branching_factor = max(legal_moves, 2) ** exponent
+        budget = math.inf
+        if time_limit is not None:
+            budget = nodes_per_second * time_limit * AI.TARGET_TIME_FRACTION
+        if node_limit is not None:
+            budget = min(budget, node_limit)
+        if budget < math.inf:
+            # A search to depth d checks about branching_factor ** (d + 1) moves
+            affordable = int(math.log(max(budget, 1)) / math.log(self.branching_factor)) - 1
+            depth = min(depth, max(affordable, 1))
+        return depth
+
+    @staticmethod
+    def get_variant_cost(variant):
+        """
+        Returns how fast a variant is searched
+        :param variant: The uci name of the variant
+        :return: A tuple of (moves checked per second, branching exponent)
+        """
+        cost = AI.variant_costs.get(variant)
+        if cost is not None:
+            return cost[0], cost[1]
+        return AI.NODE_RATES.get(variant, AI.NODE_RATES["chess"]), AI.BRANCHING_EXPONENT
+
+    def update_variant_cost(self, variant, finished):
+        """
+        Moves the measured cost of a variant towards that of the search that just finished
+        :param variant: The uci name of the variant
+        :param finished: Whether every depth of the search finished, only then is the branching factor measured
+        :return:
+        """
+        elapsed = time.perf_counter() - self.search_start
+        if self.search_depth < 1 or elapsed < 0.05:
+            return  # Too short to measure
+        nodes_per_second, exponent = AI.get_variant_cost(variant)
+        nodes_per_second += AI.COST_WEIGHT * (self.total_moves_checked / elapsed - nodes_per_second)
+        if finished and self.total_legal_moves > 1:
+            branching_factor = self.total_moves_checked ** (1 / (self.search_depth + 1))
+            exponent += AI.COST_WEIGHT * (math.log(branching_factor) / math.log(self.total_legal_moves) - exponent)
+        AI.variant_costs[variant] = [nodes_per_second, exponent]
+
+    def in_bitbase(self, chessboard: chess.Board):
+        """
+        Returns whether a position is one of the bitbase endgames
+        :param chessboard: The chessboard
+        :return:
+        """
+        return self.bitbase is not None and chess.popcount(chessboard.occupied) == 3 and \
+            self.bitbase.probe(chessboard) is not None
+
+    def get_bitbase_score(self, chessboard: chess.Board):
+        """
+        Returns the score of a bitbase position that is not checkmate or a draw by the rules
+        :param chessboard: The chessboard
+        :return: The score, or None if the position is not in the bitbase
+        """
+        if self.bitbase is None or chess.popcount(chessboard.occupied) != 3:
+            return None
+        wins = self.bitbase.probe(chessboard)
+        if not wins:
+            return None if wins is None else 0
+        strong_color = chessboard.color_at(chess.msb(chessboard.occupied & ~chessboard.kings))
+        score = AI.BITBASE_WIN + Heuristics.get_mop_up_score(chessboard, strong_color)
+        return score if strong_color == self.color else -score
+
+    def get_bitbase_outcome(self, chessboard: chess.Board):
+        """
+        Returns the result of a position the bitbase covers, for the AI
+        :param chessboard: The chessboard
+        :return: 1 if the AI wins, 0 if it is a draw, -1 if the AI loses, or None if the result is not known
+        """
+        mate_score, draw_score, _ = Heuristics.get_terminal_state(chessboard, self.color,
+                                                                  repetitions=self.current_repetitions())
+        if mate_score is not None:
+            return 1 if mate_score > 0 else -1
+        if draw_score is not None:
+            return 0
+        score = self.get_bitbase_score(chessboard)
+        if score is None:
+            return None
+        return (score > 0) - (score < 0)
+
+    def filter_bitbase_moves(self, chessboard: chess.Board, root_moves):
+        """
+        Keeps only the root moves that reach the best result the bitbase knows of, so the search only has to choose
+        between moves that keep a won endgame won, or a drawn one drawn
+        :param chessboard: The chessboard, a position in the bitbase
+        :param root_moves: The root moves
+        :return: The moves to search
+        """
+        outcomes = {}
+        for move in root_moves:
+            self.make_move(chessboard, move)
+            try:
+                outcomes[move] = self.get_bitbase_outcome(chessboard)
+            finally:
+                self.unmake_move(chessboard)
+        if None in outcomes.values():
+            return root_moves
+        best = max(outcomes.values(), default=0)
+        return [move for move in root_moves if outcomes[move] == best]
+
+    def start_search(self, chessboard: chess.Board, deadline, node_limit=None, margin=0):
+        """
+        Resets the statistics and move ordering state for a new search
+        :param chessboard: The chessboard at the root of the search
+        :param deadline: The time.monotonic() time the search has to finish by
+        :param node_limit: The number of moves the search can check before it has to finish, or None for no limit
+        :param margin: How much worse than the best move a root move can score and still need an exact score
+        :return:
+        """
+        self.deadline = deadline
+        self.node_limit = node_limit
+        self.margin = margin
         self.total_moves_checked = 0
         self.highest_score_calculated = -AI.INFINITE
         self.lowest_score_calculated = AI.INFINITE
+        self.search_depth = 0
+        self.search_start = time.perf_counter()
+        self.depth_times = []
+        self.root_ply = len(chessboard.move_stack)
+        self.killer_moves = {}
+        self.history = {}
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.start_repetitions(chessboard)
+        self.used_bitbase = self.in_bitbase(chessboard)
 
-        # If the total number of legal moves is less than 10, then increase the depth by 1.
-        if chessboard.legal_moves.count() < 10:
-            depth += 2
-        self.search_depth = depth
-        self.total_legal_moves = chessboard.legal_moves.count()
-        self.rejected_moves = 0
-        for move in chessboard.legal_moves:
-            if move in invalid_moves:
-                continue
-
-            copy = chessboard.copy()
-            copy.push(move)
+    def start_repetitions(self, chessboard: chess.Board):
+        """
+        Counts the positions of the game that the search could repeat, those since the last capture or pawn move
+        :param chessboard: The chessboard at the root of the search
+        :return:
+        """
+        if not AI.incremental_keys(chessboard):
+            self.keys = [None]
+            self.repetitions = {}
+            return
+        history = chessboard.copy(stack=chessboard.halfmove_clock)
+        self.repetitions = {}
+        for _ in range(len(history.move_stack) + 1):
+            key = AI.position_key(history)
+            self.repetitions[key] = self.repetitions.get(key, 0) + 1
+            if history.move_stack:
+                history.pop()
+        self.keys = [AI.position_key(chessboard)]
 
-            if time.time() - start_time > time_limit:
-                break
+    def iterative_search(self, chessboard: chess.Board, root_moves, depth):
+        """
+        Searches the root moves to depth 0, 1, ... up to the given depth, until the deadline passes
+        :param chessboard: The chessboard
+        :param root_moves: The moves to search, in the order to search the first iteration in
+        :param depth: The maximum depth to search
+        :return: A tuple of (iterations, partial). iterations is a list with the scores of the root moves for each
+         finished depth. partial holds the scores of the iteration that was interrupted by the deadline, if any.
+        """
+        root_moves = list(root_moves)
+        iterations = []
+        scores = {}
+        try:
+            for current_depth in range(depth + 1):
+                scores = {}
+                expected = max(iterations[-1].values(), default=None) if iterations else None
+                self.search_root(chessboard, root_moves, current_depth, scores, expected)
+                iterations.append(scores)
+                self.depth_times.append(time.perf_counter() - self.search_start)
+                # Search the best moves of this iteration first in the next one
+                root_moves.sort(key=scores.get, reverse=True)
+                # Stop if the next depth is not expected to finish before the deadline, rather than searching until
+                # the deadline and throwing the unfinished depth away
+                if self.deadline is not None and self.branching_factor is not None and 1 <= current_depth < depth:
+                    duration = self.depth_times[-1] - self.depth_times[-2]
+                    if time.monotonic() + duration * self.branching_factor > self.deadline:
+                        break
+            scores = {}
+        except SearchTimeout:
+            pass
+        return iterations, scores
 
-            # Calculate the value of this move
-            score = self.alphabeta(copy, depth, -AI.INFINITE, AI.INFINITE, False)
+    def search_root(self, chessboard: chess.Board, root_moves, depth, scores, expected=None):
+        """
+        Searches each of the root moves to the given depth.
+        The moves within the margin of the best move are always scored exactly, so that the AI can choose between them.
+        With principal variation search the other moves are only proven to be worse, so their scores are upper bounds.
+        :param chessboard: The chessboard, it is returned to its original state afterwards
+        :param root_moves: The moves to search, in the order to search them
+        :param depth: The depth to search each move to
+        :param scores: A dictionary that the score of each move is added to as it is calculated
+        :param expected: The best score of the previous iteration, used for the aspiration window of the first move
+        :return:
+        """
+        best_score = None
+        for move in root_moves:
+            self.check_deadline()
+            self.make_move(chessboard, move)
+            try:
+                # Calculate the value of this move
+                if best_score is None and expected is not None and self.aspiration_windows:
+                    # The best move of the last iteration usually scores close to what it did then
+                    a, b = expected - AI.ASPIRATION_WINDOW, expected + AI.ASPIRATION_WINDOW
+                    score = self.alphabeta(chessboard, depth, a, b, False)
+                    if score <= a or score >= b:  # Outside the window the score is only a bound
+                        score = self.alphabeta(chessboard, depth, -AI.INFINITE, AI.INFINITE, False)
+                elif best_score is not None and self.principal_variation_search:
+                    # Test whether the move is within the margin of the best one with a null window first
+                    threshold = best_score - self.margin
+                    score = self.alphabeta(chessboard, depth, threshold - 1, threshold, False)
+                    if score >= threshold:
+                        score = self.alphabeta(chessboard, depth, threshold - 1, AI.INFINITE, False)
+                else:
+                    score = self.alphabeta(chessboard, depth, -AI.INFINITE, AI.INFINITE, False)
+            finally:
+                self.unmake_move(chessboard)
+            best_score = score if best_score is None else max(best_score, score)
             self.highest_score_calculated = max(self.highest_score_calculated, score)
             self.lowest_score_calculated = min(self.lowest_score_calculated, score)
-            if random.random() > skill and chessboard.legal_moves.count() > 5:  # If the skill is not 1, then randomly skip some moves.
-                self.rejected_moves += 1
-                continue  # This is to reduce the skill of the AI.
-            if score > best_score:  # If the score is better, choose this move.
-                best_score = score
-                best_move = [move]
-            elif score == best_score:  # If the score is the same, choose a random move.
-                best_move.append(move)
+            scores[move] = score
 
-        self.total_optimal_moves = len(best_move)
-        self.best_move_score = best_score
-        self.calculate_time = time.time() - start_time
-        return random.choice(best_move)
+    @property
+    def cutoff_rate(self):
+        """
+        The fraction of cutoffs in the last search that were caused by the first move searched
+        """
+        return self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0
+
+    def check_deadline(self):
+        """
+        Stops the search by raising SearchTimeout if the deadline has passed, the node limit has been reached or the
+        search was cancelled
+        :return:
+        """
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+        if self.node_limit is not None and self.total_moves_checked >= self.node_limit:
+            raise SearchTimeout()
+        if self.stop_event is not None:
+            if self.stop_event.is_set():
+                raise SearchTimeout()
+            self.stop_checks += 1
+            if self.is_busy is not None and self.stop_checks % AI.BUSY_CHECK_INTERVAL == 0:
+                # Back off while the server is busy, so the search only uses spare time
+                while self.is_busy():
+                    if self.stop_event.wait(AI.BUSY_WAIT):
+                        raise SearchTimeout()
+
+    def ponder(self, chessboard: chess.Board, stop_event, depth=2, is_busy=None):
+        """
+        Searches while the opponent is thinking about their move.
+        The opponent's expected reply is searched first exactly like the AI's next move will be, and then the
+        other replies. The results are kept in the transposition table, so once the opponent moves the search of the
+        AI's reply can reuse them.
+        :param chessboard: The chessboard, with the opponent to move. It is searched on, so it must not be shared.
+        :param stop_event: A threading.Event that cancels the search when set
+        :param depth: The depth the AI's next move will be searched to
+        :param is_busy: A function that returns True when the server is busy, the search waits while it does
+        :return:
+        """
+        self.start_search(chessboard, None)
+        self.stop_event = stop_event
+        self.is_busy = is_busy
+        try:
+            entry = self.transposition_table.probe(AI.position_key(chessboard))
+            expected_reply = entry[3] if entry is not None else None
+            self.ponder_move = expected_reply
+            if expected_reply is not None:
+                self.make_move(chessboard, expected_reply)
+                try:
+                    self.root_ply = len(chessboard.move_stack)
+                    root_moves = self.order_moves(chessboard, None, 0)
+                    self.iterative_search(chessboard, root_moves, self.get_search_depth(chessboard, depth))
+                finally:
+                    self.unmake_move(chessboard)
+                self.check_deadline()
+
+            # Then prepare for the other replies, the opponent is to move so this position is minimizing for the AI
+            self.root_ply = len(chessboard.move_stack)
+            for current_depth in range(1, self.get_search_depth(chessboard, depth) + 2):
+                self.alphabeta(chessboard, current_depth, -AI.INFINITE, AI.INFINITE, False)
+        except SearchTimeout:
+            pass
+        finally:
+            self.stop_event = None
+            self.is_busy = None
 
     @staticmethod
     def is_invalid_move(move, invalid_moves):
@@ -260,10 +1088,36 @@ class AI:
     #
     #         return best_score
 
+    def evaluate(self, chessboard: chess.Board, has_moves=None):
+        """
+        Evaluates a position, using the evaluation cache shared by every AI in the process when possible
+        :param chessboard: The chessboard
+        :param has_moves: Whether the side to move has a legal move, if already known
+        :return: The score, see Heuristics.evaluate
+        """
+        if self.bitbase is not None and chess.popcount(chessboard.occupied) == 3:
+            # Checkmate and draws by the rules are scored as usual, the rest of the bitbase positions are looked up
+            mate_score, draw_score, _ = Heuristics.get_terminal_state(chessboard, self.color, has_moves,
+                                                                      self.current_repetitions())
+            if mate_score is None and draw_score is None:
+                score = self.get_bitbase_score(chessboard)
+                if score is not None:
+                    return score
+        if chessboard.uci_variant != "chess" or chessboard.halfmove_clock >= AI.CACHEABLE_HALFMOVES:
+            return Heuristics.evaluate(chessboard, self.color, has_moves, self.current_repetitions())
+        cache = evaluation_cache.get_evaluation_cache()
+        key = evaluation_cache.position_key(chessboard, self.color)
+        score = cache.get(key)
+        if score is None:
+            score = Heuristics.evaluate(chessboard, self.color, has_moves)
+            cache.put(key, score)
+        return score
+
     def alphabeta(self, chessboard: chess.Board, depth, a, b, maximizing):
         """
         Alpha beta pruning
-        :param chessboard: The chessboard
+        :param chessboard: The chessboard, the moves searched are made and unmade on it so it is returned to its
+         original state afterwards, even if the search is stopped
         :param depth:  The depth of the search (how many moves ahead)
         :param a:   The alpha value (best score for the maximizing player)
         :param b:   The beta value (best score for the minimizing player)
@@ -271,36 +1125,258 @@ class AI:
         :return:   The score
         """
         if depth == 0:  # If we have reached the end of the search
-            return Heuristics.evaluate(chessboard, self.color)
+            return self.evaluate(chessboard)
+        if not self.used_bitbase and self.in_bitbase(chessboard):
+            # The search reached a bitbase endgame, so its result is already known
+            return self.evaluate(chessboard)
+
+        self.check_deadline()
+
+        # Check if this position has already been searched deep enough to be reused
+        key = self.current_key(chessboard)
+        entry = self.transposition_table.probe(key)
+        if entry is not None:
+            entry_depth, bound, score, _ = entry
+            if entry_depth >= depth:
+                if bound == TranspositionTable.EXACT:
+                    return score
+                elif bound == TranspositionTable.LOWER_BOUND and score >= b:
+                    return score
+                elif bound == TranspositionTable.UPPER_BOUND and score <= a:
+                    return score
+
+        # The batch scores only know the material and piece tables, so variant positions are scored one at a time
+        if depth == 1 and self.batch_leaves and chessboard.uci_variant == "chess":
+            moves = list(chessboard.legal_moves)
+            if not moves:
+                return self.evaluate(chessboard, has_moves=False)
+            best_score, best_move = self.evaluate_frontier(chessboard, moves, maximizing)
+            self.transposition_table.store(key, depth, TranspositionTable.EXACT, best_score, best_move)
+            return best_score
+
+        in_check = chessboard.is_check()
+        if self.null_move_pruning and depth > AI.NULL_MOVE_REDUCTION and not in_check and \
+                AI.can_null_move(chessboard):
+            # If the side to move is still winning the cutoff after passing, a real move would win it too
+            self.make_move(chessboard, chess.Move.null())
+            try:
+                if maximizing:
+                    score = self.alphabeta(chessboard, depth - 1 - AI.NULL_MOVE_REDUCTION, b - 1, b, False)
+                else:
+                    score = self.alphabeta(chessboard, depth - 1 - AI.NULL_MOVE_REDUCTION, a, a + 1, True)
+            finally:
+                self.unmake_move(chessboard)
+            if (score >= b) if maximizing else (score <= a):
+                return score
 
+        original_a, original_b = a, b
+        best_move = None
+        hash_move = entry[3] if entry is not None else None
+        ply = len(chessboard.move_stack) - self.root_ply
+        moves = self.order_moves(chessboard, hash_move, ply)
+        if not moves:
+            return self.evaluate(chessboard, has_moves=False)
         if maximizing:  # If we are maximizing
             best_score = -AI.INFINITE
-            if chessboard.legal_moves.count() == 0:
-                return Heuristics.evaluate(chessboard, self.color)
-            for move in chessboard.legal_moves:  # For each move
+            for index, move in enumerate(moves):  # For each move
                 self.total_moves_checked += 1
-                copy = chessboard.copy()
-                copy.push(move)
-
-                score = self.alphabeta(copy, depth - 1, a, b, False)  # Calculate the score of this move
-                best_score = max(best_score, score)  # Choose the best score
+                reduction = self.get_reduction(chessboard, move, depth, ply, index, in_check)
+                self.make_move(chessboard, move)
+                try:
+                    score = self.search_move(chessboard, depth, a, b, True, index, reduction)  # Calculate the score
+                finally:
+                    self.unmake_move(chessboard)
+                if score > best_score or best_move is None:  # Choose the best score
+                    best_score = score
+                    best_move = move
                 a = max(a, best_score)  # Update the alpha value
                 if b <= a:  # If the beta value is less than or equal to the alpha value, then we can prune this branch.
+                    self.record_cutoff(chessboard, move, depth, ply, index)
                     break
-            return best_score
         else:  # If we are minimizing
             best_score = AI.INFINITE
-            if chessboard.legal_moves.count() == 0:
-                return Heuristics.evaluate(chessboard, self.color)
-            for move in chessboard.legal_moves:  # For each move
+            for index, move in enumerate(moves):  # For each move
                 self.total_moves_checked += 1
-                copy = chessboard.copy()
-                copy.push(move)
-
-                score = self.alphabeta(copy, depth - 1, a, b, True)  # Calculate the score of this move
-                best_score = min(best_score, score)  # Choose the best score
+                reduction = self.get_reduction(chessboard, move, depth, ply, index, in_check)
+                self.make_move(chessboard, move)
+                try:
+                    score = self.search_move(chessboard, depth, a, b, False, index, reduction)  # Calculate the score
+                finally:
+                    self.unmake_move(chessboard)
+                if score < best_score or best_move is None:  # Choose the best score
+                    best_score = score
+                    best_move = move
                 b = min(b, best_score)  # Update the beta value
                 if b <= a:  # If the beta value is less than or equal to the alpha value, then we can prune this branch.
+                    self.record_cutoff(chessboard, move, depth, ply, index)
                     break
-            return best_score
 
+        # Save the result, noting whether the score is exact or only a bound because of a cutoff
+        if best_score <= original_a:
+            bound = TranspositionTable.UPPER_BOUND
+        elif best_score >= original_b:
+            bound = TranspositionTable.LOWER_BOUND
+        else:
+            bound = TranspositionTable.EXACT
+        self.transposition_table.store(key, depth, bound, best_score, best_move)
+        return best_score
+
+    def search_move(self, chessboard: chess.Board, depth, a, b, maximizing, index, reduction):
+        """
+        Scores a move of a node, which has already been made on the board.
+        With principal variation search only the first move gets the full window, the others are tested with a null
+        window and only searched again if they could be better. A reduced move is searched again at the full depth
+        if it turns out to be better than expected.
+        :param chessboard: The chessboard after the move
+        :param depth: The depth of the node the move was made from
+        :param a: The alpha value of the node
+        :param b: The beta value of the node
+        :param maximizing: True if the node the move was made from is maximizing
+        :param index: The position of the move in the ordered move list
+        :param reduction: How much shallower to search the move first, see get_reduction
+        :return: The score
+        """
+        if reduction and chessboard.is_check():
+            reduction = 0  # Checks are forcing, so they are never reduced
+        if index == 0 or not (self.principal_variation_search or reduction):
+            return self.alphabeta(chessboard, depth - 1, a, b, not maximizing)
+
+        if not self.principal_variation_search:
+            test_a, test_b = a, b
+        elif maximizing:
+            test_a, test_b = a, a + 1
+        else:
+            test_a, test_b = b - 1, b
+
+        def improves(result):
+            return result > a if maximizing else result < b
+
+        score = self.alphabeta(chessboard, depth - 1 - reduction, test_a, test_b, not maximizing)
+        if reduction and improves(score):
+            score = self.alphabeta(chessboard, depth - 1, test_a, test_b, not maximizing)
+        if (test_a, test_b) != (a, b) and improves(score) and a < score < b:
+            score = self.alphabeta(chessboard, depth - 1, a, b, not maximizing)
+        return score
+
+    def get_reduction(self, chessboard: chess.Board, move, depth, ply, index, in_check):
+        """
+        Returns how much shallower to search a move first. Quiet moves late in the move order rarely turn out to be
+        the best, so they are searched one ply shallower, and searched again at the full depth if they do.
+        :param chessboard: The chessboard before the move
+        :param move: The move
+        :param depth: The depth of the node
+        :param ply: How many moves from the root of the search the node is
+        :param index: The position of the move in the ordered move list
+        :param in_check: Whether the side to move is in check
+        :return: The reduction in plies
+        """
+        if not self.late_move_reductions or index < AI.LATE_MOVE_INDEX or depth < AI.LATE_MOVE_DEPTH or in_check:
+            return 0
+        if move.promotion or chessboard.is_capture(move) or move in self.killer_moves.get(ply, ()):
+            return 0
+        return 1
+
+    @staticmethod
+    def can_null_move(chessboard: chess.Board):
+        """
+        Returns whether null move pruning can be used in a position.
+        It is not used in variants, where passing can break the rules, or after another null move. Positions where the
+        side to move only has pawns left are skipped too, as that is where having to move is a disadvantage (zugzwang)
+        and passing would give the wrong answer.
+        :param chessboard: The chessboard
+        :return:
+        """
+        if chessboard.uci_variant != "chess" or (chessboard.move_stack and not chessboard.move_stack[-1]):
+            return False
+        return bool(chessboard.occupied_co[chessboard.turn] & ~(chessboard.pawns | chessboard.kings))
+
+    def order_moves(self, chessboard: chess.Board, hash_move, ply):
+        """
+        Orders the legal moves so that the moves most likely to cause a cutoff are searched first.
+        The order is the hash move, then captures and promotions ranked by the value of the captured piece minus the
+        value of the capturing piece, then the killer moves of this ply, then the other moves by their history score.
+        :param chessboard: The chessboard
+        :param hash_move: The best move stored in the transposition table for this position, or None
+        :param ply: How many moves from the root of the search this position is
+        :return: A list of the legal moves
+        """
+        killers = self.killer_moves.get(ply, ())
+        history = self.history
+        piece_values = Heuristics.piece_values
+
+        def priority(move):
+            if move == hash_move:
+                return 3 * AI.INFINITE
+            if move.promotion or chessboard.is_capture(move):
+                score = 2 * AI.INFINITE
+                if move.promotion:
+                    score += piece_values[move.promotion]
+                if chessboard.is_capture(move):
+                    # En passant is the only capture without a piece on the target square
+                    victim = chessboard.piece_type_at(move.to_square) or chess.PAWN
+                    score += piece_values[victim] - piece_values[chessboard.piece_type_at(move.from_square)]
+                return score
+            if move in killers:
+                return AI.INFINITE - killers.index(move)
+            return history.get((move.from_square, move.to_square), 0)
+
+        return sorted(chessboard.legal_moves, key=priority, reverse=True)
+
+    def record_cutoff(self, chessboard: chess.Board, move, depth, ply, index):
+        """
+        Records a move that caused a cutoff, so that it can be tried earlier in other positions
+        :param chessboard: The chessboard before the move was made
+        :param move: The move that caused the cutoff
+        :param depth: The depth remaining when the cutoff happened
+        :param ply: How many moves from the root of the search the position is
+        :param index: The position of the move in the ordered move list
+        :return:
+        """
+        self.cutoffs += 1
+        if index == 0:
+            self.first_move_cutoffs += 1
+        if move.promotion or chessboard.is_capture(move):
+            return  # Captures and promotions are already ordered first
+        killers = self.killer_moves.setdefault(ply, [])
+        if move not in killers:
+            killers.insert(0, move)
+            del killers[AI.KILLER_MOVES:]
+        history_key = (move.from_square, move.to_square)
+        self.history[history_key] = self.history.get(history_key, 0) + depth * depth
+
+    def evaluate_frontier(self, chessboard: chess.Board, moves, maximizing):
+        """
+        Scores every move of a standard chess position that is one move from the end of the search as a single batch.
+        Every move is scored, so no cutoffs happen at this ply, but the score is the same as the per node search.
+        :param chessboard: The chessboard, it is returned to its original state afterwards
+        :param moves: The legal moves of the position, there must be at least one
+        :param maximizing: True if maximizing, false if minimizing
+        :return: A tuple of (best_score, best_move)
+        """
+        scores = [None] * len(moves)
+        batch = []  # The indexes of the moves scored in the batch
+        piece_masks = []
+        terminal_states = []
+        for index, move in enumerate(moves):
+            self.total_moves_checked += 1
+            self.make_move(chessboard, move)
+            try:
+                if self.bitbase is not None and chess.popcount(chessboard.occupied) == 3:
+                    # The batch does not know the bitbase, so its endgames are scored the same way as the per node
+                    # search scores them
+                    scores[index] = self.evaluate(chessboard)
+                else:
+                    batch.append(index)
+                    piece_masks.append(Heuristics.get_piece_masks(chessboard))
+                    terminal_states.append(Heuristics.get_terminal_state(chessboard, self.color,
+                                                                         repetitions=self.current_repetitions()))
+            finally:
+                self.unmake_move(chessboard)
+
+        if batch:
+            batch_scores = Heuristics.score_batch(Heuristics.get_occupancy(piece_masks), terminal_states, self.color)
+            for index, score in zip(batch, batch_scores):
+                scores[index] = score
+        pick = max if maximizing else min
+        best_index = pick(range(len(moves)), key=scores.__getitem__)
+        return scores[best_index], moves[best_index]
@@ -0,0 +1,181 @@
+"""
+Batch analysis of saved chess games, run off-peak instead of inside the request handlers. Every position of a saved
+game is searched by the AI in a pool of worker processes, and the evaluation of each move and whether it was a blunder
+is written to the chess_game_analysis table.
+
+Each game is written as soon as it is analysed, and only the moves without an analysis are searched, so the job can
+be stopped at any time and resumed, and games that were saved again with more moves only have the new moves analysed.
+Run from the server directory with:
+    python -m GameManagers.Chess.analysis --database database.db --workers 4
+"""
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import chess
+
+from loguru import logger as logging
+
+from .ai_logic import AI
+from .bitbase import Bitbase
+from .chess_room import Chess
+
+DEFAULT_BLUNDER_THRESHOLD = 200  # How much a move can lose, from the mover's point of view, before it is a blunder
+
+
+def create_analysis_table(connection):
+    """
+    Creates the table the analysis is written to if it does not exist
+    :param connection: The sqlite3 connection
+    :return:
+    """
+    connection.execute("CREATE TABLE IF NOT EXISTS chess_game_analysis ("
+                       "game_id TEXT, ply INTEGER, move TEXT, best_move TEXT, evaluation_before INTEGER, "
+                       "evaluation_after INTEGER, loss INTEGER, blunder BOOLEAN, depth INTEGER, analysed_at REAL, "
+                       "PRIMARY KEY (game_id, ply))")
+    connection.commit()
+
+
+def get_pending_games(connection, limit=None):
+    """
+    Finds the saved games that have moves without an analysis
+    :param connection: The sqlite3 connection
+    :param limit: The most games to return, or None for every game
+    :return: A list of (game_id, variant, starting_fen, moves, first_ply) where first_ply is the first move that needs
+     to be analysed
+    """
+    rows = connection.execute(
+        "SELECT saves.game_id, saves.variant, saves.starting_fen, saves.moves, COUNT(analysis.ply) "
+        "FROM chess_game_saves AS saves LEFT JOIN chess_game_analysis AS analysis ON analysis.game_id = saves.game_id "
+        "WHERE saves.moves IS NOT NULL AND saves.moves != '' GROUP BY saves.game_id ORDER BY saves.rowid").fetchall()
+    games = []
+    for game_id, variant, starting_fen, moves, analysed in rows:
+        moves = moves.split()
+        if analysed < len(moves):
+            games.append((game_id, variant, starting_fen, moves, analysed))
+        if limit is not None and len(games) >= limit:
+            break
+    return games
+
+
+def search_position(players, chessboard: chess.Board, depth, time_limit):
+    """
+    Searches a position with the AI of the side to move
+    :param players: A dictionary of the AI of each color, kept for the whole game so their transposition tables are
+     reused from one position to the next
+    :param chessboard: The chessboard
+    :param depth: The search depth
+    :param time_limit: The most time in seconds the search can take
+    :return: A tuple of (evaluation, best move), the evaluation is capped and from white's point of view, and the best
+     move is None if the game is over
+    """
+    if chessboard.is_game_over():
+        outcome = chessboard.outcome()
+        if outcome.winner is None:
+            return 0, None
+        return AI.MAX_DISPLAY_SCORE if outcome.winner == chess.WHITE else -AI.MAX_DISPLAY_SCORE, None
+    ai = players[chessboard.turn]
+    move = ai.get_ai_move(chessboard, [], depth=depth, time_limit=time_limit)
+    # Capped, so that checkmates and draws do not swamp the losses of the other moves
+    return AI.get_display_score(ai.best_move_score, ai.color), move
+
+
+def analyse_game(game_id, variant, starting_fen, moves, first_ply, depth, time_limit, blunder_threshold):
+    """
+    Analyses the moves of a game from first_ply on. Called in a worker process.
+    :param game_id: The id of the saved game
+    :param variant: The variant of the game, see Chess.create_board
+    :param starting_fen: The position the game started from
+    :param moves: The moves of the game in uci
+    :param first_ply: The first move to analyse, the moves before it were analysed by an earlier run
+    :param depth: The search depth
+    :param time_limit: The most time in seconds each position can be searched for
+    :param blunder_threshold: How much a move can lose before it is a blunder
+    :return: A list of rows for the chess_game_analysis table
+    """
+    board = Chess.create_board(variant if variant is not None else "Standard")
+    board.set_fen(starting_fen)
+    for move in moves[:first_ply]:
+        board.push_uci(move)
+    bitbase = Bitbase.get_default()
+    players = {color: AI(color, seed=0, bitbase=bitbase) for color in chess.COLORS}
+
+    rows = []
+    evaluation, best_move = search_position(players, board, depth, time_limit)
+    for ply in range(first_ply, len(moves)):
+        mover = board.turn
+        board.push_uci(moves[ply])
+        evaluation_after, next_best_move = search_position(players, board, depth, time_limit)
+        # How much worse the position got for the side that moved
+        loss = max(0, evaluation - evaluation_after if mover == chess.WHITE else evaluation_after - evaluation)
+        rows.append((game_id, ply, moves[ply], best_move.uci() if best_move is not None else None, evaluation,
+                     evaluation_after, loss, loss >= blunder_threshold, depth, time.time()))
+        evaluation, best_move = evaluation_after, next_best_move
+    return rows
+
+
+def analyse_saved_games(database_path, workers, depth, time_limit, blunder_threshold, limit):
+    """
+    Analyses the saved games that have moves without an analysis, writing each game to the database as it finishes
+    :param database_path: The path of the server's database
+    :param workers: The number of worker processes
+    :param depth: The search depth
+    :param time_limit: The most time in seconds each position can be searched for
+    :param blunder_threshold: How much a move can lose before it is a blunder
+    :param limit: The most games to analyse in this run, or None for every game
+    :return: The number of games analysed
+    """
+    connection = sqlite3.connect(database_path, timeout=30)
+    create_analysis_table(connection)
+    columns = [column[1] for column in connection.execute("PRAGMA table_info(chess_game_saves)")]
+    if "moves" not in columns:
+        logging.error("The saved games have no moves to analyse, start the server once to add the moves column")
+        return 0
+    games = get_pending_games(connection, limit)
+    logging.info(f"Analysing {len(games)} games with {workers} workers")
+
+    analysed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        games = iter(games)
+        while True:
+            # Keep only a few games queued per worker instead of submitting the whole backlog up front
+            for game in games:
+                pending.add(executor.submit(analyse_game, *game, depth, time_limit, blunder_threshold))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                rows = future.result()
+                with connection:
+                    connection.executemany("INSERT OR REPLACE INTO chess_game_analysis VALUES "
+                                           "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                analysed += 1
+                blunders = sum(row[7] for row in rows)
+                logging.info(f"Analysed {len(rows)} moves of game {rows[0][0]} with {blunders} blunders "
+                             f"({analysed} games in {time.perf_counter() - start:.0f}s)")
+    connection.close()
+    return analysed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse the moves of saved chess games")
+    parser.add_argument("--database", default="database.db")
+    parser.add_argument("--workers", type=int, default=None, help="The number of processes, one per core by default")
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--time-limit", type=float, default=10, help="The most seconds to search each position for")
+    parser.add_argument("--blunder", type=int, default=DEFAULT_BLUNDER_THRESHOLD,
+                        help="How much a move can lose before it is flagged as a blunder")
+    parser.add_argument("--limit", type=int, default=None, help="The most games to analyse in this run")
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count()
+    analyse_saved_games(args.database, workers, args.depth, args.time_limit, args.blunder, args.limit)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,432 @@
+"""
+Benchmarks for the chess AI, run from the server directory with:
+    python -m GameManagers.Chess.benchmark <benchmark> [options]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import chess
+import chess.variant
+
+from . import evaluation_cache
+from .ai_logic import AI, Heuristics
+from .parallel_search import ParallelRootSearch
+
+# A fixed set of positions so that results can be compared between runs
+POSITIONS = {
+    "opening": "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+    "middlegame": "r2q1rk1/pp2bppp/2n1bn2/2pp4/3P4/2N1PN2/PPQ1BPPP/R1B2RK1 w - - 0 10",
+    "endgame": "8/5pk1/6p1/3R4/5P2/6PK/r7/8 w - - 0 40",
+}
+
+# The positions of the suite benchmark, as (variant, fen), covering every variant a chess room can be played in
+SUITE = {
+    "opening": ("chess", POSITIONS["opening"]),
+    "middlegame": ("chess", POSITIONS["middlegame"]),
+    "endgame": ("chess", POSITIONS["endgame"]),
+    "chess960": ("chess960", "rnqkbbrn/pppppppp/8/8/8/8/PPPPPPPP/RNQKBBRN w KQkq - 0 1"),
+    "suicide": ("suicide", "rnbqkbnr/p1pppppp/8/1B6/8/4P3/PPPP1PPP/RNBQK1NR b - - 0 2"),
+    "crazyhouse": ("crazyhouse", "rn2kbnr/pp3ppp/2p1p3/q7/3P2b1/2N2N2/PPP1BPPP/R1BQK2R[Pp] w KQkq - 0 7"),
+    "three check": ("3check", "r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 3+3 4 4"),
+    "atomic": ("atomic", "rnbqkbnr/ppp2ppp/4p3/3p4/4P3/2N2N2/PPPP1PPP/R1BQKB1R b KQkq - 1 3"),
+    "antichess": ("antichess", "rnbqkbnr/p1pppppp/8/1B6/8/4P3/PPPP1PPP/RNBQK1NR b - - 0 2"),
+    "horde": ("horde", "rnbqkbnr/pppppppp/8/1PP2PP1/PPPPPPPP/PPPPPPPP/PPPPPPPP/PPPPPPPP w kq - 0 1"),
+    "king of the hill": ("kingofthehill", "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3"),
+    "racing kings": ("racingkings", "8/8/8/8/8/8/krbnNBRK/qrbnNBRQ w - - 0 1"),
+}
+DEFAULT_BASELINE_PATH = "chess_benchmark_baseline.json"
+MIN_TIMED_SECONDS = 0.25  # Searches faster than this are too noisy to flag their timings
+
+
+def random_positions(count, seed=0):
+    """
+    Creates positions by playing random moves from the fixed positions
+    :param count: The number of positions to create
+    :param seed: The random seed
+    :return: A list of boards
+    """
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        board = chess.Board(rng.choice(list(POSITIONS.values())))
+        for _ in range(rng.randint(0, 8)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        boards.append(board)
+    return boards
+
+
+def played_position(plies, seed=0):
+    """
+    Creates a position with a long move stack by playing random moves from the starting position
+    :param plies: The number of moves to play
+    :param seed: The random seed
+    :return: The board
+    """
+    rng = random.Random(seed)
+    board = chess.Board()
+    while len(board.move_stack) < plies:
+        moves = list(board.legal_moves)
+        rng.shuffle(moves)
+        # Avoid moves that end the game, so the position can still be searched
+        for move in moves:
+            board.push(move)
+            if not board.is_game_over(claim_draw=True):
+                break
+            board.pop()
+        else:
+            break
+    return board
+
+
+def benchmark_batch_evaluation(batch_sizes, repeats):
+    """
+    Compares scoring positions one at a time against scoring them as a numpy batch.
+    Only the material and piece table part is timed, the terminal checks cost the same in both paths.
+    :param batch_sizes: The batch sizes to compare
+    :param repeats: How many times each batch is scored
+    :return:
+    """
+    print(f"{'Batch':>6} {'Per node (us)':>14} {'Batched (us)':>13} {'Speedup':>8}")
+    for batch_size in batch_sizes:
+        boards = random_positions(batch_size)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for board in boards:
+                Heuristics.get_material_score(board, chess.WHITE) + Heuristics.get_position_score(board)
+        per_node = (time.perf_counter() - start) / (repeats * batch_size)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            occupancy = Heuristics.get_occupancy([Heuristics.get_piece_masks(board) for board in boards])
+            Heuristics.score_batch(occupancy, [(None, None, 0)] * batch_size, chess.WHITE)
+        batched = (time.perf_counter() - start) / (repeats * batch_size)
+
+        print(f"{batch_size:>6} {per_node * 1e6:>14.2f} {batched * 1e6:>13.2f} {per_node / batched:>7.2f}x")
+
+
+def benchmark_batch_search(depth):
+    """
+    Compares the per node search against the batched leaf search on the fixed positions
+    :param depth: The search depth
+    :return:
+    """
+    print(f"{'Position':<12} {'Mode':<9} {'Nodes':>8} {'Time (s)':>9} {'Nodes/s':>9} Move")
+    for name, fen in POSITIONS.items():
+        for batch_leaves in (False, True):
+            random.seed(0)
+            ai = AI(chess.WHITE if chess.Board(fen).turn == chess.WHITE else chess.BLACK, batch_leaves=batch_leaves)
+            start = time.perf_counter()
+            move = ai.get_ai_move(chess.Board(fen), [], depth=depth)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<12} {'batched' if batch_leaves else 'per node':<9} {ai.total_moves_checked:>8} "
+                  f"{elapsed:>9.2f} {ai.total_moves_checked / elapsed:>9.0f} {move.uci()}")
+
+
+def benchmark_parallel_search(worker_counts, depth, seed):
+    """
+    Measures the speedup of splitting the root moves across worker processes on the fixed positions
+    :param worker_counts: The worker counts to compare, the first is used as the reference
+    :param depth: The search depth
+    :param seed: The AI seed, so every worker count searches the same way
+    :return:
+    """
+    print(f"{'Position':<12} {'Workers':>7} {'Nodes':>8} {'Time (s)':>9} {'Speedup':>8} Move")
+    for name, fen in POSITIONS.items():
+        reference = None
+        for workers in worker_counts:
+            parallel_search = ParallelRootSearch.get(workers)
+            # Run once first so the time to start the worker processes is not measured
+            AI(chess.Board(fen).turn, seed=seed).get_ai_move(chess.Board(fen), [], depth=0,
+                                                              parallel_search=parallel_search)
+            ai = AI(chess.Board(fen).turn, seed=seed)
+            start = time.perf_counter()
+            move = ai.get_ai_move(chess.Board(fen), [], depth=depth, parallel_search=parallel_search)
+            elapsed = time.perf_counter() - start
+            reference = reference or elapsed
+            print(f"{name:<12} {parallel_search.workers:>7} {ai.total_moves_checked:>8} {elapsed:>9.2f} "
+                  f"{reference / elapsed:>7.2f}x {move.uci()}")
+
+
+def walk_with_copies(chessboard: chess.Board, depth):
+    """
+    Visits every position to the given depth by copying the board for each move, the way the search used to
+    :param chessboard: The chessboard
+    :param depth: The depth to visit
+    :return: The number of positions visited
+    """
+    if depth == 0:
+        return 1
+    nodes = 1
+    for move in chessboard.legal_moves:
+        copy = chessboard.copy()
+        copy.push(move)
+        nodes += walk_with_copies(copy, depth - 1)
+    return nodes
+
+
+def walk_with_make_unmake(chessboard: chess.Board, depth):
+    """
+    Visits every position to the given depth by making and unmaking each move on the one board, like the search does
+    :param chessboard: The chessboard
+    :param depth: The depth to visit
+    :return: The number of positions visited
+    """
+    if depth == 0:
+        return 1
+    nodes = 1
+    for move in chessboard.legal_moves:
+        chessboard.push(move)
+        nodes += walk_with_make_unmake(chessboard, depth - 1)
+        chessboard.pop()
+    return nodes
+
+
+def measure(function):
+    """
+    Runs a function once to time it, and once more under tracemalloc to find how much memory it allocated at its peak
+    :param function: The function to run
+    :return: A tuple of (result, seconds, peak bytes)
+    """
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def benchmark_make_unmake(depth, late_plies):
+    """
+    Compares copying the board at every node against making and unmaking moves on one board, early in a game and
+    late in a game when the move stack that copying has to duplicate is long
+    :param depth: The depth to visit and search to
+    :param late_plies: How many moves are played before the late position
+    :return:
+    """
+    positions = {"early": played_position(4), "late": played_position(late_plies)}
+    print(f"{'Position':<9} {'Stack':>5} {'Mode':<13} {'Nodes':>8} {'Nodes/s':>9} {'Peak (KB)':>10}")
+    for name, board in positions.items():
+        for mode, walk in (("copy", walk_with_copies), ("make/unmake", walk_with_make_unmake)):
+            nodes, elapsed, peak = measure(lambda: walk(board.copy(), depth))
+            print(f"{name:<9} {len(board.move_stack):>5} {mode:<13} {nodes:>8} {nodes / elapsed:>9.0f} "
+                  f"{peak / 1024:>10.1f}")
+
+    print()
+    print(f"{'Position':<9} {'Stack':>5} {'Nodes':>8} {'Nodes/s':>9} {'Peak (KB)':>10} Move (AI search)")
+    for name, board in positions.items():
+        # A fresh AI for each run, so the second run does not reuse the transposition table of the first
+        ais = []
+
+        def search():
+            ais.append(AI(board.turn, seed=0))
+            return ais[-1].get_ai_move(board, [], depth=depth)
+
+        move, elapsed, peak = measure(search)
+        nodes = ais[0].total_moves_checked
+        print(f"{name:<9} {len(board.move_stack):>5} {nodes:>8} {nodes / elapsed:>9.0f} {peak / 1024:>10.1f} "
+              f"{move.uci()}")
+
+
+def benchmark_pruning(depth):
+    """
+    Measures the node reduction of each search technique on its own and of all of them together, on the fixed positions
+    :param depth: The search depth
+    :return:
+    """
+    disabled = {option: False for option in AI(chess.WHITE).search_options}
+    configurations = {"none": disabled}
+    for option in disabled:
+        configurations[option] = dict(disabled, **{option: True})
+    configurations["all"] = {option: True for option in disabled}
+
+    print(f"{'Position':<12} {'Techniques':<27} {'Nodes':>8} {'Time (s)':>9} {'Nodes saved':>12} {'Score':>8} Move")
+    totals = {}
+    for name, fen in POSITIONS.items():
+        reference = None
+        for configuration, options in configurations.items():
+            ai = AI(chess.Board(fen).turn, seed=0, **options)
+            evaluation_cache.get_evaluation_cache().clear()  # So every run starts from the same cache
+            start = time.perf_counter()
+            move = ai.get_ai_move(chess.Board(fen), [], depth=depth)
+            elapsed = time.perf_counter() - start
+            nodes = ai.total_moves_checked
+            reference = reference or nodes
+            totals[configuration] = totals.get(configuration, 0) + nodes
+            print(f"{name:<12} {configuration:<27} {nodes:>8} {elapsed:>9.2f} {1 - nodes / reference:>12.1%} "
+                  f"{ai.best_move_score:>8} {move.uci()}")
+    print()
+    for configuration, nodes in totals.items():
+        print(f"{'total':<12} {configuration:<27} {nodes:>8} {'':>9} {1 - nodes / totals['none']:>12.1%}")
+
+
+def suite_board(variant, fen):
+    """
+    Creates the board of a suite position
+    :param variant: The uci name of the variant, or chess960
+    :param fen: The FEN of the position
+    :return: The board
+    """
+    if variant == "chess960":
+        return chess.Board(fen, chess960=True)
+    return chess.variant.find_variant(variant)(fen)
+
+
+def run_suite_position(variant, fen, depth):
+    """
+    Searches a suite position with a fresh, seeded AI and an empty evaluation cache, so the nodes and the move only
+    change when the search does
+    :param variant: The uci name of the variant, or chess960
+    :param fen: The FEN of the position
+    :param depth: The search depth
+    :return: A dictionary of the results
+    """
+    board = suite_board(variant, fen)
+    ai = AI(board.turn, seed=0)
+    evaluation_cache.get_evaluation_cache().clear()
+    start = time.perf_counter()
+    move = ai.get_ai_move(board, [], depth=depth, time_limit=3600)
+    elapsed = time.perf_counter() - start
+    return {
+        "nodes": ai.total_moves_checked,
+        "nodes_per_second": round(ai.total_moves_checked / elapsed),
+        "time": round(elapsed, 3),
+        "depth": ai.search_depth,
+        "time_to_depth": [round(seconds, 3) for seconds in ai.depth_times],
+        "move": move.uci() if move is not None else None,
+        "score": ai.best_move_score,
+    }
+
+
+def find_regressions(result, baseline, tolerance):
+    """
+    Compares the result of a suite position against its baseline.
+    The search is deterministic, so more nodes or a shallower depth always means the search changed, while the timings
+    also depend on the machine and are only flagged when they are worse than the tolerance on a search long enough to
+    time.
+    :param result: The result of run_suite_position
+    :param baseline: The stored result of the position
+    :param tolerance: How much worse, as a fraction, a timing can be before it is flagged
+    :return: A tuple of (regressions, notes), lists of descriptions
+    """
+    regressions = []
+    notes = []
+    if result["depth"] < baseline["depth"]:
+        regressions.append(f"depth {baseline['depth']} -> {result['depth']}")
+    if result["nodes"] > baseline["nodes"] * (1 + tolerance):
+        regressions.append(f"nodes {baseline['nodes']} -> {result['nodes']}")
+    if baseline["time"] >= MIN_TIMED_SECONDS:
+        if result["nodes_per_second"] < baseline["nodes_per_second"] * (1 - tolerance):
+            regressions.append(f"nodes/s {baseline['nodes_per_second']} -> {result['nodes_per_second']}")
+        if result["depth"] == baseline["depth"] and result["time_to_depth"] and \
+                result["time_to_depth"][-1] > baseline["time_to_depth"][-1] * (1 + tolerance):
+            regressions.append(f"time to depth {baseline['time_to_depth'][-1]}s -> {result['time_to_depth'][-1]}s")
+    if result["move"] != baseline["move"]:
+        notes.append(f"move {baseline['move']} -> {result['move']}")
+    return regressions, notes
+
+
+def benchmark_suite(depth, baseline_path, update, tolerance):
+    """
+    Searches every suite position, and compares the results against a stored baseline.
+    If there is no baseline yet, or update is set, the results are stored as the new baseline instead.
+    :param depth: The search depth
+    :param baseline_path: The path of the JSON baseline
+    :param update: Whether to replace the baseline with these results
+    :param tolerance: How much worse, as a fraction, a result can be before it is flagged as a regression
+    :return: The exit status, 1 if there were any regressions
+    """
+    baseline = None
+    if os.path.isfile(baseline_path) and not update:
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+        if baseline["depth"] != depth:
+            print(f"The baseline was searched to depth {baseline['depth']}, not {depth}. Use --update to replace it.")
+            return 2
+
+    print(f"{'Position':<17} {'Nodes':>8} {'Nodes/s':>8} {'Time (s)':>9} {'Depth':>5} {'Score':>8} {'Move':<6} Flags")
+    results = {}
+    regression_count = 0
+    for name, (variant, fen) in SUITE.items():
+        result = results[name] = run_suite_position(variant, fen, depth)
+        flags = ""
+        if baseline is not None and name in baseline["positions"]:
+            regressions, notes = find_regressions(result, baseline["positions"][name], tolerance)
+            regression_count += len(regressions)
+            flags = ", ".join([f"REGRESSION {regression}" for regression in regressions] + notes)
+        print(f"{name:<17} {result['nodes']:>8} {result['nodes_per_second']:>8} {result['time']:>9.2f} "
+              f"{result['depth']:>5} {result['score']:>8} {str(result['move']):<6} {flags}")
+
+    total_nodes = sum(result["nodes"] for result in results.values())
+    total_time = sum(result["time"] for result in results.values())
+    print(f"{'total':<17} {total_nodes:>8} {total_nodes / total_time:>8.0f} {total_time:>9.2f}")
+
+    if baseline is None:
+        with open(baseline_path, "w") as file:
+            json.dump({"depth": depth, "python": platform.python_version(), "machine": platform.machine(),
+                       "positions": results}, file, indent=2)
+        print(f"Wrote the baseline to {baseline_path}")
+        return 0
+    print(f"{regression_count} regressions against {baseline_path}")
+    return 1 if regression_count else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chess AI benchmarks")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    batch = benchmarks.add_parser("batch", help="Per node against batched leaf evaluation")
+    batch.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64, 128, 256])
+    batch.add_argument("--repeats", type=int, default=200)
+    batch.add_argument("--depth", type=int, default=2)
+
+    parallel = benchmarks.add_parser("parallel", help="Speedup of the parallel root search against worker count")
+    parallel.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parallel.add_argument("--depth", type=int, default=3)
+    parallel.add_argument("--seed", type=int, default=0)
+
+    make_unmake = benchmarks.add_parser("make-unmake", help="Copying the board at every node against make/unmake")
+    make_unmake.add_argument("--depth", type=int, default=3)
+    make_unmake.add_argument("--late-plies", type=int, default=120)
+
+    pruning = benchmarks.add_parser("pruning", help="Node reduction of each search technique")
+    pruning.add_argument("--depth", type=int, default=3)
+
+    suite = benchmarks.add_parser("suite", help="Every suite position, compared against a stored baseline")
+    suite.add_argument("--depth", type=int, default=3)
+    suite.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    suite.add_argument("--update", action="store_true", help="Replace the baseline with the results of this run")
+    suite.add_argument("--tolerance", type=float, default=0.15,
+                       help="How much worse, as a fraction, a result can be before it is a regression")
+
+    args = parser.parse_args()
+    match args.benchmark:
+        case "batch":
+            benchmark_batch_evaluation(args.sizes, args.repeats)
+            print()
+            benchmark_batch_search(args.depth)
+        case "parallel":
+            benchmark_parallel_search(args.workers, args.depth, args.seed)
+        case "make-unmake":
+            benchmark_make_unmake(args.depth, args.late_plies)
+        case "pruning":
+            benchmark_pruning(args.depth)
+        case "suite":
+            sys.exit(benchmark_suite(args.depth, args.baseline, args.update, args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
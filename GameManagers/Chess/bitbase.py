@@ -0,0 +1,226 @@
+"""
+Endgame bitbases for the chess AI, so positions with only a king and one queen, rook or pawn against a lone king are a
+lookup instead of a search.
+
+The tables are built by retrograde analysis: positions where the lone king is checkmated are wins, a position with the
+stronger side to move is a win if any move reaches a win, and a position with the lone king to move is a win if every
+move does. This is repeated until nothing changes, and whatever is left is a draw.
+Each table stores one bit per position, whether the stronger side wins, with the stronger side normalised to white.
+Build the file with:
+    python -m GameManagers.Chess.bitbase --output chess_bitbase.bin
+"""
+import argparse
+import os
+import threading
+import time
+from array import array
+
+import chess
+import numpy
+
+from loguru import logger as logging
+
+DEFAULT_BITBASE_PATH = "chess_bitbase.bin"
+
+# The tables in the order they are stored in the file. KPK is built last as pawns promote into the other two.
+PIECE_TYPES = (chess.QUEEN, chess.ROOK, chess.PAWN)
+POSITIONS = 2 * 64 * 64 * 64  # Side to move, strong king, weak king and piece squares
+TABLE_BYTES = POSITIONS // 8
+
+
+def position_index(strong_to_move, strong_king, weak_king, piece):
+    """
+    Returns the index of a position in a table, with the stronger side playing white
+    :param strong_to_move: Whether the stronger side is to move
+    :param strong_king: The square of the stronger side's king
+    :param weak_king: The square of the lone king
+    :param piece: The square of the stronger side's other piece
+    :return:
+    """
+    return strong_to_move << 18 | strong_king << 12 | weak_king << 6 | piece
+
+
+def piece_attacks(piece_type, square, occupied):
+    """
+    Returns the squares a white queen, rook or pawn attacks
+    :param piece_type: The piece type
+    :param square: The square of the piece
+    :param occupied: The occupied squares, which block sliding pieces
+    :return: A bitboard
+    """
+    if piece_type == chess.PAWN:
+        return chess.BB_PAWN_ATTACKS[chess.WHITE][square]
+    attacks = chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied] | \
+        chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied]
+    if piece_type == chess.QUEEN:
+        attacks |= chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied]
+    return attacks
+
+
+def generate_table(piece_type, promotion_tables=None):
+    """
+    Builds the table of an endgame
+    :param piece_type: The stronger side's piece
+    :param promotion_tables: For KPK, a dictionary of the finished tables of the pieces a pawn can promote to
+    :return: A numpy array of POSITIONS booleans, whether the stronger side wins
+    """
+    # The moves between positions, stored as parallel arrays of the position before and after
+    sources = array("I")
+    targets = array("I")
+    strong_to_move = numpy.zeros(POSITIONS, dtype=bool)
+    wins = numpy.zeros(POSITIONS, dtype=bool)
+    # Positions the stronger side wins by promoting, and positions where the lone king can capture the piece
+    promotes = numpy.zeros(POSITIONS, dtype=bool)
+    escapes = numpy.zeros(POSITIONS, dtype=bool)
+
+    pawn = piece_type == chess.PAWN
+    for strong_king in chess.SQUARES:
+        strong_king_attacks = chess.BB_KING_ATTACKS[strong_king]
+        for weak_king in chess.SQUARES:
+            if weak_king == strong_king or strong_king_attacks & chess.BB_SQUARES[weak_king]:
+                continue
+            weak_king_attacks = chess.BB_KING_ATTACKS[weak_king]
+            for piece in chess.SQUARES:
+                if piece in (strong_king, weak_king) or (pawn and not 8 <= piece < 56):
+                    continue
+                piece_mask = chess.BB_SQUARES[piece]
+                occupied = chess.BB_SQUARES[strong_king] | chess.BB_SQUARES[weak_king] | piece_mask
+                attacks = piece_attacks(piece_type, piece, occupied)
+                in_check = bool(attacks & chess.BB_SQUARES[weak_king])
+
+                # The stronger side to move, which is only legal if the lone king is not in check
+                if not in_check:
+                    index = position_index(1, strong_king, weak_king, piece)
+                    strong_to_move[index] = True
+                    for to_square in chess.scan_forward(strong_king_attacks & ~weak_king_attacks & ~occupied):
+                        sources.append(index)
+                        targets.append(position_index(0, to_square, weak_king, piece))
+                    if not pawn:
+                        for to_square in chess.scan_forward(attacks & ~occupied):
+                            sources.append(index)
+                            targets.append(position_index(0, strong_king, weak_king, to_square))
+                    elif not occupied & chess.BB_SQUARES[piece + 8]:
+                        if piece + 8 >= 56:
+                            promotes[index] = any(table[position_index(0, strong_king, weak_king, piece + 8)]
+                                                  for table in promotion_tables.values())
+                        else:
+                            sources.append(index)
+                            targets.append(position_index(0, strong_king, weak_king, piece + 8))
+                            if piece < 16 and not occupied & chess.BB_SQUARES[piece + 16]:
+                                sources.append(index)
+                                targets.append(position_index(0, strong_king, weak_king, piece + 16))
+
+                # The lone king to move. Sliding pieces still attack the squares behind the king once it moves away.
+                index = position_index(0, strong_king, weak_king, piece)
+                attacked = strong_king_attacks | piece_attacks(piece_type, piece, occupied & ~chess.BB_SQUARES[weak_king])
+                moves = weak_king_attacks & ~attacked & ~chess.BB_SQUARES[strong_king]
+                if not moves:
+                    wins[index] = in_check  # Checkmate, otherwise stalemate
+                for to_square in chess.scan_forward(moves):
+                    if to_square == piece:
+                        escapes[index] = True  # Capturing the piece is a draw
+                    else:
+                        sources.append(index)
+                        targets.append(position_index(1, strong_king, to_square, piece))
+
+    sources = numpy.frombuffer(sources, dtype=numpy.uint32)
+    targets = numpy.frombuffer(targets, dtype=numpy.uint32)
+    moves = numpy.bincount(sources, minlength=POSITIONS)
+    weak_can_win = ~strong_to_move & ~escapes & (moves > 0)
+    while True:
+        winning_moves = numpy.bincount(sources, weights=wins[targets], minlength=POSITIONS)
+        updated = wins | (strong_to_move & ((winning_moves > 0) | promotes)) | \
+            (weak_can_win & (winning_moves == moves))
+        if numpy.array_equal(updated, wins):
+            return wins
+        wins = updated
+
+
+def generate_bitbase(path):
+    """
+    Builds every table and writes them to a file
+    :param path: The path to write to
+    :return:
+    """
+    tables = {}
+    for piece_type in PIECE_TYPES:
+        start = time.perf_counter()
+        promotion_tables = {promotion: tables[promotion] for promotion in (chess.QUEEN, chess.ROOK)} \
+            if piece_type == chess.PAWN else None
+        tables[piece_type] = generate_table(piece_type, promotion_tables)
+        logging.info(f"Built K{chess.piece_symbol(piece_type).upper()}K with {tables[piece_type].sum()} wins "
+                     f"in {time.perf_counter() - start:.1f}s")
+    with open(path, "wb") as bitbase:
+        for piece_type in PIECE_TYPES:
+            bitbase.write(numpy.packbits(tables[piece_type], bitorder="little").tobytes())
+
+
+class Bitbase:
+    """
+    Looks up whether the stronger side wins a position in the bitbase file
+    """
+
+    _default = None  # type: Bitbase | None
+    _default_lock = threading.Lock()
+
+    def __init__(self, path=DEFAULT_BITBASE_PATH):
+        """
+        :param path: The path of the bitbase file, if it does not exist no positions are covered
+        """
+        self.path = path
+        self.tables = {}  # type: dict[chess.PieceType, bytes]
+        if os.path.isfile(path):
+            with open(path, "rb") as bitbase:
+                data = bitbase.read()
+            if len(data) != len(PIECE_TYPES) * TABLE_BYTES:
+                logging.warning(f"Ignoring bitbase {path}, it is {len(data)} bytes instead of "
+                                f"{len(PIECE_TYPES) * TABLE_BYTES}")
+            else:
+                for number, piece_type in enumerate(PIECE_TYPES):
+                    self.tables[piece_type] = data[number * TABLE_BYTES:(number + 1) * TABLE_BYTES]
+                logging.info(f"Loaded endgame bitbase {path}")
+
+    @classmethod
+    def get_default(cls):
+        """
+        Returns the bitbase at DEFAULT_BITBASE_PATH, which is loaded once and shared by every AI in the process
+        :return:
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def probe(self, chessboard: chess.Board):
+        """
+        Looks up a position
+        :param chessboard: The chessboard
+        :return: True if the side with the queen, rook or pawn wins, False if it is a draw, or None if the position is
+         not covered
+        """
+        if not self.tables or chessboard.uci_variant != "chess" or chessboard.castling_rights or \
+                chess.popcount(chessboard.occupied) != 3:
+            return None
+        piece = chess.msb(chessboard.occupied & ~chessboard.kings)
+        table = self.tables.get(chessboard.piece_type_at(piece))
+        if table is None:
+            return None
+        strong = chessboard.color_at(piece)
+        strong_king = chessboard.king(strong)
+        weak_king = chessboard.king(not strong)
+        if strong == chess.BLACK:
+            strong_king, weak_king, piece = (chess.square_mirror(square) for square in (strong_king, weak_king, piece))
+        index = position_index(chessboard.turn == strong, strong_king, weak_king, piece)
+        return bool(table[index >> 3] >> (index & 7) & 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the chess AI endgame bitbase")
+    parser.add_argument("--output", default=DEFAULT_BITBASE_PATH)
+    args = parser.parse_args()
+    generate_bitbase(args.output)
+    logging.info(f"Wrote {os.path.getsize(args.output)} bytes to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
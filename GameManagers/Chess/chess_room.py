@@ -3,14 +3,18 @@ import random
 import threading
 import time
 import traceback
+from concurrent.futures import CancelledError
 
 import chess
 import chess.variant
 
 from GameManagers.base_room import BaseRoom
+from GameManagers.clock import GameClock
 from loguru import logger as logging
 
 from .ai import ChessAI
+from .live_analysis import LiveAnalysis
+from .parallel_search import ParallelRootSearch
 
 
 class Chess(BaseRoom):
@@ -25,41 +29,47 @@ class Chess(BaseRoom):
         if starting_config is None:
             starting_config = {}
 
+        # How strong, and so how expensive to run, the AI players of this room are, see ChessAI.DIFFICULTIES
+        self.ai_difficulty = starting_config["ai_difficulty"] if "ai_difficulty" in starting_config \
+            else ChessAI.DEFAULT_DIFFICULTY
+        if not isinstance(self.ai_difficulty, str) or self.ai_difficulty not in ChessAI.DIFFICULTIES:
+            logging.warning(f"Unknown AI difficulty {self.ai_difficulty}, using {ChessAI.DEFAULT_DIFFICULTY}")
+            self.ai_difficulty = ChessAI.DEFAULT_DIFFICULTY
+        # The maximum time in seconds the AI players of this room can spend on each move, None uses the difficulty's.
+        # It can only shorten the difficulty's limit, so a room can not ask for a longer search.
+        self.ai_time_limit = self.get_number_config(starting_config, "ai_time_limit", None,
+                                                    minimum=ChessAI.MIN_TIME_LIMIT,
+                                                    maximum=ChessAI.DIFFICULTIES[self.ai_difficulty]["time_limit"])
+        # The number of processes each AI move is split across, and an optional seed to make the AI repeatable
+        self.ai_workers = self.get_number_config(starting_config, "ai_workers", 1, minimum=1,
+                                                 maximum=ParallelRootSearch.get_max_workers(), integer=True)
+        self.ai_seed = starting_config["ai_seed"] if "ai_seed" in starting_config else None
+        self.ai_opening_book = starting_config["ai_opening_book"] if "ai_opening_book" in starting_config else True
+        self.ai_bitbase = starting_config["ai_bitbase"] if "ai_bitbase" in starting_config else True
+        # The least time in seconds between the moves of two AI players, so that spectators can follow their game
+        self.ai_move_delay = starting_config["ai_move_delay"] if "ai_move_delay" in starting_config else 1
+        # Whether the AI moves are searched by the server's AI worker pool
+        self.ai_pool = starting_config["ai_pool"] if "ai_pool" in starting_config else True
+        # Whether the AI keeps searching while a human player is thinking
+        self.ai_ponder = starting_config["ai_ponder"] if "ai_ponder" in starting_config else False
+        # Whether everyone in the room is shown an engine evaluation and expected line of the current position
+        self.evaluation_bar = starting_config["evaluation_bar"] if "evaluation_bar" in starting_config else False
+
         if from_save:
             self.load_game(from_save, **kwargs)
         else:
             self.state = "Waiting..."
             self.variant = starting_config["chess_variant"] if "chess_variant" in starting_config else "chess_variant"
-            match self.variant:
-                case "Standard":
-                    self.board = chess.Board()
-                case "Chess960":
-                    self.board = chess.Board(chess960=True)
-                    self.board.set_chess960_pos(random.randint(0, 959))
-                case "Suicide":
-                    self.board = chess.variant.SuicideBoard()
-                case "Crazyhouse":
-                    self.board = chess.variant.CrazyhouseBoard()
-                case "Three Check":
-                    self.board = chess.variant.ThreeCheckBoard()
-                case "Atomic":
-                    self.board = chess.variant.AtomicBoard()
-                case "Antichess":
-                    self.board = chess.variant.AntichessBoard()
-                case "Horde":
-                    self.board = chess.variant.HordeBoard()
-                case "King of the Hill":
-                    self.board = chess.variant.KingOfTheHillBoard()
-                case "Racing Kings":
-                    self.board = chess.variant.RacingKingsBoard()
-                case _:
-                    self.board = chess.Board()
+            self.board = self.create_board(self.variant)
+            self.update_legal_moves()
 
             self.max_users = 2
 
             self.timers_enabled = starting_config["timers_enabled"] if "timers_enabled" in starting_config else False
-            self.move_timers = [datetime.timedelta(seconds=starting_config["white_time"] if "white_time" in starting_config else 5),
-                                datetime.timedelta(seconds=starting_config["black_time"] if "black_time" in starting_config else 5)]
+            # The clocks of white and black, which only start after the first move
+            self.clock = GameClock([starting_config["white_time"] if "white_time" in starting_config else 5,
+                                    starting_config["black_time"] if "black_time" in starting_config else 5],
+                                   self.flag_fall)
             self.time_added_per_move = \
                 datetime.timedelta(seconds=starting_config["time_added_per_move"] if "time_added_per_move" in starting_config else 10)
 
@@ -67,19 +77,67 @@ class Chess(BaseRoom):
             self.game_over = False
             self.last_move = None
             self.spectators.append(self.users[0])
-            self.users = [ChessAI(self.board, self, chess.WHITE), ChessAI(self.board, self, chess.BLACK)]
+            self.users = [self.create_ai(chess.WHITE), self.create_ai(chess.BLACK)]
             self.current_player = self.users[0]
             self.taken_pieces = {"white": [], "black": []}
 
-        threading.Thread(target=self.timer_thread, daemon=True).start()
         threading.Thread(target=self.chess_ai_thread, daemon=True).start()
 
+    @staticmethod
+    def create_board(variant):
+        """
+        Creates the starting board of a variant
+        :param variant: The name of the variant, a random starting position is chosen for Chess960
+        :return:
+        """
+        match variant:
+            case "Standard":
+                board = chess.Board()
+            case "Chess960":
+                board = chess.Board(chess960=True)
+                board.set_chess960_pos(random.randint(0, 959))
+            case "Suicide":
+                board = chess.variant.SuicideBoard()
+            case "Crazyhouse":
+                board = chess.variant.CrazyhouseBoard()
+            case "Three Check":
+                board = chess.variant.ThreeCheckBoard()
+            case "Atomic":
+                board = chess.variant.AtomicBoard()
+            case "Antichess":
+                board = chess.variant.AntichessBoard()
+            case "Horde":
+                board = chess.variant.HordeBoard()
+            case "King of the Hill":
+                board = chess.variant.KingOfTheHillBoard()
+            case "Racing Kings":
+                board = chess.variant.RacingKingsBoard()
+            case _:
+                board = chess.Board()
+        return board
+
+    def create_ai(self, color):
+        """
+        Creates an AI player using this room's AI settings
+        :param color: The color the AI plays
+        :return:
+        """
+        return ChessAI(self.board, self, color, difficulty=self.ai_difficulty, time_limit=self.ai_time_limit,
+                       workers=self.ai_workers, seed=self.ai_seed, opening_book=self.ai_opening_book,
+                       bitbase=self.ai_bitbase, ponder=self.ai_ponder, use_pool=self.ai_pool)
+
     def database_init(self):
         # Create the table to save chess games if it doesn't exist
         self.database.run("CREATE TABLE IF NOT EXISTS chess_game_saves ("
                           "game_id TEXT PRIMARY KEY, board_epd TEXT, white_hash TEXT, black_hash TEXT, "
                           "current_player TEXT, last_move TEXT, white_time_remaining INTEGER, black_time_remaining INTEGER,"
-                          "time_added_per_move INTEGER, timers_enabled BOOLEAN)")
+                          "time_added_per_move INTEGER, timers_enabled BOOLEAN, variant TEXT, starting_fen TEXT, "
+                          "moves TEXT)")
+        # Saves from before the moves were kept only have the final position, add the columns they are missing
+        columns = [column[1] for column in self.database.get("PRAGMA table_info(chess_game_saves)")]
+        for column in ("variant TEXT", "starting_fen TEXT", "moves TEXT"):
+            if column.split()[0] not in columns:
+                self.database.run(f"ALTER TABLE chess_game_saves ADD COLUMN {column}")
 
     def user_join(self, user):
         # Check if the user is already in the room
@@ -100,14 +158,18 @@ class Chess(BaseRoom):
         Data that is sent to the client every second
         :return:
         """
-        return {
+        update = {
             "players": [user.encode() for user in self.users],
             "spectators": [user.encode() for user in self.spectators],
-            "move_timers": [timer.total_seconds() for timer in self.move_timers],
+            "move_timers": self.clock.get_remaining(),
         }
+        if self.evaluation_bar:
+            # Every user in the room polls this, but each position is only analysed once, in the background
+            update["evaluation"] = LiveAnalysis.get_default().request(self.board)
+        return update
 
     def get_board_state(self, user):
-        return {
+        state = {
             "your_color": chess.WHITE if user == self.users[0] else chess.BLACK if user in self.users else None,
             "current_player": chess.WHITE if self.board.turn == chess.WHITE else chess.BLACK,
             "board": self.board.epd(hmvc=self.board.halfmove_clock, fmvn=self.board.fullmove_number),
@@ -118,12 +180,40 @@ class Chess(BaseRoom):
             "variant": self.variant,
             "taken_pieces": self.taken_pieces
         }
+        if user == self.current_player and not self.game_over:
+            # The player to move is sent their moves, so their client can reject illegal moves without a request
+            state["legal_moves"] = list(self.legal_moves)
+        return state
+
+    def get_ai_statistics(self):
+        return {
+            "room_id": self.room_id,
+            "name": self.name,
+            "type": self.__class__.__name__,
+            "variant": self.variant,
+            "players": [user.get_search_statistics() for user in self.users if isinstance(user, ChessAI)],
+        }
+
+    def update_legal_moves(self):
+        """
+        Works out the legal moves of the current position once, after every move, so that validating moves, checking
+        whether the game is over and sending the moves to the player do not each generate them again
+        :return:
+        """
+        self.legal_moves = {move.uci(): move for move in self.board.legal_moves}  # type: dict[str, chess.Move]
 
     def check_win_conditions(self):
-        if self.board.is_checkmate():
+        if self.board.uci_variant == "chess":
+            # Standard chess and Chess960 end in checkmate or stalemate exactly when there are no legal moves
+            checkmate = not self.legal_moves and self.board.is_check()
+            stalemate = not self.legal_moves and not checkmate
+        else:
+            checkmate = self.board.is_checkmate()
+            stalemate = self.board.is_stalemate()
+        if checkmate:
             self.state = "Checkmate"
             return True
-        elif self.board.is_stalemate():
+        elif stalemate:
             self.state = "Stalemate"
             return True
         elif self.board.is_insufficient_material():
@@ -152,24 +242,20 @@ class Chess(BaseRoom):
                 return True
         return False
 
-    def timer_thread(self):
+    def flag_fall(self, player):
         """
-        This function is called every second and updates the timers if they are enabled
+        Ends the game when a player's clock runs out, called by the clock scheduler
+        :param player: The index of the player, 0 for white and 1 for black
         :return:
         """
-        while self.timers_enabled:
-            # Only start the timer after the first move
-            if not self.board.move_stack:
-                time.sleep(1)
-                continue
-
-            if self.move_timers[0] <= datetime.timedelta(seconds=0) or self.move_timers[1] <= datetime.timedelta(seconds=0):
-                self.state = "Time Up"
-                self.game_over = True
-            else:
-                self.move_timers[0] -= datetime.timedelta(seconds=1) if self.board.turn == chess.WHITE else datetime.timedelta()
-                self.move_timers[1] -= datetime.timedelta(seconds=1) if self.board.turn == chess.BLACK else datetime.timedelta()
-            time.sleep(1)
+        with self.turn_changed:
+            if self.game_over:
+                return
+            self.state = "Time Up"
+            self.game_over = True
+            self.turn_changed.notify_all()
+        for user in self.users + self.spectators:
+            user.room_updated = True
 
     def chess_ai_thread(self):
         """
@@ -179,21 +265,34 @@ class Chess(BaseRoom):
         """
         ai_exceptions = 0
         while not self.game_over:
+            # Sleep until post_move makes it an AI's turn or the game ends
+            self.wait_for_turn(lambda: self.game_over or isinstance(self.current_player, ChessAI))
             try:
-                if isinstance(self.current_player, ChessAI):
+                if not self.game_over and isinstance(self.current_player, ChessAI):
                     # self.last_move = self.board.peek()
                     # self.users[1].update_player_move(self.board.peek())
-                    # start_time = time.time()
-                    ai_move = self.current_player.get_ai_move(self.board)
-
-                    logging.info(self.current_player.ai_move_debug())
-                    self.post_move(self.current_player, ai_move)
+                    start_time = time.monotonic()
+                    ai_player = self.current_player
+                    ai_move = ai_player.get_ai_move(self.board)
+
+                    logging.info(ai_player.ai_move_debug())
+                    self.post_move(ai_player, ai_move)
+                    if not self.game_over and not isinstance(self.current_player, ChessAI):
+                        # Use the human's thinking time to prepare the next move
+                        ai_player.start_pondering(self.board)
+                    elif not self.game_over:
+                        # Pace games between AIs here, post_move is also called by the request handlers and must not
+                        # block them
+                        time.sleep(max(self.ai_move_delay - (time.monotonic() - start_time), 0))
+            except CancelledError:
+                break  # The room was closed while the AI worker pool was searching its move
             except Exception as e:
                 logging.exception(e)
                 ai_exceptions += 1
                 if ai_exceptions >= 5:
                     self.state = "[red]AI Error[/red]"
                     self.game_over = True
+                    self.notify_turn_changed()
                     self.users[1].online = False
                     for player in self.users + self.spectators:
                         player.room_updated = True
@@ -203,19 +302,22 @@ class Chess(BaseRoom):
         # When the game is over, set the AI to offline
         for player in self.users + self.spectators:
             if isinstance(player, ChessAI):
+                player.stop_pondering()
                 player.online = False
             player.room_updated = True
 
+    def close(self):
+        with self.turn_changed:
+            self.game_over = True
+            self.clock.stop()
+        super().close()
+
     def check_if_capture(self, move):
         """
         Checks if the move will capture a piece and adds it to the taken pieces list
-        :param move: The move to check in UCI format
+        :param move: The legal move to check
         :return:
         """
-        move = chess.Move.from_uci(move)
-        # Check if the move is valid
-        if move not in self.board.legal_moves:
-            return False
         if self.board.is_capture(move):
             # print(f"Move {move.uci()} is a capture")
             piece = self.board.piece_at(move.to_square)
@@ -237,12 +339,19 @@ class Chess(BaseRoom):
                          f"{self.current_player.username}")
             return {"error": "out_of_turn"}
 
+        if self.game_over:
+            logging.info(f"User {user.username} tried to move after the game ended")
+            return {"error": "game_over"}
+
         for player in self.users + self.spectators:
             player.room_updated = True
 
         try:
-            self.check_if_capture(move)
-            self.board.push_uci(move)
+            legal_move = self.legal_moves.get(move)
+            if legal_move is None:
+                # Raises the error for the move, or accepts it if it is written in another notation, like castling
+                # written as the king capturing its own rook
+                legal_move = self.board.parse_uci(move)
         except chess.IllegalMoveError:
             logging.info(f"User {user.username} tried to make an illegal move")
             return {"error": "illegal_move"}
@@ -253,28 +362,34 @@ class Chess(BaseRoom):
             logging.info(f"User {user.username} cause an unknown error: {e}{traceback.format_exc()}")
             return {"error": "unknown_error"}
 
+        # Add the time to the player who moved and start the clock of the other, before the move is made so that a
+        # move that arrives after the player's time ran out is not played
+        if self.timers_enabled and not self.clock.press(0 if self.board.turn == chess.WHITE else 1,
+                                                        self.time_added_per_move.total_seconds()):
+            logging.info(f"User {user.username} tried to move after their time ran out")
+            return {"error": "game_over"}  # flag_fall ends the game
+
+        self.check_if_capture(legal_move)
+        self.board.push(legal_move)
+        self.update_legal_moves()
         self.last_move = move
         self.state = "In Progress"
 
-        # Update the timers
-        if self.timers_enabled:
-            self.move_timers[0] += self.time_added_per_move if self.board.turn == chess.BLACK else datetime.timedelta()
-            self.move_timers[1] += self.time_added_per_move if self.board.turn == chess.WHITE else datetime.timedelta()
-
-        if len(self.users) == 2:
-            self.current_player = self.users[1] if self.current_player == self.users[0] else self.users[0]
-        else:
-            # Add an AI player
-            logging.info(f"Adding an AI player to room {self.room_id}")
-            self.users.append(ChessAI(self.board, self, chess.BLACK))
-            self.current_player = self.users[1]
-            threading.Thread(target=self.chess_ai_thread, daemon=True).start()
-
-        if self.check_win_conditions():
-            self.game_over = True
-            return {"result": "success"}
+        # The turn and the end of the game change together, so a waiting AI never sees its turn in a finished game
+        with self.turn_changed:
+            if len(self.users) == 2:
+                self.current_player = self.users[1] if self.current_player == self.users[0] else self.users[0]
+            else:
+                # Add an AI player
+                logging.info(f"Adding an AI player to room {self.room_id}")
+                self.users.append(self.create_ai(chess.BLACK))
+                self.current_player = self.users[1]
+                threading.Thread(target=self.chess_ai_thread, daemon=True).start()
 
-        time.sleep(1)
+            if self.check_win_conditions():
+                self.game_over = True
+                self.clock.stop()
+            self.turn_changed.notify_all()
 
         return {"result": "success"}
 
@@ -283,14 +398,21 @@ class Chess(BaseRoom):
         Saves the game to the database to be able to be loaded later
         :return:
         """
-        self.database.run("INSERT INTO chess_game_saves VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        # Saving the game again replaces its earlier save
+        self.database.run("INSERT OR REPLACE INTO chess_game_saves (game_id, board_epd, white_hash, black_hash, "
+                          "current_player, last_move, white_time_remaining, black_time_remaining, time_added_per_move, "
+                          "timers_enabled, variant, starting_fen, moves) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                           (self.room_id, self.board.epd(hmvc=self.board.halfmove_clock,
                                                         fmvn=self.board.fullmove_number),
                            self.users[0].hash_id, self.users[1].hash_id if len(self.users) == 2 else None,
                            self.board.turn, self.last_move,
-                           self.move_timers[0].total_seconds(), self.move_timers[1].total_seconds(),
-                           self.time_added_per_move.total_seconds(), self.timers_enabled))
-        self.database.run("INSERT INTO room_saves VALUES (?, ?, ?, ?)", (self.room_id, self.__class__.__name__, self.name, self.password))
+                           *self.clock.get_remaining(),
+                           self.time_added_per_move.total_seconds(), self.timers_enabled,
+                           # The moves let the game be replayed, for repetitions and the analysis of saved games
+                           self.variant, self.board.root().fen(),
+                           " ".join(move.uci() for move in self.board.move_stack)))
+        self.database.run("INSERT OR REPLACE INTO room_saves VALUES (?, ?, ?, ?)",
+                          (self.room_id, self.__class__.__name__, self.name, self.password))
         return {"room_id": self.room_id, "room_type": "chess"}
 
     @classmethod
@@ -325,13 +447,24 @@ class Chess(BaseRoom):
         if len(game) == 0:
             raise ValueError("Game not found")
         game = game[0]
-        self.board = chess.Board()
-        self.board.turn = game[4]
-        self.board.set_epd(game[1])
+        self.variant = game[10] if game[10] is not None else "Standard"
+        if game[12] is not None:
+            # Replay the moves, so the board has the game's history
+            self.board = self.create_board(self.variant)
+            self.board.set_fen(game[11])
+            for move in game[12].split():
+                self.board.push_uci(move)
+        else:
+            self.board = chess.Board()
+            self.board.turn = game[4]
+            self.board.set_epd(game[1])
+        self.update_legal_moves()
         self.last_move = game[5]
-        self.move_timers = [game[6], game[7]]
-        self.time_added_per_move = game[8]
+        self.clock = GameClock([game[6], game[7]], self.flag_fall)
+        self.time_added_per_move = datetime.timedelta(seconds=game[8])
         self.timers_enabled = True if game[9] == 1 else False
+        if self.timers_enabled and self.board.move_stack:
+            self.clock.start(0 if self.board.turn == chess.WHITE else 1)
         self.state = "In Progress"
 
         self.users = [users.get_user(game[2])]
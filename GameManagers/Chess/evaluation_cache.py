@@ -0,0 +1,235 @@
+"""
+A process wide cache of static evaluations, shared by every chess AI so that rooms reaching the same positions, like
+the starting position and popular openings, only evaluate them once.
+
+The memory cap defaults to the CHESS_EVAL_CACHE_MB environment variable, or 64MB, and can be changed with
+configure_evaluation_cache.
+"""
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+import numpy
+
+DEFAULT_MAX_BYTES = int(os.environ.get("CHESS_EVAL_CACHE_MB", 64)) * 1024 * 1024
+
+
+def position_key(chessboard, ai_color):
+    """
+    Returns the key of a position in the cache. It holds the same state as the zobrist hash (the pieces, the side to
+    move, the castling rights and the en passant square) but is built directly from the board's bitboards, which
+    is far cheaper than hashing the position in python.
+    :param chessboard: The chessboard
+    :param ai_color: The color of the AI the evaluation is for
+    :return:
+    """
+    return (chessboard.pawns, chessboard.knights, chessboard.bishops, chessboard.rooks, chessboard.queens,
+            chessboard.kings, chessboard.occupied_co[0], chessboard.occupied_co[1], chessboard.turn,
+            chessboard.castling_rights,
+            # a1 can never be an en passant square, and unlike None it hashes the same in every process
+            chessboard.ep_square or 0,
+            ai_color)
+
+
+class EvaluationCache:
+    """
+    A size bounded least recently used cache of evaluations, shared by the threads of a process
+    """
+
+    ENTRY_BYTES = 250  # Roughly how much memory one entry uses, including its key
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # type: OrderedDict[tuple, int]
+        self.max_entries = max(1, max_bytes // self.ENTRY_BYTES)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Looks up an evaluation
+        :param key: The key returned by position_key
+        :return: The score, or None if the position is not cached
+        """
+        with self.lock:
+            score = self.entries.get(key)
+            if score is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return score
+
+    def put(self, key, score):
+        """
+        Stores an evaluation, evicting the least recently used one if the cache is full
+        :param key: The key returned by position_key
+        :param score: The score
+        :return:
+        """
+        with self.lock:
+            self.entries[key] = score
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def resize(self, max_bytes):
+        """
+        Changes the memory cap of the cache
+        :param max_bytes: The number of bytes the cache can use
+        :return:
+        """
+        with self.lock:
+            self.max_entries = max(1, max_bytes // self.ENTRY_BYTES)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns the size and hit rate of the cache
+        :return:
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_entries * self.ENTRY_BYTES,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
+
+    def reset_after_fork(self):
+        # The lock may have been held by another thread when the process forked
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+class SharedEvaluationTable:
+    """
+    A fixed size table of evaluations in shared memory, used instead of the cache by worker processes so that they
+    can share evaluations with each other.
+    Every key has one slot. A slot holds the score and the score XORed with the key's hash, so a slot is only a hit
+    when the two still match the key. A read that races a write in another process sees a mismatch and is a miss,
+    never a wrong score, so no lock is needed between the processes.
+    """
+
+    SLOT_BYTES = 16
+    MASK = 0xFFFFFFFFFFFFFFFF
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, name=None):
+        """
+        :param max_bytes: The size of the table to create
+        :param name: The name of an existing table to attach to instead of creating one
+        """
+        if name is None:
+            slots = max(1, max_bytes // self.SLOT_BYTES)
+            self.memory = shared_memory.SharedMemory(create=True, size=slots * self.SLOT_BYTES)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.slots = self.memory.size // self.SLOT_BYTES
+        self.table = numpy.ndarray((self.slots, 2), dtype=numpy.uint64, buffer=self.memory.buf)
+        self.owner = name is None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Looks up an evaluation
+        :param key: The key returned by position_key
+        :return: The score, or None if the position is not in the table
+        """
+        key_hash = hash(key) & self.MASK
+        check, stored = self.table[key_hash % self.slots]
+        check, stored = int(check), int(stored)
+        if check ^ stored != key_hash:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return stored - (1 << 64) if stored >> 63 else stored
+
+    def put(self, key, score):
+        """
+        Stores an evaluation, replacing whatever was in its slot
+        :param key: The key returned by position_key
+        :param score: The score
+        :return:
+        """
+        key_hash = hash(key) & self.MASK
+        stored = score & self.MASK
+        self.table[key_hash % self.slots] = (key_hash ^ stored, stored)
+
+    def stats(self):
+        """
+        Returns the size of the table and the hit rate of this process
+        :return:
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": None,
+            "max_entries": self.slots,
+            "max_bytes": self.slots * self.SLOT_BYTES,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
+
+    def close(self):
+        """
+        Detaches from the table, and frees it if this process created it
+        :return:
+        """
+        del self.table
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+_cache = EvaluationCache()  # type: EvaluationCache | SharedEvaluationTable
+
+
+def get_evaluation_cache():
+    """
+    Returns the evaluation cache of this process
+    :return:
+    """
+    return _cache
+
+
+def configure_evaluation_cache(max_bytes):
+    """
+    Sets the memory cap of the evaluation cache of this process
+    :param max_bytes: The number of bytes the cache can use
+    :return:
+    """
+    if isinstance(_cache, EvaluationCache):
+        _cache.resize(max_bytes)
+
+
+def use_shared_table(name):
+    """
+    Makes this process use a shared evaluation table instead of its own cache. Used to initialise worker processes.
+    :param name: The name of the SharedEvaluationTable
+    :return:
+    """
+    global _cache
+    _cache = SharedEvaluationTable(name=name)
+
+
+def _reset_after_fork():
+    if isinstance(_cache, EvaluationCache):
+        _cache.reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,128 @@
+"""
+The evaluation bar of chess rooms. Positions are analysed by one background thread shared by every room, with a
+capped budget, and the results are cached by position, so a room with hundreds of spectators, or many rooms in the
+same opening, only costs one analysis per position.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import chess
+
+from loguru import logger as logging
+
+from .ai import ChessAI
+from .ai_logic import AI
+
+
+class LiveAnalysis:
+    """
+    Analyses the positions rooms ask about in a background thread, newest first, and caches the results
+    """
+
+    MAX_RESULTS = 10000  # How many analysed positions are cached
+    MAX_PENDING = 64  # How many positions can wait to be analysed, the oldest requests are dropped first
+    LINE_LENGTH = 8  # How many moves of the expected line are returned
+
+    _default = None  # type: LiveAnalysis | None
+    _default_lock = threading.Lock()
+
+    def __init__(self, depth=3, time_limit=2, node_limit=100000):
+        """
+        :param depth: The depth each position is searched to
+        :param time_limit: The most time in seconds each position can be searched for
+        :param node_limit: The most moves each position can check
+        """
+        self.depth = depth
+        self.time_limit = time_limit
+        self.node_limit = node_limit
+        self.condition = threading.Condition()
+        self.results = OrderedDict()  # type: OrderedDict[tuple, dict]
+        self.pending = OrderedDict()  # type: OrderedDict[tuple, chess.Board]
+        # An AI for each color, kept between positions so that following positions of a game reuse its searches
+        self.ais = {color: AI(color, seed=0) for color in chess.COLORS}
+        self.thread = threading.Thread(target=self.analysis_thread, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get_default(cls):
+        """
+        Returns the analysis shared by every room in the process, creating it if needed
+        :return:
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    @staticmethod
+    def get_key(chessboard: chess.Board):
+        """
+        Returns the key of a position in the cache, the zobrist hash of the position and its variant
+        :param chessboard: The chessboard
+        :return:
+        """
+        return chessboard.uci_variant, chessboard.chess960, AI.position_key(chessboard)
+
+    def request(self, chessboard: chess.Board):
+        """
+        Returns the analysis of a position, or queues the position to be analysed if it has not been yet
+        :param chessboard: The chessboard, it is copied before being queued
+        :return: A dictionary of the score from white's point of view, the expected line in uci and the depth
+         searched, or None if the position has not been analysed yet
+        """
+        key = self.get_key(chessboard)
+        with self.condition:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+                return result
+            if key not in self.pending:
+                self.pending[key] = AI.search_board(chessboard)
+                while len(self.pending) > self.MAX_PENDING:
+                    self.pending.popitem(last=False)
+                self.condition.notify()
+            return None
+
+    def analyse(self, chessboard: chess.Board):
+        """
+        Searches a position within the budget
+        :param chessboard: The chessboard
+        :return: The result, see request
+        """
+        if chessboard.is_game_over():
+            winner = chessboard.outcome().winner
+            score = 0 if winner is None else AI.MAX_DISPLAY_SCORE if winner == chess.WHITE else -AI.MAX_DISPLAY_SCORE
+            return {"score": score, "line": [], "depth": 0}
+        ai = self.ais[chessboard.turn]
+        move = ai.get_ai_move(chessboard, [], depth=self.depth, time_limit=self.time_limit,
+                              node_limit=self.node_limit)
+        return {
+            "score": AI.get_display_score(ai.best_move_score, ai.color),
+            "line": [line_move.uci() for line_move in ai.get_principal_variation(chessboard, move,
+                                                                                 self.LINE_LENGTH)],
+            "depth": ai.search_depth,
+        }
+
+    def analysis_thread(self):
+        """
+        Analyses the queued positions, newest first as those are the ones rooms are still showing
+        :return:
+        """
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                key, chessboard = self.pending.popitem()
+            # Analysis is optional, so it waits while the server has more work than it has cores
+            while ChessAI.server_under_load():
+                time.sleep(1)
+            try:
+                result = self.analyse(chessboard)
+            except Exception as e:
+                logging.exception(f"Failed to analyse {chessboard.fen()}: {e}")
+                continue
+            with self.condition:
+                self.results[key] = result
+                while len(self.results) > self.MAX_RESULTS:
+                    self.results.popitem(last=False)
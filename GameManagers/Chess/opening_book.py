@@ -0,0 +1,185 @@
+"""
+An opening book for the chess AI, so the first moves of a game are a lookup instead of a search.
+
+The book uses the polyglot format: 16 byte entries of (zobrist hash, move, weight, learn) sorted by hash, which is
+read through mmap and binary searched. Build a book from local PGN files and/or self-play games with:
+    python -m GameManagers.Chess.opening_book --pgn games.pgn --self-play 200 --output chess_book.bin
+"""
+import argparse
+import os
+import random
+import threading
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+from loguru import logger as logging
+
+DEFAULT_BOOK_PATH = "chess_book.bin"
+
+
+class OpeningBook:
+    """
+    Looks up moves for a position in a polyglot opening book file
+    """
+
+    _default = None  # type: OpeningBook | None
+    _default_lock = threading.Lock()
+
+    def __init__(self, path=DEFAULT_BOOK_PATH, max_ply=20):
+        """
+        :param path: The path of the book file, if it does not exist the book is empty
+        :param max_ply: The book is not used after this many moves have been played
+        """
+        self.path = path
+        self.max_ply = max_ply
+        self.reader = None
+        if os.path.isfile(path):
+            self.reader = chess.polyglot.open_reader(path)
+            logging.info(f"Loaded opening book {path} with {len(self.reader)} entries")
+
+    @classmethod
+    def get_default(cls):
+        """
+        Returns the book at DEFAULT_BOOK_PATH, which is opened once and shared by every AI in the process
+        :return:
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def get_move(self, chessboard: chess.Board, rng=None, exclude_moves=()):
+        """
+        Chooses a book move for the position, weighted by how often it was played, so games still vary
+        :param chessboard: The chessboard
+        :param rng: The random number generator to choose with, or None to use the random module
+        :param exclude_moves: Moves that should not be chosen
+        :return: The move, or None if the position is not in the book
+        """
+        # The ply is counted from the move number, as a search's copy of the board only keeps its last moves
+        if self.reader is None or chessboard.ply() >= self.max_ply:
+            return None
+        # Polyglot hashes only describe standard chess positions
+        if chessboard.uci_variant != "chess" or chessboard.chess960:
+            return None
+        try:
+            return self.reader.weighted_choice(chessboard, exclude_moves=exclude_moves, random=rng).move
+        except IndexError:
+            return None
+
+
+def encode_move(chessboard: chess.Board, move: chess.Move):
+    """
+    Encodes a move in the polyglot format, where castling is written as the king capturing its own rook
+    :param chessboard: The chessboard before the move
+    :param move: The move
+    :return: The 16 bit polyglot move
+    """
+    to_square = move.to_square
+    if chessboard.is_castling(move) and not chessboard.chess960:
+        rook_file = 7 if chess.square_file(move.to_square) > chess.square_file(move.from_square) else 0
+        to_square = chess.square(rook_file, chess.square_rank(move.from_square))
+    promotion = move.promotion - 1 if move.promotion else 0
+    return to_square | move.from_square << 6 | promotion << 12
+
+
+def add_game(counts, moves, result, max_ply):
+    """
+    Adds the moves of a game to the book counts, weighting each move by how well it worked out for its side
+    :param counts: A dictionary of (key, raw_move) to weight that is updated
+    :param moves: The moves of the game from the standard starting position
+    :param result: The result of the game, like "1-0"
+    :param max_ply: How many moves of the game to add
+    :return:
+    """
+    points = {"1-0": (2, 0), "0-1": (0, 2), "1/2-1/2": (1, 1)}.get(result)
+    if points is None:
+        return  # Unfinished games say nothing about the moves
+    board = chess.Board()
+    for move in moves[:max_ply]:
+        weight = points[0] if board.turn == chess.WHITE else points[1]
+        if weight:
+            entry = (chess.polyglot.zobrist_hash(board), encode_move(board, move))
+            counts[entry] = counts.get(entry, 0) + weight
+        board.push(move)
+
+
+def read_pgn_games(path):
+    """
+    Reads the standard chess games of a PGN file
+    :param path: The path of the PGN file
+    :return: An iterator of (moves, result)
+    """
+    with open(path, encoding="utf-8", errors="replace") as pgn:
+        while (game := chess.pgn.read_game(pgn)) is not None:
+            if game.headers.get("Variant", "Standard") != "Standard" or "FEN" in game.headers:
+                continue
+            yield list(game.mainline_moves()), game.headers.get("Result", "*")
+
+
+def play_self_play_game(max_ply, seed):
+    """
+    Plays a quick game between two AIs to fill the book when there are not enough PGN games
+    :param max_ply: How many moves of the game to play before it is scored
+    :param seed: The random seed, the AIs pick randomly between moves that score close to the best one
+    :return: A tuple of (moves, result)
+    """
+    from .ai_logic import AI, Heuristics
+
+    board = chess.Board()
+    players = {chess.WHITE: AI(chess.WHITE, seed=seed), chess.BLACK: AI(chess.BLACK, seed=seed + 1)}
+    while len(board.move_stack) < max_ply and not board.is_game_over():
+        board.push(players[board.turn].get_ai_move(board, [], depth=1, time_limit=5, margin=30))
+
+    if board.is_game_over():
+        return board.move_stack, board.result()
+    # Score the opening by the material balance it left, a pawn or more counts as a win
+    material = Heuristics.get_material_score(board, chess.WHITE)
+    return board.move_stack, "1-0" if material >= 100 else "0-1" if material <= -100 else "1/2-1/2"
+
+
+def write_book(counts, path):
+    """
+    Writes the book counts to a polyglot file, sorted by key so it can be binary searched
+    :param counts: A dictionary of (key, raw_move) to weight
+    :param path: The path to write to
+    :return:
+    """
+    # Weights are 16 bit, so scale them down if the most played move does not fit
+    scale = max(1, -(-max(counts.values(), default=0) // 0xFFFF))
+    with open(path, "wb") as book:
+        for (key, raw_move), weight in sorted(counts.items()):
+            book.write(chess.polyglot.ENTRY_STRUCT.pack(key, raw_move, max(1, weight // scale), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the chess AI opening book")
+    parser.add_argument("--pgn", nargs="*", default=[], help="PGN files to read games from")
+    parser.add_argument("--self-play", type=int, default=0, help="The number of self-play games to add")
+    parser.add_argument("--max-ply", type=int, default=20, help="How many moves of each game to add")
+    parser.add_argument("--min-weight", type=int, default=2, help="Moves with less weight than this are dropped")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=DEFAULT_BOOK_PATH)
+    args = parser.parse_args()
+
+    counts = {}
+    games = 0
+    for path in args.pgn:
+        for moves, result in read_pgn_games(path):
+            add_game(counts, moves, result, args.max_ply)
+            games += 1
+    rng = random.Random(args.seed)
+    for _ in range(args.self_play):
+        moves, result = play_self_play_game(args.max_ply, rng.getrandbits(32))
+        add_game(counts, moves, result, args.max_ply)
+        games += 1
+
+    counts = {entry: weight for entry, weight in counts.items() if weight >= args.min_weight}
+    write_book(counts, args.output)
+    logging.info(f"Wrote {len(counts)} entries from {games} games to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Splits the root moves of a chess AI search across worker processes, so that a search is not limited to the one
+core the GIL allows.
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+
+from . import evaluation_cache
+from .ai_logic import AI
+from .bitbase import Bitbase
+
+# The AIs of a worker process, kept between searches so their transposition tables can be reused.
+# Only used in the worker processes.
+_worker_ais = {}  # type: dict[chess.Color, AI]
+
+
+def search_root_moves(chessboard: chess.Board, color, root_moves, depth, deadline, node_limit, margin, seed, options,
+                      use_bitbase):
+    """
+    Runs an iteratively deepened search over some of the root moves. Called in a worker process.
+    :param chessboard: The chessboard
+    :param color: The color of the AI
+    :param root_moves: The root moves this worker is responsible for
+    :param depth: The maximum depth to search
+    :param deadline: The time.monotonic() time the search has to finish by
+    :param node_limit: The number of moves this worker can check, or None for no limit
+    :param margin: How much worse than the best move a move can score and still be chosen, see AI.get_ai_move
+    :param seed: If not None a fresh AI is used, so the result only depends on the arguments
+    :param options: The search techniques to use, see AI.search_options
+    :param use_bitbase: Whether to look up endgames in the default bitbase
+    :return: A tuple of (iterations, partial, statistics), see AI.iterative_search for the first two
+    """
+    if seed is not None:
+        ai = AI(color, seed=seed, **options)
+    else:
+        ai = _worker_ais.setdefault(color, AI(color))
+        for option, enabled in options.items():
+            setattr(ai, option, enabled)
+    ai.bitbase = Bitbase.get_default() if use_bitbase else None
+    ai.start_search(chessboard, deadline, node_limit, margin)
+    try:
+        iterations, partial = ai.iterative_search(chessboard, root_moves, depth)
+    finally:
+        ai.deadline = None
+        ai.node_limit = None
+    statistics = (ai.total_moves_checked, ai.cutoffs, ai.first_move_cutoffs,
+                  ai.highest_score_calculated, ai.lowest_score_calculated, ai.depth_times)
+    return iterations, partial, statistics
+
+
+class ParallelRootSearch:
+    """
+    Splits the root moves of a search evenly across a number of worker processes.
+    Each worker deepens its share of the moves on its own, and the deepest depth that every worker finished is used.
+    Every search runs in one pool with a process per core, so the number of processes does not grow with the number
+    of rooms or the worker counts they ask for.
+    """
+
+    _executor = None  # type: ProcessPoolExecutor | None
+    _evaluation_table = None  # type: evaluation_cache.SharedEvaluationTable | None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, workers):
+        """
+        :param workers: The number of worker processes the root moves are split across, use get to create a search
+        """
+        self.workers = workers
+
+    @staticmethod
+    def get_max_workers():
+        """
+        Returns the most workers a search can be split across, one per core
+        :return:
+        """
+        return os.cpu_count() or 1
+
+    @classmethod
+    def get(cls, workers):
+        """
+        Returns a parallel search with the given number of workers, starting the shared worker processes if needed
+        :param workers: The number of worker processes, kept between 1 and get_max_workers
+        :return:
+        """
+        workers = min(max(workers, 1), cls.get_max_workers())
+        with cls._executor_lock:
+            if cls._executor is None:
+                # The workers can not see the evaluation cache of this process, so they share a table in shared
+                # memory instead
+                cls._evaluation_table = evaluation_cache.SharedEvaluationTable()
+                atexit.register(cls._evaluation_table.close)
+                # Forking a server with running threads is not safe, so the workers are started from a clean fork
+                # server
+                cls._executor = ProcessPoolExecutor(max_workers=cls.get_max_workers(),
+                                                    mp_context=multiprocessing.get_context("forkserver"),
+                                                    initializer=evaluation_cache.use_shared_table,
+                                                    initargs=(cls._evaluation_table.name,))
+        return cls(workers)
+
+    def search(self, ai: AI, chessboard: chess.Board, root_moves, depth):
+        """
+        Searches the root moves across the worker processes
+        :param ai: The AI the search is for, its deadline, node limit, margin, seed, search options and statistics
+         are used
+        :param chessboard: The chessboard
+        :param root_moves: The root moves, in the order to search them
+        :param depth: The maximum depth to search
+        :return: A dictionary of the score of each root move that was scored
+        """
+        # Deal the moves out in turn so every worker gets a similar share of the likely best moves
+        shares = [share for share in (root_moves[worker::self.workers] for worker in range(self.workers)) if share]
+        # The node limit is split between the workers in proportion to their share of the moves
+        node_limits = [ai.node_limit * len(share) // len(root_moves) if ai.node_limit is not None else None
+                       for share in shares]
+        futures = [self._executor.submit(search_root_moves, chessboard, ai.color, share, depth, ai.deadline, node_limit,
+                                         ai.margin, ai.seed, ai.search_options, ai.bitbase is not None)
+                   for share, node_limit in zip(shares, node_limits)]
+        results = [future.result() for future in futures]
+
+        for _, _, (moves_checked, cutoffs, first_move_cutoffs, highest, lowest, _) in results:
+            ai.total_moves_checked += moves_checked
+            ai.cutoffs += cutoffs
+            ai.first_move_cutoffs += first_move_cutoffs
+            ai.highest_score_calculated = max(ai.highest_score_calculated, highest)
+            ai.lowest_score_calculated = min(ai.lowest_score_calculated, lowest)
+
+        finished = min((len(iterations) for iterations, _, _ in results), default=0)
+        scores = {}
+        for iterations, partial, _ in results:
+            # Scores from different depths can not be compared, so only the depth every worker finished is used
+            scores.update(iterations[finished - 1] if finished else iterations[0] if iterations else partial)
+        ai.search_depth = max(finished - 1, 0)
+        # A depth is only finished once the slowest worker finishes it
+        ai.depth_times = [max(times) for times in zip(*(statistics[5] for _, _, statistics in results))][:finished]
+        return scores
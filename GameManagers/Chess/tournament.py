@@ -0,0 +1,244 @@
+"""
+A headless self-play tournament between two chess AI configurations, played across a pool of processes, to measure
+what a change to the AI costs in time and gains in strength. Run from the server directory with:
+    python -m GameManagers.Chess.tournament --first difficulty=hard --second difficulty=hard,null_move_pruning=false
+
+A configuration is a comma separated list of options. difficulty picks one of ChessAI.DIFFICULTIES, which depth,
+node_limit, time_limit and margin override, and the other options are passed to the AI, see AI.__init__. The
+difficulty's table_size sets the size of the AI's transposition table.
+Each opening is played twice with the colors swapped, so neither configuration is favoured by the openings.
+"""
+import argparse
+import json
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import chess
+import chess.variant
+
+from .ai import ChessAI
+from .ai_logic import AI
+from .bitbase import Bitbase
+from .opening_book import OpeningBook
+
+# The options of a configuration that are used for each move instead of being passed to the AI
+MOVE_OPTIONS = ("depth", "node_limit", "time_limit", "margin")
+# The options of a difficulty that only the server's AI worker pool uses
+POOL_OPTIONS = ("priority",)
+
+
+def parse_configuration(text):
+    """
+    Parses a configuration from the command line
+    :param text: A comma separated list of option=value, values are read as JSON if they can be
+    :return: A dictionary of the options, with the difficulty expanded into the move options
+    """
+    options = {}
+    for option in filter(None, text.split(",")):
+        name, _, value = option.partition("=")
+        try:
+            options[name.strip()] = json.loads(value)
+        except json.JSONDecodeError:
+            options[name.strip()] = value.strip()
+    difficulty = options.pop("difficulty", ChessAI.DEFAULT_DIFFICULTY)
+    if difficulty not in ChessAI.DIFFICULTIES:
+        raise ValueError(f"Unknown difficulty {difficulty}, choose from {', '.join(ChessAI.DIFFICULTIES)}")
+    return dict(ChessAI.DIFFICULTIES[difficulty], **options)
+
+
+def create_ai(configuration, color, seed):
+    """
+    Creates the AI of a configuration
+    :param configuration: A configuration from parse_configuration
+    :param color: The color the AI plays
+    :param seed: The seed of the AI, so it chooses between equally good moves the same way every time
+    :return:
+    """
+    options = {name: value for name, value in configuration.items()
+               if name not in MOVE_OPTIONS and name not in POOL_OPTIONS}
+    # The difficulty's table size is the size of the AI's transposition table
+    if "table_size" in options:
+        options["transposition_table_size"] = options.pop("table_size")
+    opening_book = OpeningBook.get_default() if options.pop("opening_book", False) else None
+    bitbase = Bitbase.get_default() if options.pop("bitbase", True) else None
+    return AI(color, seed=seed, opening_book=opening_book, bitbase=bitbase, **options)
+
+
+def create_board(variant, fen=None, rng=random):
+    """
+    Creates a board of a variant
+    :param variant: The uci name of the variant, or chess960
+    :param fen: The position, or None for the starting position, which is random in chess960
+    :param rng: The random number generator to choose a chess960 starting position with
+    :return:
+    """
+    if variant == "chess960":
+        return chess.Board(fen, chess960=True) if fen else chess.Board.from_chess960_pos(rng.randint(0, 959))
+    board_type = chess.variant.find_variant(variant)
+    return board_type(fen) if fen else board_type()
+
+
+def random_opening(variant, plies, seed):
+    """
+    Plays random moves from the starting position, so the games of a tournament do not all repeat each other
+    :param variant: The uci name of the variant, or chess960
+    :param plies: The number of random moves to play
+    :param seed: The random seed
+    :return: A tuple of (starting fen, moves in uci)
+    """
+    rng = random.Random(seed)
+    board = create_board(variant, rng=rng)
+    fen = board.fen()
+    for _ in range(plies):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        board.push(rng.choice(moves))
+        if board.is_game_over():
+            board.pop()
+            break
+    return fen, [move.uci() for move in board.move_stack]
+
+
+def play_game(first, second, first_color, variant, fen, opening, max_plies, seed):
+    """
+    Plays one game between two configurations. Called in a worker process.
+    :param first: The configuration of the first AI
+    :param second: The configuration of the second AI
+    :param first_color: The color the first AI plays
+    :param variant: The uci name of the variant, or chess960
+    :param fen: The starting position
+    :param opening: The moves to play from the starting position before the AIs take over
+    :param max_plies: The game is adjudicated a draw after this many moves
+    :param seed: The seed of the AIs
+    :return: A dictionary with the score of the first AI and, for each AI, the moves it made and the CPU time and
+     nodes it spent on them
+    """
+    board = create_board(variant, fen)
+    for move in opening:
+        board.push_uci(move)
+    configurations = {first_color: first, not first_color: second}
+    players = {color: create_ai(configuration, color, seed) for color, configuration in configurations.items()}
+    statistics = {color: {"moves": 0, "cpu_time": 0, "nodes": 0, "depth": 0} for color in configurations}
+
+    while not board.is_game_over() and len(board.move_stack) < max_plies:
+        configuration = configurations[board.turn]
+        player = players[board.turn]
+        start = time.process_time()
+        move = player.get_ai_move(board, [], **{name: configuration[name] for name in MOVE_OPTIONS})
+        player_statistics = statistics[board.turn]
+        player_statistics["cpu_time"] += time.process_time() - start
+        player_statistics["moves"] += 1
+        player_statistics["nodes"] += player.total_moves_checked
+        player_statistics["depth"] += player.search_depth
+        board.push(move)
+
+    result = board.result() if board.is_game_over() else "1/2-1/2"
+    score = {"1-0": 1, "0-1": 0}.get(result, 0.5)
+    return {
+        "score": score if first_color == chess.WHITE else 1 - score,
+        "plies": len(board.move_stack),
+        "first": statistics[first_color],
+        "second": statistics[not first_color],
+    }
+
+
+def elo_difference(scores):
+    """
+    Estimates the Elo difference between two players from their game scores
+    :param scores: The scores of the first player, 1 for a win, 0.5 for a draw and 0 for a loss
+    :return: A tuple of (elo, lower, upper), the estimate and its 95% confidence interval, infinite when every game
+     was won or lost
+    """
+    def to_elo(score):
+        if score <= 0:
+            return -math.inf
+        if score >= 1:
+            return math.inf
+        return -400 * math.log10(1 / score - 1)
+
+    mean = sum(scores) / len(scores)
+    deviation = math.sqrt(sum((score - mean) ** 2 for score in scores) / len(scores))
+    error = 1.96 * deviation / math.sqrt(len(scores))
+    return to_elo(mean), to_elo(mean - error), to_elo(mean + error)
+
+
+def print_report(first_text, second_text, results):
+    """
+    Prints the results of the games played so far
+    :param first_text: The first configuration, as given on the command line
+    :param second_text: The second configuration, as given on the command line
+    :param results: The results of play_game
+    :return:
+    """
+    scores = [result["score"] for result in results]
+    wins = scores.count(1)
+    losses = scores.count(0)
+    elo, lower, upper = elo_difference(scores)
+    print(f"Games: {len(results)}  +{wins} ={len(results) - wins - losses} -{losses}  "
+          f"Score: {sum(scores) / len(scores):.1%}  Average length: "
+          f"{sum(result['plies'] for result in results) / len(results):.0f} plies")
+    print(f"Elo difference: {elo:+.1f} (95% confidence: {lower:+.1f} to {upper:+.1f})")
+    print(f"{'Configuration':<40} {'CPU/move (ms)':>13} {'Nodes/move':>11} {'Depth':>6}")
+    for player, text in (("first", first_text), ("second", second_text)):
+        moves = sum(result[player]["moves"] for result in results) or 1
+        cpu_time = sum(result[player]["cpu_time"] for result in results)
+        nodes = sum(result[player]["nodes"] for result in results)
+        depth = sum(result[player]["depth"] for result in results)
+        print(f"{text:<40} {cpu_time / moves * 1000:>13.1f} {nodes / moves:>11.0f} {depth / moves:>6.2f}")
+
+
+def run_tournament(first_text, second_text, games, workers, variant, opening_plies, max_plies, seed, report_every):
+    """
+    Plays the games of a tournament across a pool of worker processes, and reports the results
+    :param first_text: The first configuration, see parse_configuration
+    :param second_text: The second configuration
+    :param games: The number of games to play, rounded up to an even number so every opening is played with both colors
+    :param workers: The number of worker processes
+    :param variant: The uci name of the variant, or chess960
+    :param opening_plies: The number of random moves each opening starts with
+    :param max_plies: The game is adjudicated a draw after this many moves
+    :param seed: The random seed of the openings and the AIs
+    :param report_every: How many games are played between progress reports
+    :return:
+    """
+    first = parse_configuration(first_text)
+    second = parse_configuration(second_text)
+    rng = random.Random(seed)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for _ in range((games + 1) // 2):
+            game_seed = rng.getrandbits(32)
+            fen, opening = random_opening(variant, opening_plies, game_seed)
+            for first_color in (chess.WHITE, chess.BLACK):
+                futures.append(executor.submit(play_game, first, second, first_color, variant, fen, opening,
+                                               max_plies, game_seed))
+        for future in as_completed(futures):
+            results.append(future.result())
+            if len(results) % report_every == 0 and len(results) < len(futures):
+                print_report(first_text, second_text, results)
+                print()
+    print_report(first_text, second_text, results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Self-play tournament between two chess AI configurations")
+    parser.add_argument("--first", default="", help="The first configuration, like difficulty=hard,margin=10")
+    parser.add_argument("--second", default="", help="The second configuration")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=None, help="The number of processes, one per core by default")
+    parser.add_argument("--variant", default="chess", help="The uci name of the variant, like atomic or chess960")
+    parser.add_argument("--opening-plies", type=int, default=4, help="How many random moves each opening starts with")
+    parser.add_argument("--max-plies", type=int, default=300, help="Games are drawn after this many moves")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report-every", type=int, default=100, help="Report the results every this many games")
+    args = parser.parse_args()
+    run_tournament(args.first, args.second, args.games, args.workers, args.variant, args.opening_plies,
+                   args.max_plies, args.seed, args.report_every)
+
+
+if __name__ == '__main__':
+    main()
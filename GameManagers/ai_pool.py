@@ -0,0 +1,317 @@
+"""
+A server wide pool of AI worker processes that searches the moves of the AI players of every room.
+Searches run in processes instead of the room threads, so however many AIs are thinking they do not compete with the
+web server for the GIL. The workers are started when the pool is created, from a fork server that already has chess
+and numpy imported.
+
+Requests are queued per room and the pool only runs up to max_searches at a time. When a search finishes the next one
+comes from the room that has waited longest since it was last served, so one busy room can not hold the others back.
+Rooms with a higher priority are treated as if they had been waiting PRIORITY_WEIGHT more requests per step of
+priority, so they go ahead of the others without being able to starve them. Priorities are set by the server, not the
+rooms' clients, and are kept between MIN_PRIORITY and MAX_PRIORITY. The searches of a room that closes are cancelled,
+the queued ones straight away and the running ones at their next deadline check.
+"""
+import atexit
+import collections
+import functools
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from loguru import logger as logging
+
+# Imported by the fork server, so each worker starts with them already loaded
+PRELOAD_MODULES = ["chess", "chess.polyglot", "chess.variant", "numpy"]
+WAIT_HISTORY_LENGTH = 1000  # How many of the last waits are kept for the recent wait statistics
+MIN_PRIORITY = -2
+MAX_PRIORITY = 2
+PRIORITY_WEIGHT = 4  # How many requests of other rooms a room can go ahead of for each step of priority
+
+# The stop flags of the searches, and the flag of the search running in this worker. Only used in the worker processes.
+_stop_flags = None  # type: shared_memory.SharedMemory | None
+_stop_slot = None
+
+
+class StopFlag:
+    """
+    Whether a search running in a worker has been cancelled, used as the stop_event of the chess AI
+    """
+
+    def __init__(self, memory, slot):
+        self.memory = memory
+        self.slot = slot
+
+    def is_set(self):
+        return self.memory.buf[self.slot] != 0
+
+
+def initialize_worker(stop_flags_name):
+    """
+    Opens the stop flags in a new worker process
+    :param stop_flags_name: The name of the shared memory of the stop flags
+    :return:
+    """
+    global _stop_flags
+    _stop_flags = shared_memory.SharedMemory(name=stop_flags_name)
+
+
+def get_stop_flag():
+    """
+    Returns the stop flag of the search running in this worker, or None when not called from a pool worker
+    :return:
+    """
+    if _stop_flags is None or _stop_slot is None:
+        return None
+    return StopFlag(_stop_flags, _stop_slot)
+
+
+def run_request(function, args, slot):
+    """
+    Runs a request in a worker process
+    :param function: The function to run, it must be importable by the worker
+    :param args: The arguments of the function
+    :param slot: The index of the request's stop flag
+    :return: The result of the function
+    """
+    global _stop_slot
+    _stop_slot = slot
+    try:
+        return function(*args)
+    finally:
+        _stop_slot = None
+
+
+class AIRequest:
+    """
+    A function queued to run in the pool for a room
+    """
+
+    def __init__(self, room_id, priority, function, args):
+        self.room_id = room_id
+        self.priority = priority
+        self.function = function
+        self.args = args
+        self.future = Future()  # The result that the room waits on
+        self.submitted = time.monotonic()
+        self.slot = None  # The index of the stop flag while the request is running
+
+
+class AIWorkerPool:
+    """
+    Runs AI searches for every room in a shared pool of worker processes, with a fair queue between the rooms
+    """
+
+    _default = None  # type: AIWorkerPool | None
+    _default_lock = threading.Lock()
+
+    def __init__(self, workers=None, max_searches=None):
+        """
+        :param workers: The number of worker processes, by default one less than the number of cores so that one is
+         left for the web server
+        :param max_searches: The most searches that can run at once, the number of workers by default
+        """
+        self.workers = workers if workers is not None else max((os.cpu_count() or 1) - 1, 1)
+        self.max_searches = max_searches if max_searches is not None else self.workers
+        self.condition = threading.Condition()
+        self.queues = {}  # type: dict[str, collections.deque[AIRequest]]
+        self.priorities = {}  # type: dict[str, int] # The priority of each room's latest request
+        self.last_served = {}  # type: dict[str, int] # When each room last had a request started, as a sequence number
+        self.sequence = itertools.count()
+        self.running = {}  # type: dict[int, AIRequest] # The running requests by the index of their stop flag
+        self.free_slots = list(range(self.max_searches))
+        # The statistics reported by get_statistics
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.total_wait = 0
+        self.max_wait = 0
+        self.waits = collections.deque(maxlen=WAIT_HISTORY_LENGTH)
+
+        self.stop_flags = shared_memory.SharedMemory(create=True, size=self.max_searches)
+        atexit.register(self.close_stop_flags)
+        context = multiprocessing.get_context("forkserver")
+        # Only takes effect if the fork server has not been started yet, by a parallel search for example
+        context.set_forkserver_preload(PRELOAD_MODULES)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                            initializer=initialize_worker, initargs=(self.stop_flags.name,))
+        # Start every worker now, so the first searches do not wait for them
+        for future in [self.executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+        self.thread = threading.Thread(target=self.dispatcher_thread, daemon=True)
+        self.thread.start()
+        logging.info(f"Started the AI worker pool with {self.workers} workers")
+
+    @classmethod
+    def get_default(cls):
+        """
+        Returns the pool shared by every room in the process, creating it if needed
+        :return:
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    @classmethod
+    def cancel_default_room(cls, room_id):
+        """
+        Cancels the requests of a room in the shared pool, if it has been created
+        :param room_id: The id of the room
+        :return:
+        """
+        if cls._default is not None:
+            cls._default.cancel_room(room_id)
+
+    @classmethod
+    def get_default_statistics(cls):
+        """
+        Returns the statistics of the shared pool, see get_statistics
+        :return: None if the pool has not been created
+        """
+        return cls._default.get_statistics() if cls._default is not None else None
+
+    def submit(self, room_id, function, *args, priority=0):
+        """
+        Queues a function to run in a worker process
+        :param room_id: The id of the room the request is for
+        :param function: The function, it must be importable by the workers, and can call get_stop_flag to find out
+         if it has been cancelled
+        :param args: The arguments of the function, they are pickled so must not reference the room
+        :param priority: Rooms with a higher priority are served sooner, kept between MIN_PRIORITY and MAX_PRIORITY
+        :return: A concurrent.futures.Future of the result, it raises CancelledError if the room is closed first
+        """
+        request = AIRequest(room_id, min(max(priority, MIN_PRIORITY), MAX_PRIORITY), function, args)
+        with self.condition:
+            self.queues.setdefault(room_id, collections.deque()).append(request)
+            self.priorities[room_id] = request.priority
+            self.submitted += 1
+            self.condition.notify_all()
+        return request.future
+
+    def cancel_room(self, room_id):
+        """
+        Cancels the queued and running requests of a room
+        :param room_id: The id of the room
+        :return:
+        """
+        with self.condition:
+            queued = self.queues.pop(room_id, ())
+            self.priorities.pop(room_id, None)
+            self.last_served.pop(room_id, None)
+            for request in queued:
+                request.future.cancel()
+            self.cancelled += len(queued)
+            for slot, request in self.running.items():
+                if request.room_id == room_id:
+                    self.stop_flags.buf[slot] = 1
+        if queued:
+            logging.info(f"Cancelled {len(queued)} queued AI requests of room {room_id}")
+
+    def next_request(self):
+        """
+        Takes the next request to run from the queues, with the condition held
+        :return:
+        """
+        # The room that has waited longest, counting each step of priority as PRIORITY_WEIGHT requests of waiting
+        room_id = max(self.queues,
+                      key=lambda room: self.priorities[room] * PRIORITY_WEIGHT - self.last_served.get(room, -1))
+        queue = self.queues[room_id]
+        request = queue.popleft()
+        if not queue:
+            del self.queues[room_id]
+        self.last_served[room_id] = next(self.sequence)
+        return request
+
+    def dispatcher_thread(self):
+        """
+        Starts the queued requests in the workers whenever fewer than max_searches are running
+        :return:
+        """
+        while True:
+            with self.condition:
+                while not self.queues or not self.free_slots:
+                    self.condition.wait()
+                request = self.next_request()
+                if not request.future.set_running_or_notify_cancel():
+                    self.cancelled += 1
+                    continue
+                request.slot = self.free_slots.pop()
+                self.stop_flags.buf[request.slot] = 0
+                self.running[request.slot] = request
+                wait = time.monotonic() - request.submitted
+                self.started += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.waits.append(wait)
+            try:
+                future = self.executor.submit(run_request, request.function, request.args, request.slot)
+            except Exception as e:
+                self.finish_request(request, None, e)
+                continue
+            future.add_done_callback(functools.partial(self.finish_request, request))
+
+    def finish_request(self, request, future, error=None):
+        """
+        Frees the slot of a finished request and passes its result to the room
+        :param request: The request
+        :param future: The future of the worker, or None if it could not be started
+        :param error: The error that stopped it from being started
+        :return:
+        """
+        with self.condition:
+            stopped = self.stop_flags.buf[request.slot] != 0
+            del self.running[request.slot]
+            self.free_slots.append(request.slot)
+            if error is None and future.exception() is not None:
+                error = future.exception()
+            if stopped:
+                self.cancelled += 1
+            elif error is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+            self.condition.notify_all()
+        if stopped:
+            request.future.set_exception(CancelledError())
+        elif error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(future.result())
+
+    def close_stop_flags(self):
+        """
+        Frees the shared memory of the stop flags when the server exits
+        :return:
+        """
+        self.stop_flags.close()
+        self.stop_flags.unlink()
+
+    def get_statistics(self):
+        """
+        Returns the statistics of the pool
+        :return: A dictionary that can be sent as JSON
+        """
+        with self.condition:
+            queue_depths = {room_id: len(queue) for room_id, queue in self.queues.items()}
+            waits = sorted(self.waits)
+            return {
+                "workers": self.workers,
+                "max_searches": self.max_searches,
+                "running": len(self.running),
+                "queued": sum(queue_depths.values()),
+                "queue_depths": queue_depths,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "failed": self.failed,
+                "average_wait": self.total_wait / self.started if self.started else 0,
+                "max_wait": self.max_wait,
+                "recent_average_wait": sum(waits) / len(waits) if waits else 0,
+                "recent_95th_percentile_wait": waits[int(len(waits) * 0.95)] if waits else 0,
+            }
@@ -1,5 +1,9 @@
 from user import User
 import hashlib
+import math
+import threading
+
+from GameManagers.ai_pool import AIWorkerPool
 
 
 class BaseRoom:
@@ -20,6 +24,34 @@ class BaseRoom:
         self.state = "Idle"
         self.room_id = hashlib.sha256(str(self.name).encode('utf-8')).hexdigest()
         self.max_users = 0
+        # Notified when the player to move changes or the game ends, so AI players can sleep until it is their turn
+        self.turn_changed = threading.Condition()
+
+    @staticmethod
+    def get_number_config(starting_config, key, default, minimum=None, maximum=None, integer=False):
+        """
+        Reads a number from a room's config. The config is sent by the client, so the number is checked and kept within
+        the bounds the server allows.
+        :param starting_config: The config of the room
+        :param key: The name of the option
+        :param default: The value used when the option is not given or is None
+        :param minimum: The smallest value allowed, or None for no minimum
+        :param maximum: The largest value allowed, or None for no maximum
+        :param integer: Whether the option has to be a whole number
+        :return: The value, clamped to the bounds
+        :raises ValueError: If the value is not a number
+        """
+        value = starting_config[key] if key in starting_config else None
+        if value is None:
+            return default
+        if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)) \
+                or not math.isfinite(value):
+            raise ValueError(f"The room option {key} must be {'an integer' if integer else 'a number'}")
+        if minimum is not None:
+            value = max(value, minimum)
+        if maximum is not None:
+            value = min(value, maximum)
+        return value
 
     def get_game_info(self):
         """
@@ -64,6 +96,42 @@ class BaseRoom:
         """
         raise NotImplementedError
 
+    def notify_turn_changed(self):
+        """
+        Wakes the threads waiting in wait_for_turn, called whenever the player to move changes or the game ends
+        :return:
+        """
+        with self.turn_changed:
+            self.turn_changed.notify_all()
+
+    def wait_for_turn(self, is_turn, timeout=None):
+        """
+        Blocks until it is a player's turn, without using any CPU while it waits
+        :param is_turn: A function that returns True once the player should move or the game is over, it is called with
+         turn_changed held
+        :param timeout: The most seconds to wait, or None to wait until it returns True
+        :return: The last result of is_turn
+        """
+        with self.turn_changed:
+            return self.turn_changed.wait_for(is_turn, timeout)
+
+    def close(self):
+        """
+        Called when the room is deleted. Wakes the AI threads waiting for their turn so they can see the game has ended,
+        and cancels the room's queued and running searches in the AI worker pool.
+        :return:
+        """
+        self.notify_turn_changed()
+        AIWorkerPool.cancel_default_room(self.room_id)
+
+    def get_ai_statistics(self):
+        """
+        Get the statistics of the AI players in the room, so rooms that use a lot of CPU can be found
+        :return: A dictionary with the room_id, name, type and a list of the statistics of each AI player, each with a
+         "total" dictionary of the moves, time and nodes it has searched. None if the room has no AI statistics.
+        """
+        return None
+
     def get_board_state(self, user):
         """
         Get the state of the board for a particular user
@@ -0,0 +1,208 @@
+"""
+Game clocks for every room on the server, run by a single scheduler thread.
+A clock only stores when the running player's time runs out, against time.monotonic(), and works out the time left
+when it is read, so clocks do not drift and a clock that is not running costs nothing. The scheduler keeps the
+deadlines of the running clocks in a heap and sleeps until the earliest one, so a thousand timed games cost one thread.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+from loguru import logger as logging
+
+
+class ClockScheduler:
+    """
+    Calls functions at time.monotonic() deadlines from one background thread
+    """
+
+    _default = None  # type: ClockScheduler | None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # A heap of [deadline, sequence, callback], the callback is set to None when the event is cancelled
+        self.events = []  # type: list[list]
+        self.sequence = itertools.count()  # Orders events with the same deadline by when they were scheduled
+        self.cancelled = 0
+        self.thread = None  # type: threading.Thread | None
+
+    @classmethod
+    def get_default(cls):
+        """
+        Returns the scheduler shared by every room in the process, creating it if needed
+        :return:
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def schedule(self, deadline, callback):
+        """
+        Calls a function once a deadline has passed
+        :param deadline: The time.monotonic() time to call the function at
+        :param callback: The function, called with no arguments from the scheduler thread, it should return quickly
+        :return: The event, which can be passed to cancel
+        """
+        event = [deadline, next(self.sequence), callback]
+        with self.condition:
+            heapq.heappush(self.events, event)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.scheduler_thread, daemon=True)
+                self.thread.start()
+            # Wake the thread in case this deadline is earlier than the one it is waiting for
+            self.condition.notify()
+        return event
+
+    def cancel(self, event):
+        """
+        Stops an event from being called, if it has not been already
+        :param event: The event returned by schedule
+        :return:
+        """
+        with self.condition:
+            if event[2] is None:
+                return
+            event[2] = None
+            self.cancelled += 1
+            # Cancelled events are left in the heap until they are reached, unless they are most of it
+            if self.cancelled > len(self.events) // 2:
+                self.events = [pending for pending in self.events if pending[2] is not None]
+                heapq.heapify(self.events)
+                self.cancelled = 0
+
+    def __len__(self):
+        return len(self.events) - self.cancelled
+
+    def scheduler_thread(self):
+        """
+        Waits for the earliest deadline and calls its function, until the process exits
+        :return:
+        """
+        while True:
+            with self.condition:
+                while True:
+                    while self.events and self.events[0][2] is None:
+                        heapq.heappop(self.events)
+                        self.cancelled -= 1
+                    if not self.events:
+                        self.condition.wait()
+                        continue
+                    delay = self.events[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                event = heapq.heappop(self.events)
+                # Mark the event as done, so cancelling it now does not count it as cancelled in the heap
+                callback, event[2] = event[2], None
+            try:
+                callback()
+            except Exception as e:
+                logging.exception(f"Clock event failed: {e}")
+
+
+class GameClock:
+    """
+    The clocks of the players of a game, at most one of which runs at a time
+    """
+
+    def __init__(self, remaining, on_flag_fall, scheduler=None):
+        """
+        :param remaining: A list of the seconds each player has left
+        :param on_flag_fall: Called with the index of the player when their time runs out, from the scheduler thread
+        :param scheduler: The ClockScheduler, the one shared by the process by default
+        """
+        self.lock = threading.Lock()
+        self.remaining = [float(seconds) for seconds in remaining]  # The time left when each clock was last stopped
+        self.on_flag_fall = on_flag_fall
+        self.scheduler = scheduler if scheduler is not None else ClockScheduler.get_default()
+        self.running = None  # The index of the player whose clock is running, or None
+        self.deadline = None  # The time.monotonic() time the running clock runs out at
+        self.event = None  # The scheduler event of the running clock's deadline
+        self.flagged = None  # The index of the player whose time ran out, or None
+
+    def get_remaining(self):
+        """
+        Returns the time each player has left
+        :return: A list of seconds
+        """
+        with self.lock:
+            remaining = list(self.remaining)
+            if self.running is not None:
+                remaining[self.running] = max(self.deadline - time.monotonic(), 0)
+            return remaining
+
+    def start(self, player):
+        """
+        Starts the clock of a player, stopping the one that was running
+        :param player: The index of the player
+        :return:
+        """
+        with self.lock:
+            self._stop()
+            if self.flagged is not None:
+                return
+            self.running = player
+            self.deadline = time.monotonic() + self.remaining[player]
+            self.event = self.scheduler.schedule(self.deadline, self.flag_fall)
+
+    def press(self, player, increment=0):
+        """
+        Ends a player's turn, adding the increment to their time and starting the clock of the next player
+        :param player: The index of the player that moved
+        :param increment: The seconds added to their time
+        :return: False if their time had already run out, in which case on_flag_fall is or has been called
+        """
+        with self.lock:
+            self._stop()
+            if self.flagged is not None:
+                return False
+            if self.remaining[player] > 0:
+                self.remaining[player] += increment
+                self.running = (player + 1) % len(self.remaining)
+                self.deadline = time.monotonic() + self.remaining[self.running]
+                self.event = self.scheduler.schedule(self.deadline, self.flag_fall)
+                return True
+            # The move arrived after the deadline, but before the scheduler got to it
+            self.flagged = player
+        self.on_flag_fall(player)
+        return False
+
+    def stop(self):
+        """
+        Stops the running clock, keeping the time it has left
+        :return:
+        """
+        with self.lock:
+            self._stop()
+
+    def _stop(self):
+        """
+        stop, with the lock already held
+        :return:
+        """
+        if self.running is None:
+            return
+        self.scheduler.cancel(self.event)
+        self.remaining[self.running] = max(self.deadline - time.monotonic(), 0)
+        self.running = None
+        self.deadline = None
+        self.event = None
+
+    def flag_fall(self):
+        """
+        Called by the scheduler when the running clock's deadline passes
+        :return:
+        """
+        with self.lock:
+            if self.running is None or time.monotonic() < self.deadline:
+                return  # The clock was stopped or restarted while the event was being called
+            player = self.running
+            self.remaining[player] = 0
+            self.running = None
+            self.deadline = None
+            self.event = None
+            self.flagged = player
+        self.on_flag_fall(player)
@@ -21,11 +21,6 @@ import ratelimiter
 from roommanager import RoomManager
 from user import User
 
-# Set the logging level to INFO
-logging.remove()
-logging.add(sys.stdout, level="INFO")
-logging.add("logs/{time}.log", level="INFO")
-
 
 def get_host_names():
     """
@@ -176,6 +171,9 @@ class main:
             web.get('/room/get_state', self.room_manager.get_board_state),
             web.get('/room/has_changed', self.room_manager.has_board_changed),
             web.get('/room/get_saved_info/{game_id}', self.room_manager.get_save_game_info),
+            web.get('/ai_stats', self.room_manager.get_ai_statistics),  # Search statistics of every room's AI
+            web.get('/ai_stats/{room_id}', self.room_manager.get_room_ai_statistics),
+            web.get('/ai_pool', self.room_manager.get_ai_pool_statistics),  # Queue and wait times of the AI workers
             # Post requests
             web.post('/create_room', self.room_manager.create_room),
             web.post('/join_room', self.room_manager.join_room),
@@ -289,5 +287,10 @@ class main:
 
 
 if __name__ == '__main__':
+    # Set the logging level to INFO. This is only done when run as the server, the AI worker processes also run this
+    # module and would each create a log file.
+    logging.remove()
+    logging.add(sys.stdout, level="INFO")
+    logging.add("logs/{time}.log", level="INFO")
     manager = main()
     manager.run()
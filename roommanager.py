@@ -5,6 +5,7 @@ from aiohttp import web
 import os
 
 import ratelimiter
+from GameManagers.ai_pool import AIWorkerPool
 from GameManagers.base_room import BaseRoom
 from user import User, Users
 
@@ -82,6 +83,9 @@ class RoomManager:
             self.rooms[room.room_id] = room
             logging.info(f"Created room: {room.room_id} with starting config: {room_config}")
             return web.json_response({"room_id": room.room_id})
+        except ValueError as e:
+            logging.info(f"Invalid room config: {e} from {request.remote}")
+            return web.json_response({"error": str(e)}, status=400)
         except Exception as e:
             logging.exception(f"Failed to create room: {e}")
             return web.json_response({"error": "Failed to create room"}, status=500)
@@ -338,6 +342,75 @@ class RoomManager:
         game_info = game_class.get_save_game_info(self.database, self.users, game[0])
         return web.json_response(game_info, status=200)
 
+    def get_room_ai_statistics(self, request):
+        """
+        Returns the live and recent search statistics of the AI players in a room
+        :param request: A web request, with the room_id in its path
+        :return:
+        """
+        room_id = request.match_info.get("room_id")
+        if room_id not in self.rooms:
+            return web.json_response({"error": "Invalid room id"}, status=404)
+        statistics = self.rooms[room_id].get_ai_statistics()
+        if statistics is None:
+            return web.json_response({"error": "Room has no AI statistics"}, status=404)
+        return web.json_response(statistics, status=200)
+
+    def get_ai_statistics(self, request):
+        """
+        Returns the search statistics of the AI players of every room, with the rooms that have spent the most time
+        searching first, and the totals of each room type and variant
+        :param request: A web request
+        :return:
+        """
+        rooms = []
+        variants = {}
+        try:
+            for room in list(self.rooms.values()):
+                statistics = room.get_ai_statistics()
+                if statistics is None:
+                    continue
+                players = statistics["players"]
+                summary = {
+                    "room_id": statistics["room_id"],
+                    "name": statistics["name"],
+                    "type": statistics["type"],
+                    "variant": statistics.get("variant"),
+                    "searching": any(player["live"]["searching"] for player in players),
+                    "moves": sum(player["total"]["moves"] for player in players),
+                    "time": sum(player["total"]["time"] for player in players),
+                    "nodes": sum(player["total"]["nodes"] for player in players),
+                }
+                rooms.append(summary)
+
+                name = summary["type"] if summary["variant"] is None else f"{summary['type']} ({summary['variant']})"
+                totals = variants.setdefault(name, {"rooms": 0, "searching": 0, "moves": 0, "time": 0, "nodes": 0})
+                totals["rooms"] += 1
+                totals["searching"] += summary["searching"]
+                for statistic in ("moves", "time", "nodes"):
+                    totals[statistic] += summary[statistic]
+        except Exception as e:
+            logging.exception(f"Failed to get AI statistics: {e}")
+            return web.json_response({"error": "Failed to get AI statistics"}, status=500)
+
+        for totals in list(variants.values()) + rooms:
+            totals["nodes_per_second"] = totals["nodes"] / totals["time"] if totals["time"] else 0
+            totals["time_per_move"] = totals["time"] / totals["moves"] if totals["moves"] else 0
+        rooms.sort(key=lambda room: room["time"], reverse=True)
+        return web.json_response({"rooms": rooms, "variants": variants}, status=200)
+
+    def get_ai_pool_statistics(self, request):
+        """
+        Returns how many searches the AI worker pool is running, how many are queued for each room and how long
+        searches wait to start
+        :param request: A web request
+        :return:
+        """
+        statistics = AIWorkerPool.get_default_statistics()
+        if statistics is None:
+            return web.json_response({"error": "The AI worker pool has not been started"}, status=404)
+        return web.json_response(statistics, status=200)
+
     def cleanup_rooms(self):
         """
         Cleans up rooms that have no users
@@ -351,6 +424,6 @@ class RoomManager:
                     logging.info(f"Deleting room {room.room_id}")
                     to_delete.append(room.room_id)
             for room_id in to_delete:
-                self.rooms.pop(room_id)
+                self.rooms.pop(room_id).close()
             # logging.debug("Finished cleaning up rooms")
             time.sleep(30)
@@ -0,0 +1,36 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# The server is run from the root of the repository, so its modules are imported from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Database(sqlite3.Connection):
+    """
+    An in memory database with the run and get methods of the server's ConcurrentDatabase
+    """
+
+    def run(self, sql, *args, **kwargs):
+        cursor = self.cursor()
+        cursor.execute(sql, *args)
+        self.commit()
+        return cursor
+
+    def get(self, sql, *args):
+        cursor = self.run(sql, *args)
+        result = cursor.fetchall()
+        cursor.close()
+        return result
+
+
+@pytest.fixture
+def database():
+    database = sqlite3.connect(":memory:", factory=Database, check_same_thread=False)
+    database.run("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, hash_id TEXT)")
+    database.run("CREATE TABLE room_saves (room_id TEXT PRIMARY KEY, room_type TEXT, room_name TEXT, "
+                 "room_password TEXT)")
+    yield database
+    database.close()
@@ -0,0 +1,172 @@
+import random
+import time
+
+import chess
+import chess.polyglot
+import chess.variant
+import numpy
+import pytest
+
+from GameManagers.Chess.ai_logic import AI, Heuristics
+from GameManagers.Chess.bitbase import Bitbase, generate_table
+
+
+def random_positions(count, seed, variant=chess.Board, max_plies=60):
+    """
+    Plays random games of random lengths and returns their final positions
+    """
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        board = variant()
+        for _ in range(rng.randrange(max_plies)):
+            moves = list(board.legal_moves)
+            if not moves or board.is_variant_end():
+                break
+            board.push(rng.choice(moves))
+        positions.append(board)
+    return positions
+
+
+# The original evaluation, which looked at every square of the board for each piece type
+SCAN_TABLES = {chess.PAWN: Heuristics.PAWN_TABLE, chess.KNIGHT: Heuristics.KNIGHT_TABLE,
+               chess.BISHOP: Heuristics.BISHOP_TABLE, chess.ROOK: Heuristics.ROOK_TABLE,
+               chess.QUEEN: Heuristics.QUEEN_TABLE}
+
+
+def scan_position_score(board):
+    score = 0
+    for piece_type, table in SCAN_TABLES.items():
+        for x in range(8):
+            for y in range(8):
+                piece = board.piece_at(chess.square(x, y))
+                if piece and piece.piece_type == piece_type:
+                    score += table[x][y] if piece.color == chess.WHITE else -table[7 - x][y]
+    return score
+
+
+def scan_material_score(board, ai_color):
+    score = 0
+    for x in range(8):
+        for y in range(8):
+            piece = board.piece_at(chess.square(x, y))
+            if piece:
+                value = Heuristics.piece_values[piece.piece_type]
+                score += value if piece.color == ai_color else -value
+    return score
+
+
+def scan_evaluate(board, ai_color):
+    if board.is_checkmate():
+        return -AI.INFINITE if board.turn == ai_color else AI.INFINITE
+    material = scan_material_score(board, ai_color)
+    if board.is_game_over():
+        if board.is_stalemate():
+            return 999999 if material < 0 else -999999
+        elif board.is_insufficient_material():
+            return 999998 if material < 0 else -999998
+        elif board.is_seventyfive_moves():
+            return 999997 if material < 0 else -999997
+        elif board.is_fivefold_repetition():
+            return 999996 if material < 0 else -999996
+    score = material + scan_position_score(board)
+    if board.is_check():
+        return score + (-9999 if board.turn == ai_color else 99)
+    return score
+
+
+def test_evaluate_matches_square_scan():
+    positions = random_positions(200, seed=2, max_plies=200)
+    # Positions that end the game, or end it by the rules rather than a checkmate
+    positions += [chess.Board("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1"), chess.Board("6Qk/8/6K1/8/8/8/8/8 b - - 0 1"),
+                  chess.Board("8/8/8/4k3/8/8/3K4/8 w - - 0 1"), chess.Board("8/8/8/4k3/8/8/3KR3/8 w - - 150 100")]
+    for board in positions:
+        for ai_color in chess.COLORS:
+            assert Heuristics.evaluate(board, ai_color) == scan_evaluate(board, ai_color), board.fen()
+
+
+@pytest.mark.parametrize("variant", [chess.variant.CrazyhouseBoard, chess.variant.AtomicBoard,
+                                     chess.variant.HordeBoard, chess.variant.AntichessBoard,
+                                     chess.variant.KingOfTheHillBoard, chess.variant.ThreeCheckBoard,
+                                     chess.variant.RacingKingsBoard])
+def test_variant_material_and_position_match_square_scan(variant):
+    # Variant evaluations add their own terms, but the material and piece tables have to be unchanged
+    for board in random_positions(50, seed=3, variant=variant):
+        assert Heuristics.get_position_score(board) == scan_position_score(board), board.fen()
+        for ai_color in chess.COLORS:
+            assert Heuristics.get_material_score(board, ai_color) == scan_material_score(board, ai_color), board.fen()
+
+
+# Positions where castling on both sides, en passant and promotions come up quickly
+SPECIAL_MOVE_POSITIONS = [chess.STARTING_FEN, "r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1",
+                          "r3k2r/8/8/1pP5/8/8/8/R3K2R w KQkq b6 0 1", "4k3/1P4pP/8/3pP3/8/8/1p4Pp/4K3 w - d6 0 1",
+                          "r1n1k2r/1P3ppp/8/8/8/8/1p3PPP/R1N1K2R b KQkq - 0 1"]
+
+
+def test_incremental_keys_match_a_fresh_hash_through_make_and_unmake():
+    rng = random.Random(4)
+    special_moves = {"castling": 0, "en passant": 0, "promotion": 0, "null": 0}
+    for game in range(40):
+        board = chess.Board(SPECIAL_MOVE_POSITIONS[game % len(SPECIAL_MOVE_POSITIONS)])
+        ai = AI(board.turn)
+        ai.start_search(board, time.monotonic() + 60)
+        repetitions = dict(ai.repetitions)
+        snapshots = [(board.fen(), chess.polyglot.zobrist_hash(board))]
+        for _ in range(rng.randrange(10, 60)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            if not board.is_check() and rng.random() < 0.1:
+                move = chess.Move.null()
+                special_moves["null"] += 1
+            else:
+                # Prefer the moves whose key updates are the most involved
+                special = [move for move in moves
+                           if board.is_castling(move) or board.is_en_passant(move) or move.promotion]
+                move = rng.choice(special if special and rng.random() < 0.5 else moves)
+                if board.is_castling(move):
+                    special_moves["castling"] += 1
+                elif board.is_en_passant(move):
+                    special_moves["en passant"] += 1
+                elif move.promotion:
+                    special_moves["promotion"] += 1
+            ai.make_move(board, move)
+            assert ai.current_key(board) == chess.polyglot.zobrist_hash(board), board.fen()
+            snapshots.append((board.fen(), chess.polyglot.zobrist_hash(board)))
+
+        # Unwinding has to restore every earlier position and key
+        while len(snapshots) > 1:
+            snapshots.pop()
+            ai.unmake_move(board)
+            assert (board.fen(), ai.current_key(board)) == snapshots[-1]
+            assert ai.current_key(board) == chess.polyglot.zobrist_hash(board)
+        assert ai.repetitions == repetitions
+
+    assert all(special_moves.values()), special_moves
+
+
+@pytest.fixture(scope="module")
+def queen_bitbase():
+    # Only the KQK table, building every table takes too long for a test
+    bitbase = Bitbase(path="")
+    bitbase.tables = {chess.QUEEN: numpy.packbits(generate_table(chess.QUEEN), bitorder="little").tobytes()}
+    return bitbase
+
+
+@pytest.mark.parametrize("maximizing", [True, False])
+def test_frontier_batch_matches_per_node_scores(queen_bitbase, maximizing):
+    # Captures that leave a bitbase endgame, and some middlegame positions
+    positions = [chess.Board("4k3/8/8/8/8/8/3r4/3QK3 w - - 0 1"), chess.Board("3qk3/3R4/8/8/8/8/8/4K3 b - - 0 1")]
+    positions += [board for board in random_positions(20, seed=1) if board.legal_moves]
+    for board in positions:
+        ai = AI(board.turn, bitbase=queen_bitbase)
+        ai.start_search(board, time.monotonic() + 60)
+        moves = list(board.legal_moves)
+        per_node = []
+        for move in moves:
+            ai.make_move(board, move)
+            per_node.append(ai.evaluate(board))
+            ai.unmake_move(board)
+
+        best_score, _ = ai.evaluate_frontier(board, moves, maximizing)
+        assert best_score == (max if maximizing else min)(per_node), board.fen()
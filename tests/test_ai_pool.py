@@ -0,0 +1,27 @@
+import time
+
+from GameManagers.ai_pool import AIWorkerPool, MAX_PRIORITY, PRIORITY_WEIGHT
+
+
+def test_high_priority_room_does_not_starve_others():
+    pool = AIWorkerPool(workers=1, max_searches=1)
+    order = []
+    try:
+        # Hold the only slot, so every other request is queued before the pool picks between them
+        blocker = pool.submit("blocker", time.sleep, 0.5)
+        while not blocker.running():
+            time.sleep(0.01)
+        futures = [pool.submit("busy", time.sleep, 0, priority=10 ** 9) for _ in range(20)]
+        futures.append(pool.submit("normal", time.sleep, 0))
+        assert pool.priorities["busy"] == MAX_PRIORITY
+        for future, room in zip(futures, ["busy"] * 20 + ["normal"]):
+            future.add_done_callback(lambda _, room=room: order.append(room))
+        for future in futures:
+            future.result(timeout=30)
+    finally:
+        pool.executor.shutdown()
+
+    # The busy room goes ahead for its priority's worth of requests, then has to let the normal room in
+    served_first = order.index("normal")
+    assert served_first <= MAX_PRIORITY * PRIORITY_WEIGHT
+    assert served_first < len(order) - 1
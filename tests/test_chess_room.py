@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import chess
+
+from GameManagers.Chess.chess_room import Chess
+from user import User
+
+AI_MOVE_DELAY = 0.5
+ROOM_CONFIG = {"ai_difficulty": "beginner", "ai_move_delay": AI_MOVE_DELAY, "ai_pool": False}
+
+
+class HumanWhiteChess(Chess):
+    """
+    A chess room where the host plays white against an AI
+    """
+
+    def create_ai(self, color):
+        return self.host if color == chess.WHITE else super().create_ai(color)
+
+
+async def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+async def measure_loop_latency(done):
+    """
+    Returns the longest the event loop took to wake a 10ms sleep, until done is set
+    """
+    longest = 0
+    while not done.is_set():
+        start = time.monotonic()
+        await asyncio.sleep(0.01)
+        longest = max(longest, time.monotonic() - start - 0.01)
+    return longest
+
+
+async def run_with_latency(*coroutines):
+    done = asyncio.Event()
+
+    async def run():
+        try:
+            return await asyncio.gather(*coroutines)
+        finally:
+            done.set()
+
+    _, latency = await asyncio.gather(run(), measure_loop_latency(done))
+    return latency
+
+
+def test_human_moves_in_different_rooms_do_not_serialize(database):
+    rooms = [HumanWhiteChess(database, host=User(database, new_user=True, username=f"human {index}"),
+                             name=f"human room {index}", starting_config=ROOM_CONFIG) for index in range(2)]
+
+    async def move_and_wait_for_reply(room):
+        # Called on the event loop, the way the make_move request handler calls it
+        assert room.post_move(room.host, "e2e4") == {"result": "success"}
+        await wait_until(lambda: room.current_player is room.host)
+
+    start = time.monotonic()
+    latency = asyncio.run(run_with_latency(*(move_and_wait_for_reply(room) for room in rooms)))
+    elapsed = time.monotonic() - start
+    for room in rooms:
+        room.close()
+
+    assert all(len(room.board.move_stack) == 2 for room in rooms)
+    # post_move used to sleep for a second on the event loop, so the second room's move waited for the first's
+    assert elapsed < AI_MOVE_DELAY
+    assert latency < 0.1
+
+
+def test_ai_rooms_pace_their_moves_at_the_same_time(database):
+    start = time.monotonic()
+    rooms = [Chess(database, host=User(database, new_user=True, username=f"spectator {index}"),
+                   name=f"ai room {index}", starting_config=ROOM_CONFIG) for index in range(2)]
+
+    async def wait_for_two_moves(room):
+        await wait_until(lambda: len(room.board.move_stack) >= 2)
+
+    latency = asyncio.run(run_with_latency(*(wait_for_two_moves(room) for room in rooms)))
+    elapsed = time.monotonic() - start
+    for room in rooms:
+        room.close()
+
+    # Each room waits one ai_move_delay between its AIs' moves, and the rooms wait at the same time
+    assert AI_MOVE_DELAY <= elapsed < AI_MOVE_DELAY * 1.5
+    assert latency < 0.1
+
+
+def create_human_room(database, name, **config):
+    """
+    Creates a chess room between two human players
+    :return: A tuple of (room, white, black)
+    """
+    white = User(database, new_user=True, username="white")
+    black = User(database, new_user=True, username="black")
+    room = HumanWhiteChess(database, host=white, name=name, starting_config=dict(ROOM_CONFIG, **config))
+    room.users[1] = black
+    return room, white, black
+
+
+def test_move_after_flag_fall(database):
+    room, white, black = create_human_room(database, "timed room", timers_enabled=True, white_time=60,
+                                           black_time=0.05)
+    # The clocks start with the first move
+    assert room.post_move(white, "e2e4") == {"result": "success"}
+    deadline = time.monotonic() + 5
+    while not room.game_over:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    assert room.post_move(black, "e7e5") == {"error": "game_over"}
+    room.close()
+
+    assert room.state == "Time Up"
+    assert [move.uci() for move in room.board.move_stack] == ["e2e4"]
+
+
+def test_save_game_twice(database):
+    room, white, black = create_human_room(database, "saved room")
+    room.post_move(white, "e2e4")
+    room.post_move(black, "e7e5")
+    room.save_game()
+    room.post_move(white, "g1f3")
+    room.save_game()
+    room.close()
+
+    assert database.get("SELECT moves FROM chess_game_saves WHERE game_id = ?", (room.room_id,)) == \
+        [("e2e4 e7e5 g1f3",)]
+    assert len(database.get("SELECT * FROM room_saves WHERE room_id = ?", (room.room_id,))) == 1
@@ -0,0 +1,23 @@
+import threading
+import time
+
+from GameManagers.clock import ClockScheduler
+
+
+def test_cancel_after_event_fires():
+    scheduler = ClockScheduler()
+    fired = threading.Event()
+    event = scheduler.schedule(time.monotonic(), fired.set)
+    # Enough pending events that one miscounted cancel does not trigger a compaction, which would hide it
+    pending = [scheduler.schedule(time.monotonic() + 60, lambda: None) for _ in range(4)]
+    assert fired.wait(5)
+    assert len(scheduler) == 4
+
+    # A move or the room closing can cancel the clock's event just after its flag fell
+    scheduler.cancel(event)
+    assert len(scheduler) == 4
+    assert len(scheduler.events) == 4
+
+    for event in pending:
+        scheduler.cancel(event)
+    assert len(scheduler) == 0
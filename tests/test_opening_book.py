@@ -0,0 +1,28 @@
+import chess
+
+from GameManagers.Chess.ai_logic import AI
+from GameManagers.Chess.opening_book import OpeningBook, add_game, write_book
+
+GAME = ["e2e4", "e7e5", "g1f3", "b8c6", "f1b5", "a7a6"]
+
+
+def create_book(tmp_path, max_ply):
+    counts = {}
+    add_game(counts, [chess.Move.from_uci(move) for move in GAME], "1/2-1/2", len(GAME))
+    write_book(counts, tmp_path / "book.bin")
+    return OpeningBook(str(tmp_path / "book.bin"), max_ply=max_ply)
+
+
+def test_book_stops_at_max_ply_after_pawn_moves(tmp_path):
+    book = create_book(tmp_path, max_ply=4)
+    board = chess.Board()
+    for move in GAME[:4]:
+        ai = AI(board.turn, seed=1, opening_book=book)
+        assert ai.get_ai_move(board, [], depth=0, time_limit=1) == chess.Move.from_uci(move)
+        assert ai.used_opening_book
+        board.push_uci(move)
+
+    # The search's copy of the board only keeps the moves since the last pawn move, the book still has to stop here
+    ai = AI(board.turn, seed=1, opening_book=book)
+    ai.get_ai_move(board, [], depth=0, time_limit=1)
+    assert not ai.used_opening_book
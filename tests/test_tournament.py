@@ -0,0 +1,15 @@
+import chess
+import pytest
+
+from GameManagers.Chess.ai import ChessAI
+from GameManagers.Chess.tournament import parse_configuration, play_game
+
+
+@pytest.mark.parametrize("difficulty", ChessAI.DIFFICULTIES)
+def test_play_game_with_each_difficulty(difficulty):
+    # The time limit only keeps the test short, every other option of the difficulty is used as is
+    configuration = parse_configuration(f"difficulty={difficulty},time_limit=0.5")
+    result = play_game(configuration, configuration, chess.WHITE, "chess", chess.STARTING_FEN, ["e2e4"], 5, 1)
+
+    assert result["plies"] == 5
+    assert result["first"]["moves"] + result["second"]["moves"] == 4